@@ -1 +1,6 @@
-from .bazaar import FileSystem
\ No newline at end of file
+from .bazaar import FileSystem
+
+try:
+    from .aio import AsyncFileSystem
+except ImportError:  # motor is only installed with the "async" extra
+    pass
@@ -0,0 +1,546 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from bson import ObjectId
+from fs import open_fs
+from fs.base import FS
+from fs.errors import ResourceNotFound
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection, AsyncIOMotorDatabase
+from pymongo.errors import DuplicateKeyError
+
+from .bazaar import (
+    FILE_COMMITTED, FILE_INDEX, FILE_OBJECT_PROJECT, FILE_PENDING, FILE_PROJECT, FILE_ROLLBACK_PROJECT,
+    FILE_SIZE_CHANGING_MODES, TIER_COLD, TIER_MOVE_POLL_SECONDS, TIER_MOVE_WAIT_SECONDS, FileAttrs, FileSystem
+)
+from .blobs import BlobStore
+from .compression import Codec, decompress_chunks, get_codec, open_reader
+from .directories import DirectoryIndex
+from .ranges import read_range
+from .layout import ObjectLayout
+from .usage import UsageCounters
+
+
+# Threads running the storage calls, the database ones don't need them
+ASYNC_IO_WORKERS = 16
+
+
+class AsyncBufferWrapper(object):
+    """What AsyncFileSystem.open returns: the file methods run in the executor and close updates the size."""
+
+    def __init__(
+        self,
+        wrapped_object: Any,
+        file_data: Dict[str, Any],
+        db: AsyncIOMotorCollection,
+        executor: ThreadPoolExecutor,
+        usage_counters: UsageCounters = None
+    ):
+        self.wrapped_object = wrapped_object
+        self.file_data = file_data
+        self.db = db
+        self.executor = executor
+        self.usage_counters = usage_counters
+
+    async def run(self, function: Callable, *args) -> Any:
+        return await asyncio.get_event_loop().run_in_executor(self.executor, partial(function, *args))
+
+    async def read(self, size: int = -1):
+        return await self.run(self.wrapped_object.read, size)
+
+    async def write(self, data) -> int:
+        return await self.run(self.wrapped_object.write, data)
+
+    async def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        return await self.run(self.wrapped_object.seek, offset, whence)
+
+    def tell(self) -> int:
+        return self.wrapped_object.tell()
+
+    async def close(self):
+        # Closing stores the content on some backends (the upload of S3), so the size is committed after it
+        new_size = self.wrapped_object.tell() if self.can_mode_change_size() else None
+        await self.run(self.wrapped_object.close)
+        if new_size is not None:
+            await self.update_file_size_if_needed(new_size)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def update_file_size_if_needed(self, new_size: int = None) -> bool:
+        if self.can_mode_change_size():
+            if new_size is None:
+                new_size = self.wrapped_object.tell()
+            if self.file_data.get('size') != new_size:
+                await self.update_file_size(new_size)
+                return True
+        return False
+
+    def can_mode_change_size(self) -> bool:
+        # Text files of some backends only have the mode in the underlying binary file
+        mode = getattr(self.wrapped_object, 'mode', None) or getattr(getattr(self.wrapped_object, 'buffer', None), 'mode', None)
+        return mode is not None and mode[0] in FILE_SIZE_CHANGING_MODES
+
+    async def update_file_size(self, new_size: int):
+        update_result = await self.db.update_one(
+            {"name": self.file_data["name"], "namespace": self.file_data["namespace"]},
+            {"$set": {"size": new_size, "state": FILE_COMMITTED}}
+        )
+        # In case source does not exist, matched_count is 0
+        if update_result.matched_count == 0:
+            raise Exception("Cannot update size of a non existent file")
+        if self.usage_counters is not None:
+            await self.run(
+                self.usage_counters.add, self.file_data["namespace"], 0, new_size - (self.file_data.get("size") or 0)
+            )
+        self.file_data["size"] = new_size
+
+
+class AsyncFileSystem(object):
+    """FileSystem for asyncio: metadata goes through motor and only the storage calls use threads.
+
+    The database can be given already connected (eg a mongomock-motor one for tests), then db_uri is ignored.
+    Indexes are not created on init, await ensure_indexes() for it.
+
+    Files stored by FileSystem(deduplicate=True) or compressed can be read. Writes here store the contents as they are,
+    releasing the blob of a deduplicated file, as removing it. Files moved to the cold tier need its cold_storage_uri;
+    writing them brings them back to the hot one, as in FileSystem.
+
+    directory_index keeps the collection of directories of FileSystem(directory_index=True) updated, and list_dirs
+    reads it, as usage_counters does with the counters of FileSystem(usage_counters=True). Both must have them on to
+    share a database.
+
+    The blobs, the directories and the usage counters are kept with the classes of FileSystem, through the pymongo database under the
+    motor one (its delegate) and in the executor, so the two share their bookkeeping.
+    """
+
+    def __init__(
+        self,
+        storage_uri=None,
+        db_uri="mongodb://localhost/bazaar",
+        namespace="",
+        io_workers=ASYNC_IO_WORKERS,
+        database: AsyncIOMotorDatabase = None,
+        shard_levels=0,
+        cold_storage_uri=None,
+        directory_index=False,
+        usage_counters=False
+    ):
+        if storage_uri is None:
+            storage_uri = "bazaar"
+            if not os.path.exists(storage_uri):
+                os.mkdir(storage_uri)
+
+        if database is None:
+            if db_uri is None:
+                self.mongo = AsyncIOMotorClient()
+            else:
+                self.mongo = AsyncIOMotorClient(host=db_uri)
+            database = self.mongo.get_default_database()
+
+        self.fs = open_fs(storage_uri)
+        self.cold_fs = open_fs(cold_storage_uri) if cold_storage_uri is not None else None
+        self.layout = ObjectLayout(shard_levels)
+        self.db = database.file
+        self.blobs = BlobStore(database.delegate.blob, self.layout)
+        self.directories = None
+        if directory_index:
+            self.directories = DirectoryIndex(database.delegate.directory)
+        self.usage_counters = None
+        if usage_counters:
+            self.usage_counters = UsageCounters(database.delegate.usage)
+        self.namespace = namespace
+        self.executor = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="bazaar-aio")
+
+    async def run_io(self, function: Callable[..., Any], *args) -> Any:
+        return await asyncio.get_event_loop().run_in_executor(self.executor, partial(function, *args))
+
+    async def ensure_indexes(self):
+        await self.db.create_index(FILE_INDEX, unique=True)
+        if self.directories is not None:
+            await self.run_io(self.directories.ensure_indexes)
+
+    async def add_directories(self, names: Iterable[str], namespace: str):
+        if self.directories is not None:
+            await self.run_io(self.directories.add, names, namespace)
+
+    async def remove_directories(self, names: Iterable[str], namespace: str):
+        if self.directories is not None:
+            await self.run_io(self.directories.remove, names, namespace)
+
+    async def count_usage(self, namespace: str, files: int, size: int):
+        if self.usage_counters is not None:
+            await self.run_io(self.usage_counters.add, namespace, files, size)
+
+    def storage_of(self, d: Dict[str, Any]) -> FS:
+        if d.get("tier") != TIER_COLD:
+            return self.fs
+        if self.cold_fs is None:
+            raise ValueError(f"The object of {d.get('name', d['_id'])} is in the cold tier, but there is no cold_storage_uri")
+        return self.cold_fs
+
+    async def wait_move(self, file_id: ObjectId):
+        """Wait for the move between tiers of a file to end before writing its hot object, as FileSystem.wait_moves."""
+        query = {"_id": file_id, "moving": {"$ne": None}}
+        deadline = time.monotonic() + TIER_MOVE_WAIT_SECONDS
+        while await self.db.find_one(query, {"_id": 1}) is not None:
+            if time.monotonic() > deadline:
+                await self.db.update_one(query, {"$unset": {"moving": ""}})
+                return
+            await asyncio.sleep(TIER_MOVE_POLL_SECONDS)
+
+    def remove_cold(self, d: Dict[str, Any]):
+        """Remove the cold object of the file of d, or the copy kept after promoting it, once it's written to the hot
+        tier or removed.
+        """
+        if (d.get("tier") == TIER_COLD or d.get("cold_copy")) and self.cold_fs is not None:
+            try:
+                self.layout.remove(self.cold_fs, str(d["_id"]))
+            except ResourceNotFound:
+                pass
+
+    def drop_flat(self, d: Dict[str, Any]):
+        """Remove the legacy flat object of the file of d (as it was before writing it), now in its sharded path."""
+        if not d.get("sharded") and not d.get("blob"):
+            self.layout.remove_flat(self.fs, str(d["_id"]))
+
+    def read_file(self, fs: FS, filename: str, codec: Codec = None) -> bytes:
+        with self.layout.open(fs, filename, "rb") as f:
+            content = f.read()
+        return content if codec is None else codec.decompress(content)
+
+    def write_file(self, fs: FS, filename: str, content: bytes):
+        with self.layout.open(fs, filename, "wb") as f:
+            f.write(content)
+
+    async def get(self, path: str, namespace: str = None) -> bytes:
+        path = FileSystem.sanitize_path(path, False)
+        if namespace is None:
+            namespace = self.namespace
+
+        d = await self.db.find_one({"name": path, "namespace": namespace}, FILE_OBJECT_PROJECT)
+        if d is not None:
+            return await self.run_io(self.read_file, self.storage_of(d), FileSystem.object_name(d), get_codec(d.get("codec")))
+
+    async def get_range(self, path: str, offset: int, length: int = None, namespace: str = None) -> Optional[bytes]:
+        path = FileSystem.sanitize_path(path, False)
+        if namespace is None:
+            namespace = self.namespace
+
+        d = await self.db.find_one({"name": path, "namespace": namespace}, FILE_PROJECT)
+        if d is None:
+            return None
+        size = d.get("size")
+        if size is None:
+            size = await self.run_io(self.storage_of(d).getsize, self.layout.path(FileSystem.object_name(d)))
+        offset, end = FileSystem.range_bounds(offset, length, size)
+        return await self.run_io(
+            read_range, self.storage_of(d), self.layout, FileSystem.object_name(d), offset, end - offset,
+            get_codec(d.get("codec"))
+        )
+
+    async def open(self, path: str, mode: str, namespace: str = None) -> AsyncBufferWrapper:
+        path = FileSystem.sanitize_path(path, False)
+        if namespace is None:
+            namespace = self.namespace
+
+        if any(m in mode for m in "wax+"):
+            # Touched, so a move between tiers started before is given up
+            fields = {"updated": datetime.utcnow()}
+            if "w" in mode:
+                fields.update(FileSystem.layout_fields(self.layout))
+            d = await self.db.find_one_and_update(
+                {"name": path, "namespace": namespace}, FileSystem.set_fields(fields), FILE_PROJECT
+            )
+            if d is not None and d.get("moving"):
+                await self.wait_move(d["_id"])
+        else:
+            d = await self.db.find_one({"name": path, "namespace": namespace}, FILE_PROJECT)
+        codec = None
+        fs = self.fs
+        # Database information
+        if d is not None:
+            previous = dict(d)
+            filename = FileSystem.object_name(d)
+            new_file = False
+            codec = get_codec(d.get("codec"))
+            if (d.get("tier") == TIER_COLD or d.get("cold_copy")) and any(m in mode for m in "wax+"):
+                # Written in the hot tier
+                fields = {"tier": None, "cold_copy": None}
+                if "w" not in mode and d.get("tier") == TIER_COLD:
+                    await self.run_io(self.layout.transfer, self.storage_of(d), self.fs, str(d["_id"]))
+                    fields.update(FileSystem.layout_fields(self.layout))
+                await self.db.update_one({"_id": d["_id"]}, FileSystem.set_fields(fields))
+                await self.run_io(self.remove_cold, d)
+                d.update(fields)
+            elif d.get("tier") == TIER_COLD:
+                fs = self.storage_of(d)
+            if (d.get("blob") or codec is not None) and any(m in mode for m in "wax+"):
+                # A shared or compressed content can't be changed, the file gets its own plain copy
+                filename = str(d["_id"])
+                fields = {"blob": None, "codec": None, "stored_size": None}
+                if "w" not in mode and codec is not None:
+                    await self.run_io(
+                        self.layout.rewrite, self.fs, FileSystem.object_name(d), filename,
+                        lambda chunks: decompress_chunks(chunks, codec)
+                    )
+                    fields.update(FileSystem.layout_fields(self.layout))
+                elif "w" not in mode:
+                    await self.run_io(self.layout.copy, self.fs, d["blob"], filename)
+                    fields.update(FileSystem.layout_fields(self.layout))
+                await self.db.update_one({"_id": d["_id"]}, FileSystem.set_fields(fields))
+                if d.get("blob"):
+                    await self.run_io(self.blobs.release, self.fs, d["blob"])
+                d.update(fields)
+                codec = None
+        else:
+            if "w" in mode:
+                # Committed when closed
+                d = {
+                    "name": path,
+                    "namespace": namespace,
+                    "created": datetime.utcnow(),
+                    "updated": datetime.utcnow(),
+                    "state": FILE_PENDING
+                }
+                if self.layout.shard_levels:
+                    d["sharded"] = True
+                insert_info = await self.db.insert_one(d)
+                filename = str(insert_info.inserted_id)
+                new_file = True
+                d['_id'] = insert_info.inserted_id
+                # Accounted as it's created, so a crash leaves a pending file to undo like one being removed
+                await self.add_directories([path], namespace)
+                await self.count_usage(namespace, 1, 0)
+            else:
+                raise FileNotFoundError("[Errno 2] No such file or directory: '{filename}'".format(filename=path))
+
+        # File bytes storing
+        try:
+            if codec is not None:
+                file = open_reader(await self.run_io(self.layout.open, fs, filename, "rb", d.get("sharded")), codec, mode)
+            else:
+                file = await self.run_io(self.layout.open, fs, filename, mode, d.get("sharded"))
+        except Exception as e:
+            if new_file:
+                # Only remove when creating the file, otherwise we could remove a valid entry (eg if database is ok and storage is not)
+                await self.db.delete_one({"name": path, "namespace": namespace})
+                await self.remove_directories([path], namespace)
+                await self.count_usage(namespace, -1, 0)
+            raise e
+        if not new_file and any(m in mode for m in "wax+") and ("w" in mode or d.get("sharded")):
+            # Written to its sharded path from now on
+            await self.run_io(self.drop_flat, previous)
+        return AsyncBufferWrapper(file, d, self.db, self.executor, self.usage_counters)
+
+    async def change_namespace(self, path: str, from_namespace: str, to_namespace: str) -> bool:
+        path = FileSystem.sanitize_path(path, False)
+        # Destination should not exists
+        if await self.db.find_one({"name": path, "namespace": to_namespace}, {"_id": 1}) is not None:
+            return False
+
+        d = await self.db.find_one_and_update(
+            {"name": path, "namespace": from_namespace},
+            {"$set": {"namespace": to_namespace, "updated": datetime.utcnow()}},
+            {"size": 1}
+        )
+        if d is None:
+            return False
+        await self.remove_directories([path], from_namespace)
+        await self.add_directories([path], to_namespace)
+        await self.count_usage(from_namespace, -1, -d.get("size", 0))
+        await self.count_usage(to_namespace, 1, d.get("size", 0))
+        return True
+
+    async def set_extras(self, path: str, extras: Dict[str, Any], namespace: str = None) -> bool:
+        path = FileSystem.sanitize_path(path, False)
+        if namespace is None:
+            namespace = self.namespace
+
+        r = await self.db.update_one(
+            {"name": path, "namespace": namespace},
+            {"$set": {"extras": extras, "updated": datetime.utcnow()}}
+        )
+        return r.matched_count > 0
+
+    async def get_extras(self, path: str, namespace: str = None) -> Dict[str, Any]:
+        path = FileSystem.sanitize_path(path, False)
+        if namespace is None:
+            namespace = self.namespace
+
+        d = await self.db.find_one({"name": path, "namespace": namespace}, {"extras": 1})
+        if d is not None:
+            return d.get("extras", {})
+        else:
+            return {}
+
+    async def put(self, path: str, content: bytes, namespace: str = None):
+        path = FileSystem.sanitize_path(path, False)
+        if namespace is None:
+            namespace = self.namespace
+
+        # A single round trip creates or updates the document, returning the previous one to roll back
+        file_id = ObjectId()
+        d = await self.db.find_one_and_update(
+            {"name": path, "namespace": namespace},
+            FileSystem.upsert_fields({
+                "size": len(content),
+                "updated": datetime.utcnow(),
+                "blob": None,
+                "codec": None,
+                "stored_size": None,
+                "tier": None,
+                "cold_copy": None,
+                **FileSystem.layout_fields(self.layout)
+            }, file_id),
+            FILE_ROLLBACK_PROJECT,
+            upsert=True
+        )
+        new_file = d is None
+        if not new_file:
+            file_id = d["_id"]
+        else:
+            # Accounted as it's created, so a crash leaves a pending file to undo like one being removed
+            await self.add_directories([path], namespace)
+            await self.count_usage(namespace, 1, len(content))
+        if not new_file and d.get("moving"):
+            await self.wait_move(file_id)
+
+        try:
+            await self.run_io(self.write_file, self.fs, str(file_id), content)
+            # Existing files are already committed, unless a write or a removal was interrupted
+            if new_file or d.get("state") == FILE_PENDING:
+                await self.db.update_one({"_id": file_id}, {"$set": {"state": FILE_COMMITTED}})
+        except Exception as e:
+            if new_file:
+                # Only remove when creating the file, otherwise we could remove a valid entry (eg if database is ok and storage is not)
+                await self.db.delete_one({"_id": file_id})
+                await self.remove_directories([path], namespace)
+                await self.count_usage(namespace, -1, -len(content))
+            else:
+                # Backup data
+                await self.db.update_one({"_id": file_id}, FileSystem.set_fields({
+                    "size": d.get("size"),
+                    "updated": d["updated"],
+                    "blob": d.get("blob"),
+                    "codec": d.get("codec"),
+                    "stored_size": d.get("stored_size"),
+                    "tier": d.get("tier"),
+                    "cold_copy": d.get("cold_copy"),
+                    "sharded": d.get("sharded")
+                }))
+            raise e
+        if not new_file:
+            if d.get("blob"):
+                await self.run_io(self.blobs.release, self.fs, d["blob"])
+            await self.run_io(self.remove_cold, d)
+            await self.run_io(self.drop_flat, d)
+            await self.count_usage(namespace, 0, len(content) - d.get("size", 0))
+
+    async def list(self, path: str, namespace: str = None) -> List[str]:
+        path = FileSystem.sanitize_path(path, True)
+        if namespace is None:
+            namespace = self.namespace
+
+        files = self.db.find(FileSystem.list_query(path, namespace), {"name": 1})
+        return [file["name"].rsplit("/", 1)[-1] async for file in files]
+
+    async def list_dirs(self, path: str, namespace: str = None) -> List[str]:
+        path = FileSystem.sanitize_path(path, True)
+        if namespace is None:
+            namespace = self.namespace
+
+        if self.directories is not None:
+            return await self.run_io(lambda: list(self.directories.iter(path, namespace)))
+        return [f["_id"] async for f in self.db.aggregate(FileSystem.list_dirs_pipeline(path, namespace))]
+
+    async def rename(self, old_path: str, new_path: str, namespace: str = None) -> bool:
+        old_path = FileSystem.sanitize_path(old_path, False)
+        new_path = FileSystem.sanitize_path(new_path, False)
+        if namespace is None:
+            namespace = self.namespace
+
+        # Destination should not exists
+        destination = {"name": new_path, "namespace": namespace}
+        if new_path != old_path and await self.db.find_one(destination, {"_id": 1}) is not None:
+            return False
+        try:
+            r = await self.db.update_one({"name": old_path, "namespace": namespace}, {"$set": {"name": new_path}})
+        except DuplicateKeyError:
+            # Created meanwhile
+            return False
+        if r.matched_count > 0:
+            await self.remove_directories([old_path], namespace)
+            await self.add_directories([new_path], namespace)
+        return r.matched_count > 0
+
+    async def attrs(self, path: str, namespace: str = None) -> FileAttrs:
+        path = FileSystem.sanitize_path(path, False)
+        if namespace is None:
+            namespace = self.namespace
+
+        f = await self.db.find_one({"name": path, "namespace": namespace})
+        if f is not None:
+            return FileSystem.file_attrs(f)
+
+    async def remove(self, path: str, namespace: str = None) -> bool:
+        path = FileSystem.sanitize_path(path, False)
+        if namespace is None:
+            namespace = self.namespace
+
+        # Pending while the object is removed, as in FileSystem.remove
+        file_doc = await self.db.find_one_and_update(
+            {"name": path, "namespace": namespace}, {"$set": {"state": FILE_PENDING}}, FILE_OBJECT_PROJECT
+        )
+        if file_doc is None:
+            raise ValueError(f"Couldn't find file {path} in {namespace}.")
+
+        if not file_doc.get("blob"):
+            try:
+                await self.run_io(self.layout.remove, self.storage_of(file_doc), str(file_doc['_id']))
+            except Exception as e:
+                await self.db.update_one({"_id": file_doc["_id"]}, FileSystem.set_fields({"state": file_doc.get("state")}))
+                raise e
+        r = await self.db.delete_one({"name": path, "namespace": namespace})
+        if file_doc.get("blob") and r.deleted_count > 0:
+            await self.run_io(self.blobs.release, self.fs, file_doc["blob"])
+        if r.deleted_count > 0:
+            await self.remove_directories([path], namespace)
+            await self.count_usage(namespace, -1, -file_doc.get("size", 0))
+        if file_doc.get("cold_copy") and r.deleted_count > 0:
+            await self.run_io(self.remove_cold, file_doc)
+        return r.deleted_count > 0
+
+    async def exists(self, path: str, namespace: str = None) -> bool:
+        path = FileSystem.sanitize_path(path, False)
+        if namespace is None:
+            namespace = self.namespace
+
+        return await self.db.find_one({"name": path, "namespace": namespace}, {"_id": 1}) is not None
+
+    async def get_url(self, path: str, namespace: str = None) -> str:
+        path = FileSystem.sanitize_path(path, False)
+        if namespace is None:
+            namespace = self.namespace
+
+        file_info = await self.db.find_one({"name": path, "namespace": namespace}, FILE_OBJECT_PROJECT)
+
+        if file_info is None:
+            raise FileNotFoundError("[Errno 2] No such file or directory: '{filename}'".format(filename=path))
+
+        return await self.run_io(
+            self.layout.geturl, self.storage_of(file_info), FileSystem.object_name(file_info), file_info.get("sharded")
+        )
+
+    async def close(self):
+        await self.run_io(self.fs.close)
+        if self.cold_fs is not None:
+            await self.run_io(self.cold_fs.close)
+        self.executor.shutdown(wait=False)
@@ -1,72 +1,192 @@
 import io
+import itertools
+import logging
+import mmap
 import os
+import posixpath
 import re
+import time
 from collections import namedtuple
-from datetime import datetime
-from typing import Any, Dict, List, Union
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
-from pymongo import MongoClient
+from pymongo import ASCENDING, UpdateOne
 from pymongo.collection import Collection
+from pymongo.database import Database
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 from fs import open_fs
+from fs.base import FS
+from fs.errors import NoSysPath, ResourceNotFound
 from fs.iotools import RawWrapper
 
+from .blobs import BlobStore
+from .cache import ChangeStreamInvalidator, ContentCache, MetadataCache
+from .compression import Codec, decompress_chunks, get_codec, is_compressible, open_reader, open_writer, rechunk
+from .directories import DirectoryIndex
+from .layout import ObjectLayout
+from .metrics import RESULT, Metrics, in_current_call, measured, measured_sanitize
+from .ranges import RANGE_BLOCK_SIZE, object_ranges, ranged_file, read_range
+from .usage import NamespaceUsage, UsageCounters
+from .registry import (
+    MONGO_MAX_POOL_SIZE, acquire_mongo, acquire_storage, mongo_client, mongo_key, release_mongo, release_storage,
+    storage_key
+)
+from .workers import IOPool, run_serially
+
+
+logger = logging.getLogger(__name__)
 
 FileAttrs = namedtuple('FileAttrs', ["created", "updated", "name", "size", "namespace"])
+Page = namedtuple('Page', ["names", "next"])
+QueryPlan = namedtuple('QueryPlan', ["method", "query", "index", "stages"])
+DiskUsage = namedtuple('DiskUsage', ["files", "size", "stored_size"])
+# directory is None when not grouped by directories
+Usage = namedtuple('Usage', ["namespace", "directory", "files", "size", "stored_size"])
 
-FILE_NEEDED_FIELDS = {'_id', 'name', 'namespace', 'size'}
+FILE_NEEDED_FIELDS = {
+    '_id', 'name', 'namespace', 'size', 'updated', 'blob', 'codec', 'tier', 'cold_copy', 'accessed', 'moving', 'sharded'
+}
+# Fields to find where and how the content of a file is stored, its size for the usage counters and what the
+# tiering looks at
+FILE_OBJECT_PROJECT = {
+    '_id': True, 'blob': True, 'codec': True, 'state': True, 'size': True, 'updated': True, 'tier': True,
+    'cold_copy': True, 'accessed': True, 'moving': True, 'sharded': True
+}
 FILE_PROJECT = {f: True for f in FILE_NEEDED_FIELDS}
+FILE_ATTRS_PROJECT = {'_id': False, 'created': True, 'updated': True, 'name': True, 'size': True, 'namespace': True}
 FILE_SIZE_CHANGING_MODES = {'w', 'a', 'x'}
+# What a write changes, to put it back if storing the content fails, and if it must wait for a move between tiers
+FILE_ROLLBACK_PROJECT = {
+    '_id': True, 'size': True, 'updated': True, 'blob': True, 'codec': True, 'stored_size': True, 'state': True,
+    'tier': True, 'cold_copy': True, 'moving': True, 'sharded': True
+}
+# A new file is pending until its object is stored, and a removed one while its object is removed. Documents without
+# state are committed, they were stored before it existed
+FILE_PENDING = "pending"
+FILE_COMMITTED = "committed"
+# tier of the files whose object was moved to the cold storage. Files without tier are in the hot one. The ones moved
+# back keep their cold object for a while, for the reads that found it, with cold_copy telling since when
+TIER_COLD = "cold"
+# Files being moved between tiers have a moving token (an ObjectId, so it tells since when) while the hot object is
+# removed or written. Writers wait for it to go before writing the hot object, and take the move as dead after a while
+TIER_MOVE_POLL_SECONDS = 0.1
+TIER_MOVE_WAIT_SECONDS = 60
+# Reads of a file within this many seconds of the last one noted aren't noted again, see track_access
+ACCESS_RESOLUTION_SECONDS = 24 * 3600
+# Methods of the files opened called straight on them, not through BufferWrapper
+BUFFER_DELEGATED = (
+    "read", "read1", "readinto", "readinto1", "readline", "readlines", "write", "writelines", "seek", "tell", "truncate",
+    "flush", "readable", "writable", "seekable", "fileno", "isatty"
+)
+# Bytes moved at once by the streaming methods
+CHUNK_SIZE = 1024 * 1024
+# Default limit of bytes being read or written at the same time by the io workers
+IO_MAX_IN_FLIGHT_BYTES = 64 * 1024 * 1024
+# Documents fetched at once by the iterating methods
+LIST_BATCH_SIZE = 1000
+# Default seconds a document stays in the metadata cache
+METADATA_CACHE_TTL = 60
+# Every lookup is done by (namespace, name), and list/list_dirs use it as namespace + name prefix
+FILE_INDEX = [("namespace", ASCENDING), ("name", ASCENDING)]
+# Error code of Mongo when a unique index finds the same key twice, also when it's created
+DUPLICATE_KEY_CODE = 11000
+# Paths sanitized recently, most calls repeat them
+SANITIZE_CACHE_SIZE = 65536
+
 
+@lru_cache(maxsize=SANITIZE_CACHE_SIZE)
+def normalize_path(path: str, directory: bool) -> str:
+    """Absolute path without '.', '..' or repeated slashes, ending with a slash if it's a directory.
 
+    Paths are names in the database, not local files, so it's all string operations: nothing is resolved against
+    the local disk and relative paths are relative to the root, not to the working directory.
+    """
+    path = posixpath.normpath("/" + path.lstrip("/"))
+    if directory and not path.endswith("/"):
+        path += "/"
+    return path
+
+
+@io.IOBase.register
 class BufferWrapper(object):
+    """A file of the storage that updates the size of its document when closed.
+
+    The methods of every call (read, write...) are the ones of the wrapped file, bound when the wrapper is created,
+    so they cost the same as on the file itself. Only close and __exit__ go through the wrapper, anything else is
+    looked up in the wrapped file.
+    """
+    __slots__ = ("wrapped_object", "file_data", "db", "cache", "usage_counters") + BUFFER_DELEGATED
+
     def __init__(
         self,
         wrapped_object: Union[io.TextIOWrapper, RawWrapper],
         file_data: Dict[str, Any],
-        db: Collection
+        db: Collection,
+        cache: MetadataCache = None,
+        usage_counters: UsageCounters = None
     ):
         self.wrapped_object = wrapped_object
         self.file_data = file_data
         self.db = db
+        self.cache = cache
+        self.usage_counters = usage_counters
+        for name in BUFFER_DELEGATED:
+            # Text files have no readinto, for example
+            method = getattr(wrapped_object, name, None)
+            if method is not None:
+                setattr(self, name, method)
 
     def __getattr__(self, attr: str) -> Any:
-        orig_attr = self.wrapped_object.__getattribute__(attr)
-        if callable(orig_attr):
-            def hooked(*args, **kwargs):
-                if attr == "close":
-                    self.update_file_size_if_needed()
-                result = orig_attr(*args, **kwargs)
-                if result == self.wrapped_object:
-                    return self
-                return result
-
-            return hooked
-        else:
-            return orig_attr
+        # Only called for what is not bound, like closed, name or mode
+        return getattr(self.wrapped_object, attr)
+
+    def __iter__(self):
+        return iter(self.wrapped_object)
+
+    def close(self):
+        # Closing stores the content on some backends (the upload of S3), so the size is committed after it
+        new_size = self.written_size()
+        self.wrapped_object.close()
+        if new_size is not None:
+            self.update_file_size_if_needed(new_size)
 
-    # These following two methods can't be dynamically queried through the __getattr__ method.
-    def __enter__(self, *args, **kwargs):
+    def __enter__(self):
         """Needed to implement the context handler - with FileSystem.open() as... -."""
-        result = self.wrapped_object.__enter__(*args, **kwargs)
-        return self if result == self.wrapped_object else result
+        result = self.wrapped_object.__enter__()
+        return self if result is self.wrapped_object else result
 
     def __exit__(self, *args, **kwargs):
         """Needed to implement the context handler - with FileSystem.open() as... -."""
-        self.update_file_size_if_needed()
-        return self.wrapped_object.__exit__(*args, **kwargs)
-
-    def update_file_size_if_needed(self) -> bool:
-        if self.can_mode_change_size():
-            new_size = self.wrapped_object.tell()
-            if self.file_data.get('size') != new_size:
-                self.update_file_size(new_size)
-                return True
+        new_size = self.written_size()
+        result = self.wrapped_object.__exit__(*args, **kwargs)
+        if new_size is not None:
+            self.update_file_size_if_needed(new_size)
+        return result
+
+    def written_size(self) -> Optional[int]:
+        """Size of a file open for writing, None if it's open for reading or closed (closing twice does nothing)."""
+        if getattr(self.wrapped_object, "closed", False) or not self.can_mode_change_size():
+            return None
+        return self.wrapped_object.tell()
+
+    def update_file_size_if_needed(self, new_size: int = None) -> bool:
+        if new_size is None:
+            new_size = self.written_size()
+        if new_size is not None and self.file_data.get('size') != new_size:
+            self.update_file_size(new_size)
+            return True
         return False
 
     def can_mode_change_size(self) -> bool:
+        # Text files of some backends (mem, S3, FTP) only have the mode in the underlying binary file
         mode = getattr(self.wrapped_object, 'mode', None)
+        if mode is None:
+            mode = getattr(getattr(self.wrapped_object, 'buffer', None), 'mode', None)
         if mode is not None:
-            can_change_size = self.wrapped_object.mode[0] in FILE_SIZE_CHANGING_MODES
+            can_change_size = mode[0] in FILE_SIZE_CHANGING_MODES
         else:
             can_change_size = isinstance(self.wrapped_object, io.BufferedWriter)
         return can_change_size
@@ -74,78 +194,869 @@ class BufferWrapper(object):
     def update_file_size(self, new_size: int):
         update_result = self.db.update_one(
             {"name": self.file_data["name"], "namespace": self.file_data["namespace"]},
-            {"$set": {"size": new_size}}
+            {"$set": {"size": new_size, "state": FILE_COMMITTED}}
         )
+        if self.cache is not None:
+            self.cache.invalidate((self.file_data["namespace"], self.file_data["name"]))
         # In case source does not exist, matched_count is 0
         if update_result.matched_count == 0:
             raise Exception("Cannot update size of a non existent file")
+        if self.usage_counters is not None:
+            self.usage_counters.add(self.file_data["namespace"], 0, new_size - (self.file_data.get("size") or 0))
+        self.file_data["size"] = new_size
 
 
 class FileSystem(object):
 
-    def __init__(self, storage_uri=None, db_uri="mongodb://localhost/bazaar", namespace=""):
+    def __init__(
+        self,
+        storage_uri=None,
+        db_uri="mongodb://localhost/bazaar",
+        namespace="",
+        create_indexes=True,
+        io_workers=0,
+        max_in_flight_bytes=IO_MAX_IN_FLIGHT_BYTES,
+        storage_per_worker=False,
+        metadata_cache_size=0,
+        metadata_cache_ttl=METADATA_CACHE_TTL,
+        metadata_cache_watch=False,
+        content_cache_bytes=0,
+        content_cache_dir=None,
+        content_cache_dir_bytes=0,
+        directory_index=False,
+        shard_levels=0,
+        deduplicate=False,
+        codec=None,
+        namespace_codecs=None,
+        metrics=False,
+        metrics_hooks=None,
+        database: Database = None,
+        shared=True,
+        max_pool_size=MONGO_MAX_POOL_SIZE,
+        usage_counters=False,
+        cold_storage_uri=None,
+        promote_on_read=False,
+        track_access=False
+    ):
+        """
+        io_workers threads run in parallel the storage calls of the batch methods and prefetch the chunks of the
+        streaming ones, keeping at most max_in_flight_bytes on the move. The storage handle is shared by the workers
+        unless storage_per_worker is set, which is needed by backends that serialize calls (like FTP).
+
+        With a metadata_cache_size, up to that many file documents are kept in memory for metadata_cache_ttl
+        seconds. Changes made by this instance invalidate them; metadata_cache_watch also invalidates the changes
+        made by anyone else, following a change stream (it needs a replica set).
+
+        With content_cache_bytes, the content of recently read files is kept in memory, and with content_cache_dir
+        also in that local directory up to content_cache_dir_bytes. Useful for slow storages like S3 or FTP.
+
+        directory_index keeps a collection of directories updated, so list_dirs doesn't go through all the files
+        below the path. Run rebuild_directories() once when enabling it on an existing database.
+
+        With shard_levels, objects are stored in that many levels of directories (ab/cd/<id> for 2) instead of all
+        of them in the root of the storage. Objects stored before are still found; move them with the migration of
+        bazaar.layout.
+
+        With deduplicate, put and put_stream store every content once, named after its SHA-256, and files with the
+        same content share it. A content is removed when no file uses it. Clients can check has_digest() and call
+        put_by_digest() to skip uploading contents that are already stored. Files opened for writing get their own
+        copy of the content, as before.
+
+        codec compresses the stored contents ("zlib", "lzma" or "zstd" with the zstandard package), and namespace_codecs
+        sets it by namespace ({namespace: codec}, "none" for no compression). put and the streaming methods also take
+        it by call. Contents that don't compress (small, or already compressed like images or zip files) are stored
+        as they are. attrs().size is always the uncompressed size; the stored one is in the stored_size field.
+
+        With metrics, the calls to the public methods are timed and counted (database round trips, bytes...) in
+        self.metrics, which can be enabled and disabled any time. metrics_hooks are callables receiving every call
+        measured, like bazaar.metrics.LoggingHook. The database round trips are counted by a listener given to the
+        clients created here: to count them with a given database, create its client with
+        event_listeners=[bazaar.metrics.COMMAND_COUNTER], otherwise db_queries stays at 0.
+
+        An already connected database can be given instead of db_uri, eg a mongomock one.
+
+        With shared, every FileSystem of the process with the same db_uri (and max_pool_size, the connections of the
+        client at most) uses the same Mongo client, and the ones with the same storage_uri the same storage handle
+        when the backend allows it (local disk and S3). close() only closes them when the last one using them is
+        closed. The client connects at the first query, so with create_indexes off nothing is connected until used.
+
+        usage_counters keeps the files and bytes of every namespace counted in a collection as they change, so
+        usage() is a single lookup. Run rebuild_usage() once when enabling it on an existing database. stats() gives
+        the same (and by directory) without the counters, going through the files.
+
+        cold_storage_uri is a second, cheaper storage (the cold tier) where bazaar.tiering.TierMover moves the objects
+        of the files not written (nor read, with track_access) for a while. Every document tells the tier of its
+        object, so reads find it with the same lookup. Writes always go to the hot storage, taking the file out of
+        the cold one. With promote_on_read, a file read from the cold tier is moved back to the hot one in the
+        background (its cold object is removed by the next run of the mover after an hour). track_access notes in the
+        documents when files are read, once a day at most.
+        """
         if storage_uri is None:
             storage_uri = "bazaar"
             if not os.path.exists(storage_uri):
                 os.mkdir(storage_uri)
 
-        if db_uri is None:
-            self.mongo = MongoClient()
+        self.storage_uri = storage_uri
+        self.db_uri = db_uri
+        self.shared = shared
+        self.max_pool_size = max_pool_size
+        # Clients given with the database belong to the caller
+        self.owns_mongo = database is None
+        self.closed = False
+        # Shared resources are released with the keys they were acquired with, they change in a forked process
+        self.mongo_key = mongo_key(db_uri, max_pool_size)
+        if database is None:
+            self.mongo = acquire_mongo(self.mongo_key) if shared else mongo_client(db_uri, max_pool_size)
+            database = self.mongo.get_default_database()
         else:
-            self.mongo = MongoClient(host=db_uri)
+            self.mongo = database.client
+        self.metrics = Metrics(metrics, metrics_hooks)
 
-        self.fs = open_fs(storage_uri)
-        self.db = self.mongo.get_default_database().file
+        self.storage_key = storage_key(storage_uri)
+        self.fs = acquire_storage(self.storage_key) if shared else open_fs(storage_uri)
+        self.cold_storage_uri = cold_storage_uri
+        self.cold_storage_key = None
+        self.cold_fs = None
+        if cold_storage_uri is not None:
+            self.cold_storage_key = storage_key(cold_storage_uri)
+            self.cold_fs = acquire_storage(self.cold_storage_key) if shared else open_fs(cold_storage_uri)
+        self.track_access = track_access
+        self.promoter = None
+        if promote_on_read:
+            # One at a time, reads don't wait for it
+            self.promoter = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bazaar-promote")
+            self.promoting = set()
+        self.layout = ObjectLayout(shard_levels)
+        self.db = database.file
         self.namespace = namespace
+        self.deduplicate = deduplicate
+        self.codec = codec
+        self.namespace_codecs = namespace_codecs or {}
+        # Unknown codecs fail now and not when writing
+        for name in [codec, *self.namespace_codecs.values()]:
+            get_codec(name)
+        # Files stored deduplicated are always readable, even with deduplicate off
+        self.blobs = BlobStore(database.blob, self.layout)
+        self.directories = None
+        if directory_index:
+            self.directories = DirectoryIndex(database.directory)
+        self.usage_counters = None
+        if usage_counters:
+            self.usage_counters = UsageCounters(database.usage)
+        self.io_pool = None
+        if io_workers:
+            fs_factory = (lambda: open_fs(storage_uri)) if storage_per_worker else None
+            self.io_pool = IOPool(io_workers, max_in_flight_bytes, self.fs, fs_factory)
+        self.metadata_cache = None
+        self.cache_invalidator = None
+        if metadata_cache_size:
+            self.metadata_cache = MetadataCache(metadata_cache_size, metadata_cache_ttl)
+            self.metrics.add_gauges("metadata_cache", self.metadata_cache.stats)
+            if metadata_cache_watch:
+                self.cache_invalidator = ChangeStreamInvalidator(self.db, self.metadata_cache)
+        self.content_cache = None
+        if content_cache_bytes or content_cache_dir is not None:
+            self.content_cache = ContentCache(content_cache_bytes, content_cache_dir, content_cache_dir_bytes)
+            self.metrics.add_gauges("content_cache", self.content_cache.stats)
+        if create_indexes:
+            self.ensure_indexes()
+
+    def find_file(self, path: str, namespace: str, projection: Dict[str, Any] = None) -> Optional[Dict[str, Any]]:
+        """Document of a (sanitized) path, from the metadata cache when there is one.
+
+        Only for reads: writes must look at the database, a cached document may be outdated.
+        """
+        if self.metadata_cache is None:
+            return self.db.find_one({"name": path, "namespace": namespace}, projection)
+
+        key = (namespace, path)
+        d = self.metadata_cache.get(key)
+        if d is None:
+            # The whole document, so it's useful for any method
+            d = self.db.find_one({"name": path, "namespace": namespace})
+            if d is not None:
+                self.metadata_cache.set(key, d)
+        return d
+
+    def clear_metadata_cache(self):
+        if self.metadata_cache is not None:
+            self.metadata_cache.clear()
+
+    def invalidate(self, path: str, namespace: str, file_id: Any = None):
+        """Drop the cached document of a path and, if the stored object is given, its cached content."""
+        if self.metadata_cache is not None:
+            self.metadata_cache.invalidate((namespace, path))
+        if self.content_cache is not None and file_id is not None:
+            self.content_cache.invalidate(str(file_id))
+
+    @staticmethod
+    def object_name(d: Dict[str, Any]) -> str:
+        """Name of the stored object with the content of document d: its blob, or its own object named after its id."""
+        return d.get("blob") or str(d["_id"])
+
+    def storage_of(self, d: Dict[str, Any], fs: FS = None) -> FS:
+        """Storage with the object of document d: the cold one if it was moved there, else fs or the hot one."""
+        if d.get("tier") != TIER_COLD:
+            return fs or self.fs
+        if self.cold_fs is None:
+            raise ValueError(f"The object of {d.get('name', d['_id'])} is in the cold tier, but there is no cold_storage_uri")
+        return self.cold_fs
+
+    def read_storage(self, d: Dict[str, Any], fs: FS = None) -> FS:
+        """storage_of to read the object of d, noting the access and promoting it if asked to."""
+        if self.track_access:
+            now = datetime.utcnow()
+            if d.get("accessed") is None or d["accessed"] < now - timedelta(seconds=ACCESS_RESOLUTION_SECONDS):
+                self.db.update_one({"_id": d["_id"]}, {"$set": {"accessed": now}})
+                d["accessed"] = now
+        if self.promoter is not None and d.get("tier") == TIER_COLD and d["_id"] not in self.promoting:
+            self.promoting.add(d["_id"])
+            self.promoter.submit(self.promote_in_background, dict(d))
+        return self.storage_of(d, fs)
+
+    def promote_in_background(self, d: Dict[str, Any]):
+        try:
+            self.promote(d)
+        except Exception:
+            logger.exception("Couldn't move %s to the hot tier", d["_id"])
+        finally:
+            self.promoting.discard(d["_id"])
+
+    def demote(self, d: Dict[str, Any], fs: FS = None) -> bool:
+        """Move the object of document d (with _id and updated) to the cold tier. False if the file was written or
+        removed meanwhile, then it stays hot.
+
+        The object is copied, the document points to the copy if the file didn't change, and only then the hot object
+        is removed, with the file marked as moving so writers wait instead of writing an object that is removed. A read
+        that found the document just before can still fail to find the hot object.
+        """
+        fs = fs or self.fs
+        file_id = str(d["_id"])
+        self.layout.transfer(fs, self.cold_fs, file_id)
+        token = ObjectId()
+        moved = self.db.find_one_and_update(
+            {
+                "_id": d["_id"], "updated": d["updated"], "tier": {"$ne": TIER_COLD}, "blob": None, "cold_copy": None,
+                # Being removed, its cold copy would be left without document
+                "state": {"$ne": FILE_PENDING}
+            },
+            {"$set": {"tier": TIER_COLD, "moving": token}},
+            {"name": True, "namespace": True}
+        )
+        if moved is None:
+            self.layout.remove(self.cold_fs, file_id)
+            return False
+        self.invalidate(moved["name"], moved["namespace"])
+        try:
+            self.layout.remove(fs, file_id)
+        except ResourceNotFound:
+            pass
+        finally:
+            self.db.update_one({"_id": d["_id"], "moving": token}, {"$unset": {"moving": ""}})
+        return True
+
+    def promote(self, d: Dict[str, Any], fs: FS = None) -> bool:
+        """Move the object of document d (with _id and updated) back from the cold tier. False if the file was written
+        or removed meanwhile.
+
+        The file is marked as moving while the hot object is written, so writers wait for it instead of having their
+        content overwritten. The cold object is kept, the reads that found the document before may be reading it.
+        TierMover removes it later, and writing or removing the file before.
+        """
+        fs = fs or self.fs
+        file_id = str(d["_id"])
+        token = ObjectId()
+        dead = ObjectId.from_datetime(datetime.utcnow() - timedelta(seconds=TIER_MOVE_WAIT_SECONDS))
+        marked = self.db.update_one(
+            {"_id": d["_id"], "updated": d["updated"], "tier": TIER_COLD, "$or": [
+                {"moving": None}, {"moving": {"$lt": dead}}
+            ]},
+            {"$set": {"moving": token}}
+        )
+        if marked.modified_count == 0:
+            return False
+        try:
+            self.layout.transfer(self.cold_fs, fs, file_id)
+            now = datetime.utcnow()
+            moved = self.db.find_one_and_update(
+                {"_id": d["_id"], "tier": TIER_COLD, "moving": token},
+                # Read now, so it isn't moved to the cold tier again right away
+                {"$unset": {"tier": "", "moving": ""}, "$set": {"cold_copy": now, "accessed": now}},
+                {"name": True, "namespace": True}
+            )
+            if moved is None and self.db.find_one({"_id": d["_id"], "blob": None}, {"_id": 1}) is None:
+                # Removed or deduplicated meanwhile, nobody uses the hot object. Written, the writer overwrites it next
+                self.layout.remove(fs, file_id)
+        finally:
+            self.db.update_one({"_id": d["_id"], "moving": token}, {"$unset": {"moving": ""}})
+        if moved is None:
+            return False
+        self.invalidate(moved["name"], moved["namespace"])
+        return True
+
+    def wait_moves(self, file_ids: List[ObjectId]):
+        """Wait for the moves between tiers of the files of file_ids to end, before writing their hot objects. Moves
+        older than TIER_MOVE_WAIT_SECONDS are dead (the mover crashed), they are forgotten.
+        """
+        query = {"_id": {"$in": file_ids}, "moving": {"$ne": None}}
+        deadline = time.monotonic() + TIER_MOVE_WAIT_SECONDS
+        while self.db.find_one(query, {"_id": 1}) is not None:
+            if time.monotonic() > deadline:
+                self.db.update_many(query, {"$unset": {"moving": ""}})
+                return
+            time.sleep(TIER_MOVE_POLL_SECONDS)
+
+    def warm_object(self, d: Dict[str, Any], keep_content: bool):
+        """Bring the object of a cold file to the hot tier, to open it for writing, dropping what's in the cold one."""
+        fields = {"tier": None, "cold_copy": None}
+        if keep_content and d.get("tier") == TIER_COLD:
+            self.layout.transfer(self.cold_fs, self.fs, str(d["_id"]))
+            fields.update(self.layout_fields(self.layout))
+        self.db.update_one({"_id": d["_id"]}, self.set_fields(fields))
+        self.drop_cold([d])
+        d.update(fields)
+
+    def drop_cold(self, docs: Iterable[Dict[str, Any]]):
+        """Remove the cold objects of the files of docs, or the copies kept after promoting them, once they are
+        written to the hot tier or removed.
+        """
+        for d in docs:
+            if (d.get("tier") == TIER_COLD or d.get("cold_copy")) and self.cold_fs is not None:
+                try:
+                    self.layout.remove(self.cold_fs, str(d["_id"]))
+                except ResourceNotFound:
+                    pass
+
+    def drop_flat(self, docs: Iterable[Dict[str, Any]]):
+        """Remove the legacy flat objects of the files of docs (as they were before writing them), now that they are
+        written to their sharded paths.
+        """
+        for d in docs:
+            if not d.get("sharded") and not d.get("blob"):
+                self.layout.remove_flat(self.fs, str(d["_id"]))
+
+    def release_object(self, d: Dict[str, Any], fs: FS = None):
+        """Drop the stored content of a file that is removed or overwritten by a blob."""
+        if d.get("blob"):
+            self.blobs.release(fs or self.fs, d["blob"])
+            return
+        try:
+            self.layout.remove(self.storage_of(d, fs), str(d["_id"]))
+        except ResourceNotFound:
+            pass
+        if d.get("cold_copy"):
+            self.drop_cold([d])
+
+    def own_object(self, d: Dict[str, Any], keep_content: bool):
+        """Make the file of d use a plain object of its own, to open it for writing: shared or compressed can't be."""
+        codec = get_codec(d.get("codec"))
+        blob = d.get("blob")
+        fields = {}
+        if keep_content and codec is not None:
+            self.layout.rewrite(self.fs, self.object_name(d), str(d["_id"]), lambda chunks: decompress_chunks(chunks, codec))
+            fields.update(codec=None, stored_size=None, **self.layout_fields(self.layout))
+        elif keep_content and blob:
+            self.layout.copy(self.fs, blob, str(d["_id"]))
+            fields.update(self.layout_fields(self.layout))
+        if blob:
+            fields["blob"] = None
+        if fields:
+            self.db.update_one({"_id": d["_id"]}, self.set_fields(fields))
+            d.update(fields)
+        if blob:
+            self.blobs.release(self.fs, blob)
+
+    def detach_blobs(self, docs: Iterable[Dict[str, Any]]):
+        """Point the files of docs that were deduplicated to their own objects again, once they are written."""
+        docs = [d for d in docs if d.get("blob")]
+        if docs:
+            self.db.update_many({"_id": {"$in": [d["_id"] for d in docs]}}, {"$unset": {"blob": ""}})
+            for d in docs:
+                self.blobs.release(self.fs, d["blob"])
+
+    def choose_codec(self, namespace: str, codec: str = None, sample: bytes = None) -> Optional[Codec]:
+        """Codec to store a content: the one given, else the one of the namespace, else the default one.
+
+        With a sample of the beginning of the content, None if it's not worth compressing it.
+        """
+        if codec is None:
+            codec = self.namespace_codecs.get(namespace, self.codec)
+        if codec is None or (sample is not None and not is_compressible(sample)):
+            return None
+        return get_codec(codec)
+
+    @staticmethod
+    def codec_fields(codec: Optional[Codec], stored_size: int) -> Dict[str, Any]:
+        """How a content is stored, for set_fields."""
+        return {"codec": codec and codec.name, "stored_size": stored_size}
+
+    @staticmethod
+    def layout_fields(layout: ObjectLayout) -> Dict[str, Any]:
+        """Where an object written now is, for set_fields. Sharded ones are found without looking for a flat one."""
+        return {"sharded": True if layout.shard_levels else None}
+
+    @staticmethod
+    def set_fields(fields: Dict[str, Any]) -> Dict[str, Any]:
+        """Update setting the fields, removing the ones that are None."""
+        update = {}
+        if any(value is not None for value in fields.values()):
+            update["$set"] = {field: value for field, value in fields.items() if value is not None}
+        if any(value is None for value in fields.values()):
+            update["$unset"] = {field: "" for field, value in fields.items() if value is None}
+        return update
+
+    @classmethod
+    def upsert_fields(cls, fields: Dict[str, Any], file_id: ObjectId) -> Dict[str, Any]:
+        """Update setting the fields, or creating a pending file with them and file_id if there is none. The id is
+        chosen here so the object can be named without reading the document back.
+        """
+        update = cls.set_fields(fields)
+        update["$setOnInsert"] = {"_id": file_id, "created": datetime.utcnow(), "state": FILE_PENDING}
+        return update
+
+    def read_content(self, d: Dict[str, Any], fs: FS = None) -> bytes:
+        """Content of the file of document d, through the content cache if there is one."""
+        filename = self.object_name(d)
+        if self.content_cache is not None:
+            content = self.content_cache.get(filename, d["updated"], d.get("size"))
+            if content is not None:
+                return content
+
+        with self.layout.open(self.read_storage(d, fs), filename, "rb") as f:
+            content = f.read()
+        codec = get_codec(d.get("codec"))
+        if codec is not None:
+            content = codec.decompress(content)
+        # A different size means it's being written right now
+        if self.content_cache is not None and len(content) == d.get("size"):
+            self.content_cache.set(filename, d["updated"], d["size"], content)
+        return content
+
+    def map_io(self, function, items: List[Any], sizes: List[int]) -> List[Any]:
+        """Call function(fs, item) for every item, in the io workers if any. Exceptions are returned, not raised."""
+        if self.io_pool is None:
+            return run_serially(function, self.fs, items)
+        return self.io_pool.map(in_current_call(function), items, sizes)
+
+    def prefetch(self, chunks: Iterator[bytes], chunk_size: int) -> Iterator[bytes]:
+        if self.io_pool is None:
+            return chunks
+        return self.io_pool.prefetch(chunks, chunk_size)
+
+    def ensure_indexes(self):
+        """Create the unique (namespace, name) index. Users with a read-only connection should skip it.
+
+        Databases written before it may have the same path twice, then it's not created and the error is logged.
+        """
+        try:
+            self.db.create_index(FILE_INDEX, unique=True)
+        except OperationFailure as e:
+            if e.code != DUPLICATE_KEY_CODE:
+                raise e
+            logger.error(
+                "Couldn't create the unique (namespace, name) index of %s, some paths have more than one file: %s. "
+                "Remove the duplicates, or pass create_indexes=False", self.db.full_name, e
+            )
+        if self.directories is not None:
+            self.directories.ensure_indexes()
+
+    @staticmethod
+    def extras_field(field: str) -> str:
+        if not field or field.startswith("$"):
+            raise ValueError(f"Invalid extras field {field!r}")
+        return f"extras.{field}"
+
+    def ensure_extras_index(self, field: str) -> str:
+        """Create an index on (namespace, extras.<field>) for find() by that field (dotted for nested ones). Returns
+        its name. Files without the field are indexed too, as null.
+        """
+        return self.db.create_index([("namespace", ASCENDING), (self.extras_field(field), ASCENDING)])
+
+    def rebuild_directories(self, namespace: str = None):
+        """Build the directory index from the files, of every namespace or of the given one."""
+        self.directories.rebuild(self.db, namespace)
+
+    def add_directories(self, names: Iterable[str], namespace: str):
+        if self.directories is not None:
+            self.directories.add(names, namespace)
+
+    def remove_directories(self, names: Iterable[str], namespace: str):
+        if self.directories is not None:
+            self.directories.remove(names, namespace)
+
+    def count_usage(self, namespace: str, files: int, size: int):
+        if self.usage_counters is not None:
+            self.usage_counters.add(namespace, files, size)
+
+    def rebuild_usage(self, namespace: str = None):
+        """Count the files and bytes of every namespace, or of the given one, again for the usage counters."""
+        self.usage_counters.rebuild(self.db, namespace)
+
+    @measured("usage")
+    def usage(self, namespace: str = None) -> NamespaceUsage:
+        """Files and bytes of a namespace from the usage counters, without going through the files."""
+        if self.usage_counters is None:
+            raise ValueError("Usage counters are off, use stats() or FileSystem(usage_counters=True)")
+        return self.usage_counters.get(self.namespace if namespace is None else namespace)
+
+    @measured("stats")
+    def stats(self, namespace: str = None, group_by_depth: int = 0) -> List[Usage]:
+        """Files, bytes and stored bytes by namespace (only the given one, or all) with a single aggregation.
+
+        With group_by_depth, also by directory up to that depth: 1 for /dir/, 2 for /dir/subdir/... Files in
+        shallower directories count in their own (the root is /). The server goes through every file, for frequent
+        reads of whole namespaces use the usage counters.
+        """
+        parts = {"$split": ["$name", "/"]}
+        group = {"namespace": "$namespace"}
+        if group_by_depth:
+            # Names are split as ["", "dir", "subdir", "file"], the directory is the parts before the file name up
+            # to the depth. Every branch slices a fixed count, mongomock doesn't take expressions there
+            group["directory"] = {"$switch": {
+                "branches": [
+                    {"case": {"$eq": [{"$size": parts}, depth + 1]}, "then": {"$slice": [parts, depth]}}
+                    for depth in range(1, group_by_depth + 1)
+                ],
+                "default": {"$slice": [parts, group_by_depth + 1]}
+            }}
+        result = self.db.aggregate([
+            {"$match": {} if namespace is None else {"namespace": namespace}},
+            {"$group": {
+                "_id": group,
+                "files": {"$sum": 1},
+                "size": {"$sum": "$size"},
+                "stored_size": {"$sum": {"$ifNull": ["$stored_size", "$size"]}}
+            }},
+            {"$sort": {"_id": ASCENDING}}
+        ])
+        return [Usage(
+            namespace=r["_id"]["namespace"],
+            directory="/".join(r["_id"]["directory"]) + "/" if group_by_depth else None,
+            files=r["files"],
+            size=r["size"],
+            stored_size=r["stored_size"]
+        ) for r in result]
 
+    @staticmethod
+    def prefix_query(path: str, namespace: str, regex: str) -> Dict[str, Any]:
+        """Query for names under the directory 'path' that also match 'regex'.
+
+        The $gte/$lt range makes the index bounds explicit instead of relying on the regex prefix extraction
+        of the server: as a directory path always ends with '/', every name below it is lower than the same
+        path ending with '0' (the next character).
+        """
+        return {
+            "namespace": namespace,
+            "name": {"$gte": path, "$lt": path[:-1] + "0", "$regex": regex}
+        }
+
+    @staticmethod
+    def list_query(path: str, namespace: str) -> Dict[str, Any]:
+        # We search for paths that starts with the provided path (directory), the something without a slash (filename)
+        # and the end, because if we have another slash this is a directory
+        return FileSystem.prefix_query(path, namespace, f'^{re.escape(path)}[^/]+$')
+
+    @staticmethod
+    def list_dirs_query(path: str, namespace: str) -> Dict[str, Any]:
+        # Get things that are: path/{dir}/{something} just to be sure that {dir} is a directory and not a file
+        return FileSystem.prefix_query(path, namespace, f'^{re.escape(path)}([^/]+/)')
+
+    @staticmethod
+    def list_dirs_pipeline(path: str, namespace: str) -> List[Dict[str, Any]]:
+        return [
+            # 1. Get things that are: path/{dir}/{something} just to be sure that {dir} is a directory and not a file
+            {"$match": FileSystem.list_dirs_query(path, namespace)},
+            # 2. Remove the provided path from the path. path/dir1/file -> dir1/file
+            {"$project": {'name': {"$substr": ["$name", len(path), {"$strLenCP": "$name"}]}}},
+            # 3. Split a get the first element. dir1/file -> dir. It also works for dir1/subdir/file -> dir1
+            {"$project": {'name': {"$arrayElemAt": [{"$split": ["$name", "/"]}, 0]}}},
+            # 4. Group to avoid duplicates (a subdirectory with several files will cause these duplicates)
+            {"$group": {"_id": "$name"}}
+        ]
+
+    @staticmethod
+    def file_attrs(f: Dict[str, Any]) -> FileAttrs:
+        return FileAttrs(
+            created=f["created"],
+            updated=f["updated"],
+            name=f["name"].rsplit("/")[-1],
+            size=f["size"],
+            namespace=f["namespace"]
+        )
+
+    def explain(self, namespace: str = None, extras: Dict[str, Any] = None) -> Dict[str, QueryPlan]:
+        """Report, for every public method, the index used by its query (None means a collection scan). With extras,
+        also for find() by them.
+        """
+        if namespace is None:
+            namespace = self.namespace
+
+        file_query = (self.db, {"name": "/", "namespace": namespace})
+        queries = {method: file_query for method in (
+            "get", "open", "put", "exists", "attrs", "remove", "rename", "get_url", "get_extras", "set_extras",
+            "change_namespace"
+        )}
+        queries["list"] = (self.db, self.list_query("/", namespace))
+        if self.directories is not None:
+            queries["list_dirs"] = (self.directories.db, {"namespace": namespace, "parent": "/"})
+        else:
+            # The $match is the first stage of the pipeline so it uses the same plan than a find
+            queries["list_dirs"] = (self.db, self.list_dirs_query("/", namespace))
+        if extras is not None:
+            queries["find"] = (self.db, self.extras_query(extras, None, namespace))
+
+        plans = {}
+        for method, (collection, query) in queries.items():
+            stages = []
+            index = None
+            plan = collection.find(query).explain()["queryPlanner"]["winningPlan"]
+            plan = plan.get("queryPlan", plan)  # Slot based engine nests the classic plan
+            pending = [plan]
+            while pending:
+                stage = pending.pop()
+                stages.append(stage["stage"])
+                if stage["stage"] == "IXSCAN":
+                    index = stage["indexName"]
+                pending.extend(stage.get("inputStages", []))
+                if "inputStage" in stage:
+                    pending.append(stage["inputStage"])
+            plans[method] = QueryPlan(method=method, query=query, index=index, stages=stages)
+        return plans
+
+    @measured("get", bytes_out=RESULT)
     def get(self, path: str, namespace: str = None) -> bytes:
         path = self.sanitize_path(path, False)
         if namespace is None:
             namespace = self.namespace
 
-        d = self.db.find_one({"name": path, "namespace": namespace})
+        d = self.find_file(path, namespace)
         if d is not None:
-            with self.fs.open(str(d["_id"]), "rb") as f:
-                return f.read()
+            return self.read_content(d)
+
+    def syspath(self, d: Dict[str, Any]) -> Optional[str]:
+        """Path in the local disk of the stored object of document d, None if the storage isn't local."""
+        name = self.object_name(d)
+        fs = self.read_storage(d)
+        try:
+            path = fs.getsyspath(self.layout.path(name))
+        except NoSysPath:
+            return None
+        if not os.path.exists(path) and self.layout.path(name) != name:
+            # Stored before sharding
+            path = fs.getsyspath(name)
+        return path
+
+    def map_content(self, d: Dict[str, Any]) -> Optional[mmap.mmap]:
+        """Read-only map of the content of document d, from the local storage or the disk tier of the content cache.
+
+        None when there is no local file with the content (other storages, compressed files) or it's empty.
+        """
+        path = None
+        if self.content_cache is not None:
+            path = self.content_cache.get_path(self.object_name(d), d["updated"], d.get("size"))
+        if path is None and not d.get("codec"):
+            path = self.syspath(d)
+        if path is None or os.path.getsize(path) == 0:
+            return None
+        with open(path, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
+    @measured("get_buffer", bytes_out=RESULT)
+    def get_buffer(self, path: str, namespace: str = None) -> Optional[memoryview]:
+        """Like get, but without copying the content when the storage is a local disk: a view of a map of the file.
+
+        Other storages read the content, as get does. See open_mmap about files changed while mapped.
+        """
+        path = self.sanitize_path(path, False)
+        if namespace is None:
+            namespace = self.namespace
+
+        d = self.find_file(path, namespace, FILE_PROJECT)
+        if d is None:
+            return None
+        mapped = self.map_content(d)
+        if mapped is None:
+            return memoryview(self.read_content(d))
+        return memoryview(mapped)
+
+    @measured("open_mmap")
+    def open_mmap(self, path: str, namespace: str = None) -> mmap.mmap:
+        """Read-only mmap of the file, shared with every process mapping it when the storage is a local disk.
+
+        Other storages read the content into an anonymous map. Like with mmap, empty files can't be mapped
+        (ValueError). Overwriting a file rewrites its object, so reading a map of it meanwhile can crash the process
+        if it shrinks; with deduplicate=True objects are never rewritten and that can't happen.
+        """
+        path = self.sanitize_path(path, False)
+        if namespace is None:
+            namespace = self.namespace
+
+        d = self.find_file(path, namespace, FILE_PROJECT)
+        if d is None:
+            raise FileNotFoundError("[Errno 2] No such file or directory: '{filename}'".format(filename=path))
+        mapped = self.map_content(d)
+        if mapped is None:
+            content = self.read_content(d)
+            if not content:
+                raise ValueError(f"{path} is empty, it can't be mapped")
+            mapped = mmap.mmap(-1, len(content))
+            mapped.write(content)
+            mapped.seek(0)
+        return mapped
+
+    def content_size(self, d: Dict[str, Any]) -> int:
+        """Size of the content of document d. Only documents without size need to ask the storage."""
+        if d.get("size") is not None:
+            return d["size"]
+        fs = self.storage_of(d)
+        try:
+            return fs.getsize(self.layout.path(self.object_name(d)))
+        except ResourceNotFound:
+            # Stored before sharding
+            return fs.getsize(self.object_name(d))
+
+    @staticmethod
+    def range_bounds(offset: int, length: Optional[int], size: int) -> Tuple[int, int]:
+        """Start and end of a range in a content of size, see get_range."""
+        if offset < 0:
+            offset = max(size + offset, 0)
+        end = size if length is None else min(offset + length, size)
+        return offset, max(end, offset)
+
+    @measured("get_range", bytes_out=RESULT)
+    def get_range(self, path: str, offset: int, length: int = None, namespace: str = None) -> Optional[bytes]:
+        """length bytes of the file from offset (all of them to the end without length), only reading those.
+
+        A negative offset counts from the end, like the suffix ranges of HTTP: bytes=-500 is offset=-500.
+        """
+        path = self.sanitize_path(path, False)
+        if namespace is None:
+            namespace = self.namespace
+
+        d = self.find_file(path, namespace, FILE_PROJECT)
+        if d is None:
+            return None
+        offset, end = self.range_bounds(offset, length, self.content_size(d))
+        if self.content_cache is not None:
+            content = self.content_cache.get(self.object_name(d), d["updated"], d.get("size"))
+            if content is not None:
+                return content[offset:end]
+        return read_range(
+            self.read_storage(d), self.layout, self.object_name(d), offset, end - offset, get_codec(d.get("codec"))
+        )
+
+    @measured("open_ranged")
+    def open_ranged(self, path: str, mode: str = "rb", namespace: str = None, block_size: int = RANGE_BLOCK_SIZE) -> BufferWrapper:
+        """Seekable read-only file ("r" or "rb") that fetches from the storage only the blocks being read.
+
+        With S3 they are ranged GETs, where open would download the whole object. Compressed files are
+        decompressed from the beginning, so seeking back is slow for them.
+        """
+        if any(m in mode for m in "wax+"):
+            raise ValueError(f"Ranged files are read-only, invalid mode {mode}")
+        path = self.sanitize_path(path, False)
+        if namespace is None:
+            namespace = self.namespace
+
+        d = self.find_file(path, namespace, FILE_PROJECT)
+        if d is None:
+            raise FileNotFoundError("[Errno 2] No such file or directory: '{filename}'".format(filename=path))
+        ranges = object_ranges(self.read_storage(d), self.layout, self.object_name(d), get_codec(d.get("codec")))
+        return BufferWrapper(ranged_file(ranges, self.content_size(d), mode, block_size), d, self.db)
+
+    @measured("open")
     def open(self, path: str, mode: str, namespace: str = None) -> BufferWrapper:
         path = self.sanitize_path(path, False)
         if namespace is None:
             namespace = self.namespace
 
-        d = self.db.find_one({"name": path, "namespace": namespace}, FILE_PROJECT)
-        # Database information
-        if d is not None:
-            filename = str(d["_id"])
-            new_file = False
+        read_only = not any(m in mode for m in "wax+")
+        # A content being replaced is compressed, unless it's also read
+        codec = self.choose_codec(namespace) if "w" in mode and "+" not in mode else None
+        new_file = False
+        if read_only:
+            d = self.find_file(path, namespace, FILE_PROJECT)
         else:
+            # The content is going to change
+            fields = {"updated": datetime.utcnow()}
+            query = {"name": path, "namespace": namespace}
             if "w" in mode:
-                d = {
-                    "name": path,
-                    "namespace": namespace,
-                    "created": datetime.utcnow(),
-                    "updated": datetime.utcnow()
-                }
-                insert_info = self.db.insert_one(d)
-                filename = str(insert_info.inserted_id)
-                new_file = True
-                d['_id'] = insert_info.inserted_id
+                fields.update(self.codec_fields(codec, None), **self.layout_fields(self.layout))
+                # Created if missing in the same round trip, committed when closed
+                file_id = ObjectId()
+                d = self.db.find_one_and_update(query, self.upsert_fields(fields, file_id), FILE_PROJECT, upsert=True)
+                if d is None:
+                    new_file = True
+                    d = {"_id": file_id, "name": path, "namespace": namespace, "updated": fields["updated"]}
+                    if codec is not None:
+                        d["codec"] = codec.name
+                    if self.layout.shard_levels:
+                        d["sharded"] = True
+                    # Accounted as it's created, so a crash leaves a pending file to undo like one being removed
+                    self.add_directories([path], namespace)
+                    self.count_usage(namespace, 1, 0)
             else:
-                raise FileNotFoundError("[Errno 2] No such file or directory: '{filename}'".format(filename=path))
+                d = self.db.find_one_and_update(query, self.set_fields(fields), FILE_PROJECT)
+            self.invalidate(path, namespace, d and d["_id"])
+        if d is None:
+            raise FileNotFoundError("[Errno 2] No such file or directory: '{filename}'".format(filename=path))
+
+        # Database information
+        filename = self.object_name(d) if read_only else str(d["_id"])
+        if read_only:
+            codec = get_codec(d.get("codec"))
+        elif not new_file:
+            previous = dict(d)
+            if d.get("moving"):
+                self.wait_moves([d["_id"]])
+            if d.get("tier") == TIER_COLD or d.get("cold_copy"):
+                self.warm_object(d, keep_content="w" not in mode)
+            if d.get("blob") or d.get("codec"):
+                self.own_object(d, keep_content="w" not in mode)
+        if mode == "rb" and self.content_cache is not None:
+            cached = self.open_cached(d)
+            if cached is not None:
+                return cached
 
-        # File bytes storing
+        # Compressed objects are read or written whole, in binary
+        object_mode = mode if codec is None else "rb" if read_only else "wb"
+        # File bytes storing. Opening is enough to know the storage takes it (it creates the object when writing)
         try:
-            file = self.fs.open(filename, mode)
-            file.close()  # Force the file creation to force error and avoid keeping the entity in the database but not the file
-            file = self.fs.open(filename, mode)
-            return BufferWrapper(file, d, self.db)
+            file = self.layout.open(self.read_storage(d) if read_only else self.fs, filename, object_mode, d.get("sharded"))
         except Exception as e:
             if new_file:
                 # Only remove when creating the file, otherwise we could remove a valid entry (eg if database is ok and storage is not)
-                self.db.delete_one({"name": path, "namespace": namespace})
-                d.delete()
+                self.db.delete_one({"_id": d["_id"]})
+                self.remove_directories([path], namespace)
+                self.count_usage(namespace, -1, 0)
             raise e
+        if not read_only and not new_file and ("w" in mode or d.get("sharded")):
+            # Written to its sharded path from now on
+            self.drop_flat([previous])
+        if codec is not None and read_only:
+            file = open_reader(file, codec, mode)
+        elif codec is not None:
+            # Like put, the beginning of the content decides if it's compressed
+            file = open_writer(
+                file, codec, mode, lambda stored_size, codec: self.set_codec_fields(d, codec, stored_size), sample=True
+            )
+        if read_only:
+            return BufferWrapper(file, d, self.db)
+        return BufferWrapper(file, d, self.db, self.metadata_cache, self.usage_counters)
+
+    def set_codec_fields(self, d: Dict[str, Any], codec: Optional[Codec], stored_size: int):
+        self.db.update_one({"_id": d["_id"]}, self.set_fields(self.codec_fields(codec, stored_size)))
+        self.invalidate(d["name"], d["namespace"])
 
+    def open_cached(self, d: Dict[str, Any]) -> Optional[BufferWrapper]:
+        """Reader of a file from the content cache: its file in the disk tier or the content if small enough."""
+        path = self.content_cache.get_path(self.object_name(d), d["updated"], d.get("size"))
+        if path is not None:
+            return BufferWrapper(io.open(path, "rb"), d, self.db)
+        if d.get("size", self.content_cache.max_item_bytes + 1) <= self.content_cache.max_item_bytes:
+            return BufferWrapper(io.BytesIO(self.read_content(d)), d, self.db)
+
+    @measured("change_namespace")
     def change_namespace(self, path: str, from_namespace: str, to_namespace: str) -> bool:
         path = self.sanitize_path(path, False)
         # Destination should not exists
@@ -153,10 +1064,22 @@ class FileSystem(object):
             return False
 
         # Perform the update
-        r = self.db.update_one({"name": path, "namespace": from_namespace}, {"$set": {"namespace": to_namespace, "updated": datetime.utcnow()}})
-        # In case source does not exist, matched_count is 0
-        return r.matched_count > 0
+        d = self.db.find_one_and_update(
+            {"name": path, "namespace": from_namespace},
+            {"$set": {"namespace": to_namespace, "updated": datetime.utcnow()}},
+            {"size": 1}
+        )
+        self.invalidate(path, from_namespace)
+        # In case source does not exist
+        if d is None:
+            return False
+        self.remove_directories([path], from_namespace)
+        self.add_directories([path], to_namespace)
+        self.count_usage(from_namespace, -1, -d.get("size", 0))
+        self.count_usage(to_namespace, 1, d.get("size", 0))
+        return True
 
+    @measured("set_extras")
     def set_extras(self, path: str, extras: Dict[str, Any], namespace: str = None) -> bool:
         path = self.sanitize_path(path, False)
         if namespace is None:
@@ -164,25 +1087,196 @@ class FileSystem(object):
 
         # Perform the update
         r = self.db.update_one({"name": path, "namespace": namespace}, {"$set": {"extras": extras, "updated": datetime.utcnow()}})
+        self.invalidate(path, namespace)
         return r.matched_count > 0
 
+    @measured("get_extras")
     def get_extras(self, path: str, namespace: str = None) -> Dict[str, Any]:
         path = self.sanitize_path(path, False)
         if namespace is None:
             namespace = self.namespace
 
-        d = self.db.find_one({"name": path, "namespace": namespace}, {"extras": 1})
+        d = self.find_file(path, namespace, {"extras": 1})
         if d is not None:
             return d.get("extras", {})
         else:
             return {}
 
-    def put(self, path: str, content: bytes, namespace: str = None):
+    @measured("put", bytes_in="content")
+    def put(self, path: str, content: bytes, namespace: str = None, codec: str = None):
+        path = self.sanitize_path(path, False)
+        if namespace is None:
+            namespace = self.namespace
+
+        codec = self.choose_codec(namespace, codec, content)
+        if self.deduplicate:
+            self.put_deduplicated(path, content, namespace, codec)
+            return
+
+        stored = content if codec is None else codec.compress(content)
+        # A single round trip creates or updates the document, returning the previous one to roll back
+        file_id = ObjectId()
+        d = self.db.find_one_and_update(
+            {"name": path, "namespace": namespace},
+            self.upsert_fields({
+                "size": len(content),
+                "updated": datetime.utcnow(),
+                "tier": None,
+                "cold_copy": None,
+                **self.codec_fields(codec, len(stored)),
+                **self.layout_fields(self.layout)
+            }, file_id),
+            FILE_ROLLBACK_PROJECT,
+            upsert=True
+        )
+        new_file = d is None
+        if not new_file:
+            file_id = d["_id"]
+        else:
+            # Accounted as it's created, so a crash leaves a pending file to undo like one being removed
+            self.add_directories([path], namespace)
+            self.count_usage(namespace, 1, len(content))
+        if not new_file and d.get("moving"):
+            self.wait_moves([file_id])
+        filename = str(file_id)
+
+        try:
+            with self.layout.open(self.fs, filename, "wb") as f:
+                f.write(stored)
+            # Existing files are already committed, unless a write or a removal was interrupted
+            if new_file or d.get("state") == FILE_PENDING:
+                self.db.update_one({"_id": file_id}, {"$set": {"state": FILE_COMMITTED}})
+        except Exception as e:
+            if new_file:
+                # Only remove when creating the file, otherwise we could remove a valid entry (eg if database is ok and storage is not)
+                self.db.delete_one({"_id": file_id})
+                self.remove_directories([path], namespace)
+                self.count_usage(namespace, -1, -len(content))
+            else:
+                # Backup data
+                self.db.update_one({"_id": file_id}, self.set_fields({
+                    "size": d.get("size"),
+                    "updated": d["updated"],
+                    "codec": d.get("codec"),
+                    "stored_size": d.get("stored_size"),
+                    "tier": d.get("tier"),
+                    "cold_copy": d.get("cold_copy"),
+                    "sharded": d.get("sharded")
+                }))
+            raise e
+        finally:
+            self.invalidate(path, namespace, filename)
+        if not new_file:
+            self.detach_blobs([d])
+            self.drop_cold([d])
+            self.drop_flat([d])
+            self.count_usage(namespace, 0, len(content) - d.get("size", 0))
+
+    def put_deduplicated(self, path: str, content: bytes, namespace: str, codec: Optional[Codec], fs: FS = None):
+        fs = fs or self.fs
+        digest = self.blobs.digest(content)
+
+        def write():
+            stored = content if codec is None else codec.compress(content)
+            with self.layout.open(fs, digest, "wb") as f:
+                f.write(stored)
+            return self.set_fields({**self.codec_fields(codec, len(stored)), **self.layout_fields(self.layout)})["$set"]
+
+        self.put_blob(path, namespace, digest, len(content), write, fs)
+
+    def put_blob(
+        self,
+        path: str,
+        namespace: str,
+        digest: str,
+        size: int,
+        write: Callable[[], Dict[str, Any]],
+        fs: FS = None
+    ):
+        """Point a (sanitized) path to the blob of digest, storing it with write() if it isn't stored yet."""
+        fs = fs or self.fs
+        blob = self.blobs.acquire(fs, digest, size, write)
+        now = datetime.utcnow()
+        # The blob may have been stored by someone else with another codec
+        update = self.set_fields({
+            "blob": digest,
+            "size": size,
+            "updated": now,
+            "state": FILE_COMMITTED,
+            "codec": blob.get("codec"),
+            "stored_size": blob.get("stored_size"),
+            "sharded": blob.get("sharded"),
+            "tier": None,
+            "cold_copy": None
+        })
+        update["$setOnInsert"] = {"created": now}
+        try:
+            previous = self.db.find_one_and_update(
+                {"name": path, "namespace": namespace}, update, FILE_OBJECT_PROJECT, upsert=True
+            )
+        except Exception as e:
+            self.blobs.release(fs, digest)
+            raise e
+        self.invalidate(path, namespace, previous and previous["_id"])
+        if previous is None:
+            self.add_directories([path], namespace)
+            self.count_usage(namespace, 1, size)
+        else:
+            # Also when it had the same blob: it was referenced twice now
+            self.release_object(previous, fs)
+            self.count_usage(namespace, 0, size - previous.get("size", 0))
+
+    @measured("has_digest")
+    def has_digest(self, digest: str) -> bool:
+        """If a content with this SHA-256 (hex digest) is stored, so put_by_digest can be used instead of put."""
+        return self.blobs.get(digest) is not None
+
+    @measured("put_by_digest")
+    def put_by_digest(self, path: str, digest: str, namespace: str = None) -> bool:
+        """Put a file with the stored content of this SHA-256, without uploading it. False if it isn't stored."""
         path = self.sanitize_path(path, False)
         if namespace is None:
             namespace = self.namespace
 
-        d = self.db.find_one({"name": path, "namespace": namespace}, {"size": 1, "updated": 1})
+        blob = self.blobs.get(digest)
+        if blob is None:
+            return False
+
+        def missing():
+            raise ResourceNotFound(digest)
+
+        try:
+            self.put_blob(path, namespace, digest, blob["size"], missing)
+        except ResourceNotFound:
+            # Removed in the meantime
+            return False
+        return True
+
+    @measured("put_stream", bytes_in=RESULT)
+    def put_stream(
+        self,
+        path: str,
+        content: Union[Iterable[bytes], BinaryIO],
+        namespace: str = None,
+        chunk_size: int = CHUNK_SIZE,
+        codec: str = None
+    ) -> int:
+        """Like put, but content is a file-like object or an iterable of bytes so it's never fully in memory.
+
+        The size is only known at the end, so it's stored once the content is written. Returns the size.
+        If the content is worth compressing is guessed from its first chunk.
+        """
+        path = self.sanitize_path(path, False)
+        if namespace is None:
+            namespace = self.namespace
+
+        if self.deduplicate:
+            return self.put_stream_deduplicated(path, content, namespace, chunk_size, codec)
+
+        # An existing file is touched, so a move between tiers started before is given up
+        d = self.db.find_one_and_update(
+            {"name": path, "namespace": namespace}, {"$set": {"updated": datetime.utcnow()}}, FILE_OBJECT_PROJECT
+        )
         new_file = d is None
 
         if new_file:
@@ -191,123 +1285,736 @@ class FileSystem(object):
                 "namespace": namespace,
                 "created": datetime.utcnow(),
                 "updated": datetime.utcnow(),
-                "size": len(content)
+                "size": 0,
+                "state": FILE_PENDING
             })
             filename = str(insert_info.inserted_id)
+            # Accounted as it's created, so a crash leaves a pending file to undo like one being removed
+            self.add_directories([path], namespace)
+            self.count_usage(namespace, 1, 0)
         else:
-            self.db.update_one({"name": path, "namespace": namespace}, {"$set": {"size": len(content), "updated": datetime.utcnow()}})
             filename = str(d["_id"])
+            if d.get("moving"):
+                self.wait_moves([d["_id"]])
 
         try:
-            with self.fs.open(filename, "wb") as f:
-                f.write(content)
+            # The content is read by a worker while the previous chunk is written
+            chunks, codec = self.stream_codec(self.prefetch(self.read_chunks(content, chunk_size), chunk_size), namespace, codec)
+            with self.layout.open(self.fs, filename, "wb") as f:
+                size, stored_size = self.write_chunks(f, chunks, codec)
+            self.db.update_one({"name": path, "namespace": namespace}, self.set_fields({
+                "size": size,
+                "updated": datetime.utcnow(),
+                "state": FILE_COMMITTED,
+                "tier": None,
+                "cold_copy": None,
+                **self.codec_fields(codec, stored_size),
+                **self.layout_fields(self.layout)
+            }))
         except Exception as e:
             if new_file:
                 # Only remove when creating the file, otherwise we could remove a valid entry (eg if database is ok and storage is not)
                 self.db.delete_one({"name": path, "namespace": namespace})
+                self.remove_directories([path], namespace)
+                self.count_usage(namespace, -1, 0)
             else:
-                # Backup data
-                self.db.update_one({"name": path, "namespace": namespace}, {"$set": {"size": d["size"], "updated": d["updated"]}})
+                # An existing file keeps its size, it's only changed when everything is written, and gets its date back
+                self.db.update_one({"_id": d["_id"]}, {"$set": {"updated": d["updated"]}})
             raise e
+        finally:
+            self.invalidate(path, namespace, filename)
+        if new_file:
+            self.count_usage(namespace, 0, size)
+        else:
+            self.detach_blobs([d])
+            self.drop_cold([d])
+            self.drop_flat([d])
+            self.count_usage(namespace, 0, size - d.get("size", 0))
+        return size
 
+    def put_stream_deduplicated(
+        self,
+        path: str,
+        content: Union[Iterable[bytes], BinaryIO],
+        namespace: str,
+        chunk_size: int,
+        codec: Optional[str]
+    ) -> int:
+        # The digest is only known at the end, meanwhile the content goes to a temporary object
+        tmp_name = f"tmp-{ObjectId()}"
+        content_hash = self.blobs.new_hash()
+        try:
+            chunks, codec = self.stream_codec(self.prefetch(self.read_chunks(content, chunk_size), chunk_size), namespace, codec)
+            with self.layout.open(self.fs, tmp_name, "wb") as f:
+                size, stored_size = self.write_chunks(f, chunks, codec, content_hash)
+            digest = content_hash.hexdigest()
+
+            def write():
+                self.layout.move(self.fs, tmp_name, digest)
+                return self.set_fields({**self.codec_fields(codec, stored_size), **self.layout_fields(self.layout)})["$set"]
+
+            self.put_blob(path, namespace, digest, size, write)
+        finally:
+            # Still there if the content was already stored
+            try:
+                self.layout.remove(self.fs, tmp_name)
+            except ResourceNotFound:
+                pass
+        return size
+
+    def stream_codec(self, chunks: Iterator[bytes], namespace: str, codec: Optional[str]) -> Tuple[Iterator[bytes], Optional[Codec]]:
+        """Choose the codec of a stream looking at its first chunk. Returns the chunks, that one included, and the codec."""
+        first = next(chunks, b"")
+        return itertools.chain([first], chunks), self.choose_codec(namespace, codec, first)
+
+    @staticmethod
+    def write_chunks(f: BinaryIO, chunks: Iterable[bytes], codec: Optional[Codec], content_hash: Any = None) -> Tuple[int, int]:
+        """Write the chunks to f, compressed with codec if any, and feed them to the hash. Returns both sizes."""
+        size = stored_size = 0
+        compressor = codec and codec.compressor()
+        for chunk in chunks:
+            size += len(chunk)
+            if content_hash is not None:
+                content_hash.update(chunk)
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            f.write(chunk)
+            stored_size += len(chunk)
+        if compressor is not None:
+            chunk = compressor.flush()
+            f.write(chunk)
+            stored_size += len(chunk)
+        return size, stored_size
+
+    @measured("get_stream", stream=True)
+    def get_stream(self, path: str, namespace: str = None, chunk_size: int = CHUNK_SIZE) -> Optional[Iterator[bytes]]:
+        """Like get, but returns a generator of chunks of at most chunk_size bytes.
+
+        For a readable file object use open(path, "rb").
+        """
+        path = self.sanitize_path(path, False)
+        if namespace is None:
+            namespace = self.namespace
+
+        # The lookup is done here and not in the generator so a missing file is known before iterating
+        d = self.find_file(path, namespace, FILE_OBJECT_PROJECT)
+        if d is not None:
+            chunks = self.read_chunks(
+                self.layout.open(self.read_storage(d), self.object_name(d), "rb"), chunk_size, close=True
+            )
+            codec = get_codec(d.get("codec"))
+            if codec is not None:
+                # Decompressed chunks can be of any size
+                chunks = rechunk(decompress_chunks(chunks, codec), chunk_size)
+            return self.prefetch(chunks, chunk_size)
+
+    @staticmethod
+    def read_chunks(
+        content: Union[Iterable[bytes], BinaryIO],
+        chunk_size: int,
+        close: bool = False
+    ) -> Iterator[bytes]:
+        if not hasattr(content, "read"):
+            yield from content
+            return
+
+        try:
+            chunk = content.read(chunk_size)
+            while chunk:
+                yield chunk
+                chunk = content.read(chunk_size)
+        finally:
+            if close:
+                content.close()
+
+    @measured("list")
     def list(self, path: str, namespace: str = None) -> List[str]:
         path = self.sanitize_path(path, True)
         if namespace is None:
             namespace = self.namespace
 
-        # We search for paths that starts with the provided path (directory), the something without a slash (filename)
-        # and the end, because if we have another slash this is a directory
-        files = self.db.find({"namespace": namespace, "name": {'$regex': f'^{re.escape(path)}[^/]+$'}})
+        files = self.db.find(self.list_query(path, namespace), {"name": 1})
         # To make it faster, a raw mongo query
         return [file["name"].rsplit("/", 1)[-1] for file in files]
 
-    @staticmethod
-    def sanitize_path(path: str, directory: str) -> str:
-        path = os.path.realpath(path)
+    def iter_list(self, path: str, namespace: str = None, batch_size: int = LIST_BATCH_SIZE) -> Iterator[str]:
+        """Like list, but yielding the names in order as they are fetched, batch_size at a time."""
+        path = self.sanitize_path(path, True)
+        if namespace is None:
+            namespace = self.namespace
 
-        if directory:
-            if not path.endswith("/"):
-                path += "/"
+        files = self.db.find(self.list_query(path, namespace), {"name": 1}).sort("name", ASCENDING).batch_size(batch_size)
+        for file in files:
+            yield file["name"].rsplit("/", 1)[-1]
 
-        if not path.startswith("/"):
-            path = "/" + path
+    @classmethod
+    def extras_query(cls, extras: Dict[str, Any], path: Optional[str], namespace: str) -> Dict[str, Any]:
+        """Query for the files whose extras match, below the (sanitized) directory 'path' if any."""
+        query = {"namespace": namespace} if path is None else cls.tree_query(path, namespace)
+        query.update((cls.extras_field(field), condition) for field, condition in extras.items())
+        return query
 
-        return path
+    def find(
+        self,
+        extras: Dict[str, Any],
+        path_prefix: str = None,
+        namespace: str = None,
+        batch_size: int = LIST_BATCH_SIZE
+    ) -> Iterator[FileAttrs]:
+        """Files of the namespace whose extras match, below the directory path_prefix if given, yielded as they are
+        fetched batch_size at a time, in no particular order. Their name is the whole path.
+
+        extras is {field: value or condition}, the conditions with the operators of Mongo (eg {"status": "pending",
+        "tries": {"$lt": 3}}) and dotted fields for nested ones. Without an index (ensure_extras_index) it goes
+        through every file of the namespace.
+        """
+        if path_prefix is not None:
+            path_prefix = self.sanitize_path(path_prefix, True)
+        if namespace is None:
+            namespace = self.namespace
+
+        files = self.db.find(self.extras_query(extras, path_prefix, namespace), FILE_ATTRS_PROJECT).batch_size(batch_size)
+        for f in files:
+            yield self.file_attrs(f)._replace(name=f["name"])
+
+    @measured("list_page")
+    def list_page(self, path: str, limit: int, after: str = None, namespace: str = None) -> Page:
+        """Up to limit names of the directory, in order, after the 'after' token.
+
+        The next token is in the returned page, None when there are no more names.
+        """
+        if limit < 1:
+            raise ValueError(f"Invalid limit {limit}, it must be at least 1")
+        path = self.sanitize_path(path, True)
+        if namespace is None:
+            namespace = self.namespace
+
+        query = self.list_query(path, namespace)
+        if after is not None:
+            # The token is the last name returned, the index goes straight to the following one
+            query["name"]["$gt"] = path + after
+            del query["name"]["$gte"]
+        files = self.db.find(query, {"name": 1}).sort("name", ASCENDING).limit(limit + 1)
+        names = [file["name"].rsplit("/", 1)[-1] for file in files]
+        if len(names) > limit:
+            return Page(names=names[:limit], next=names[limit - 1])
+        return Page(names=names, next=None)
+
+    def iter_dirs(self, path: str, namespace: str = None) -> Iterator[str]:
+        """Like list_dirs, but yielding the directories as they are found, with a query each.
+
+        Instead of going through every file below path, after finding a directory it jumps over its contents:
+        every name in path/dir/ is lower than path/dir0.
+        """
+        path = self.sanitize_path(path, True)
+        if namespace is None:
+            namespace = self.namespace
 
+        if self.directories is not None:
+            yield from self.directories.iter(path, namespace)
+            return
+
+        query = self.list_dirs_query(path, namespace)
+        while True:
+            file = self.db.find_one(query, {"name": 1}, sort=[("name", ASCENDING)])
+            if file is None:
+                return
+            directory = file["name"][len(path):].split("/", 1)[0]
+            yield directory
+            query["name"]["$gte"] = path + directory + "0"
+
+    @staticmethod
+    @measured_sanitize
+    def sanitize_path(path: str, directory: bool) -> str:
+        return normalize_path(path, bool(directory))
+
+    @measured("list_dirs")
     def list_dirs(self, path: str, namespace: str = None) -> List[str]:
         path = self.sanitize_path(path, True)
-        # query = list_dir_query(path)
         if namespace is None:
             namespace = self.namespace
 
-        pipeline = [
-            # 1. Get things that are: path/{dir}/{something} just to be sure that {dir} is a directory and not a file
-            {"$match": {'namespace': namespace, 'name': {'$regex': f'^{re.escape(path)}([^/]+/)'}}},
-            # 2. Remove the provided path from the path. path/dir1/file -> dir1/file
-            {"$project": {'name': {"$substr": ["$name", len(path), {"$strLenCP": "$name"}]}}},
-            # 3. Split a get the first element. dir1/file -> dir. It also works for dir1/subdir/file -> dir1
-            {"$project": {'name': {"$arrayElemAt": [{"$split": ["$name", "/"]}, 0]}}},
-            # 4. Group to avoid duplicates (a subdirectory with several files will cause these duplicates)
-            {"$group": {"_id": "$name"}}
-        ]
-        return [f["_id"] for f in self.db.aggregate(pipeline)]
+        if self.directories is not None:
+            return list(self.directories.iter(path, namespace))
+        return [f["_id"] for f in self.db.aggregate(self.list_dirs_pipeline(path, namespace))]
 
+    @measured("rename")
     def rename(self, old_path: str, new_path: str, namespace: str = None) -> bool:
         old_path = self.sanitize_path(old_path, False)
         new_path = self.sanitize_path(new_path, False)
         if namespace is None:
             namespace = self.namespace
 
-        r = self.db.update_one({"name": old_path, "namespace": namespace}, {"$set": {"name": new_path}})
+        # Destination should not exists
+        destination = {"name": new_path, "namespace": namespace}
+        if new_path != old_path and self.db.find_one(destination, {"_id": 1}) is not None:
+            return False
+        try:
+            r = self.db.update_one({"name": old_path, "namespace": namespace}, {"$set": {"name": new_path}})
+        except DuplicateKeyError:
+            # Created meanwhile
+            return False
+        self.invalidate(old_path, namespace)
+        if r.matched_count > 0:
+            self.remove_directories([old_path], namespace)
+            self.add_directories([new_path], namespace)
         return r.matched_count > 0
 
+    @measured("attrs")
     def attrs(self, path: str, namespace: str = None) -> FileAttrs:
         path = self.sanitize_path(path, False)
         if namespace is None:
             namespace = self.namespace
 
-        f = self.db.find_one({"name": path, "namespace": namespace})
+        f = self.find_file(path, namespace)
         if f is not None:
-            return FileAttrs(
-                created=f["created"],
-                updated=f["updated"],
-                name=f["name"].rsplit("/")[-1],
-                size=f["size"],
-                namespace=f["namespace"]
-            )
+            return self.file_attrs(f)
 
+    @staticmethod
+    def tree_query(path: str, namespace: str) -> Dict[str, Any]:
+        """Query for every name below the directory 'path', at any depth."""
+        return FileSystem.prefix_query(path, namespace, f'^{re.escape(path)}')
+
+    def check_tree_destination(self, old_path: str, new_path: str, old_namespace: str, new_namespace: str):
+        if old_namespace == new_namespace and new_path.startswith(old_path):
+            raise ValueError(f"{new_path} is inside {old_path}")
+        if self.db.find_one(self.tree_query(new_path, new_namespace), {"_id": 1}) is not None:
+            raise ValueError(f"{new_path} in {new_namespace} is not empty")
+
+    @measured("move_tree")
+    def move_tree(self, old_path: str, new_path: str, namespace: str = None) -> int:
+        """Rename a directory with everything below it, with a single update in the database. Returns the files moved.
+
+        The destination must be empty. The update is a pipeline, it needs MongoDB 4.2 or later.
+        """
+        old_path = self.sanitize_path(old_path, True)
+        new_path = self.sanitize_path(new_path, True)
+        if namespace is None:
+            namespace = self.namespace
+
+        self.check_tree_destination(old_path, new_path, namespace, namespace)
+        # Objects are named after the ids, only names change
+        r = self.db.update_many(self.tree_query(old_path, namespace), [{"$set": {"name": {"$concat": [
+            new_path, {"$substrCP": ["$name", len(old_path), {"$strLenCP": "$name"}]}
+        ]}}}])
+        self.clear_metadata_cache()
+        if r.modified_count and self.directories is not None:
+            names = [f["name"] for f in self.db.find(self.tree_query(new_path, namespace), {"name": 1})]
+            self.directories.remove([old_path + name[len(new_path):] for name in names], namespace)
+            self.directories.add(names, namespace)
+        return r.modified_count
+
+    @measured("change_namespace_tree")
+    def change_namespace_tree(self, path: str, from_namespace: str, to_namespace: str) -> int:
+        """Move a directory with everything below it to another namespace, with a single update. Returns the files moved.
+
+        The directory must be empty in the destination namespace.
+        """
+        path = self.sanitize_path(path, True)
+        self.check_tree_destination(path, path, from_namespace, to_namespace)
+
+        if self.directories is not None:
+            names = [f["name"] for f in self.db.find(self.tree_query(path, from_namespace), {"name": 1})]
+        if self.usage_counters is not None:
+            moved = self.du(path, from_namespace)
+        r = self.db.update_many(
+            self.tree_query(path, from_namespace), {"$set": {"namespace": to_namespace, "updated": datetime.utcnow()}}
+        )
+        self.clear_metadata_cache()
+        if r.modified_count and self.directories is not None:
+            self.directories.remove(names, from_namespace)
+            self.directories.add(names, to_namespace)
+        if r.modified_count and self.usage_counters is not None:
+            self.usage_counters.add_many({
+                from_namespace: (-moved.files, -moved.size), to_namespace: (moved.files, moved.size)
+            })
+        return r.modified_count
+
+    @measured("copy_tree")
+    def copy_tree(self, old_path: str, new_path: str, namespace: str = None, to_namespace: str = None) -> int:
+        """Copy a directory with everything below it, to another namespace if given. Returns the files copied.
+
+        Files are copied in batches: the stored objects of a batch in parallel (with io_workers), then its documents
+        with a single insert. Deduplicated files just get another reference to their blob. The destination must be
+        empty. If some file can't be copied, the rest are copied and then an exception is raised.
+        """
+        old_path = self.sanitize_path(old_path, True)
+        new_path = self.sanitize_path(new_path, True)
+        if namespace is None:
+            namespace = self.namespace
+        if to_namespace is None:
+            to_namespace = namespace
+
+        self.check_tree_destination(old_path, new_path, namespace, to_namespace)
+
+        def copy(fs, docs):
+            d, new_d = docs
+            if d.get("blob"):
+                def missing():
+                    raise ResourceNotFound(d["blob"])
+                self.blobs.acquire(fs, d["blob"], d.get("size"), missing)
+            else:
+                # Within its tier, the copy stays in the same one
+                self.layout.copy(self.storage_of(d, fs), str(d["_id"]), str(new_d["_id"]), d.get("sharded"))
+
+        copied = 0
+        errors = []
+        files = self.db.find(self.tree_query(old_path, namespace)).batch_size(LIST_BATCH_SIZE)
+        while True:
+            batch = list(itertools.islice(files, LIST_BATCH_SIZE))
+            if not batch:
+                break
+            now = datetime.utcnow()
+            pairs = [(d, dict(
+                d,
+                _id=ObjectId(),
+                name=new_path + d["name"][len(old_path):],
+                namespace=to_namespace,
+                created=now,
+                updated=now,
+                state=FILE_COMMITTED
+            )) for d in batch]
+            for _, new_d in pairs:
+                # Its object is copied within its tier, a cold copy kept after promoting it isn't
+                new_d.pop("cold_copy", None)
+                new_d.pop("moving", None)
+                if self.layout.shard_levels and not new_d.get("blob"):
+                    # Copied to its sharded path
+                    new_d["sharded"] = True
+            results = self.map_io(copy, pairs, [d.get("size", 0) for d in batch])
+            errors.extend(error for error in results if error is not None)
+            new_docs = [new_d for (_, new_d), error in zip(pairs, results) if error is None]
+            if new_docs:
+                self.db.insert_many(new_docs)
+                self.add_directories([d["name"] for d in new_docs], to_namespace)
+                self.count_usage(to_namespace, len(new_docs), sum(d.get("size", 0) for d in new_docs))
+                copied += len(new_docs)
+        if errors:
+            raise Exception(f"{len(errors)} files of {old_path} couldn't be copied, first error: {errors[0]!r}") from errors[0]
+        return copied
+
+    @measured("remove_tree")
+    def remove_tree(self, path: str, namespace: str = None) -> int:
+        """Remove a directory with everything below it, in batches. Returns the files removed.
+
+        Objects that are missing already don't stop their files from being removed. If some file can't be removed,
+        the rest are removed and then an exception is raised.
+        """
+        path = self.sanitize_path(path, True)
+        if namespace is None:
+            namespace = self.namespace
+
+        removed = 0
+        errors = []
+        projection = dict(FILE_OBJECT_PROJECT, name=True)
+        files = self.db.find(self.tree_query(path, namespace), projection).batch_size(LIST_BATCH_SIZE)
+        while True:
+            batch = list(itertools.islice(files, LIST_BATCH_SIZE))
+            if not batch:
+                break
+            results = self.remove_files(batch, namespace, missing_ok=True)
+            errors.extend(error for error in results if error is not None)
+            removed += results.count(None)
+        if errors:
+            raise Exception(f"{len(errors)} files of {path} couldn't be removed, first error: {errors[0]!r}") from errors[0]
+        return removed
+
+    @measured("du")
+    def du(self, path: str, namespace: str = None) -> DiskUsage:
+        """Files below the directory, at any depth, and the sum of their sizes, with a single aggregation.
+
+        stored_size is the sum of the stored (maybe compressed) sizes. Deduplicated contents count once per file.
+        """
+        path = self.sanitize_path(path, True)
+        if namespace is None:
+            namespace = self.namespace
+
+        result = list(self.db.aggregate([
+            {"$match": self.tree_query(path, namespace)},
+            {"$group": {
+                "_id": None,
+                "files": {"$sum": 1},
+                "size": {"$sum": "$size"},
+                "stored_size": {"$sum": {"$ifNull": ["$stored_size", "$size"]}}
+            }}
+        ]))
+        if not result:
+            return DiskUsage(files=0, size=0, stored_size=0)
+        return DiskUsage(files=result[0]["files"], size=result[0]["size"], stored_size=result[0]["stored_size"])
+
+    @measured("remove")
     def remove(self, path, namespace=None) -> bool:
         path = self.sanitize_path(path, False)
         if namespace is None:
             namespace = self.namespace
 
-        file_doc = self.db.find_one({"name": path, "namespace": namespace})
+        # Pending while the object is removed, so a crash doesn't leave a committed file without content
+        file_doc = self.db.find_one_and_update({"name": path, "namespace": namespace}, {"$set": {"state": FILE_PENDING}})
         if file_doc is None:
             raise ValueError(f"Couldn't find file {path} in {namespace}.")
         file_id = str(file_doc['_id'])
 
-        self.fs.remove(file_id)
+        if not file_doc.get("blob"):
+            try:
+                self.layout.remove(self.storage_of(file_doc), file_id)
+            except Exception as e:
+                self.db.update_one({"_id": file_doc["_id"]}, self.set_fields({"state": file_doc.get("state")}))
+                raise e
         r = self.db.delete_one({"name": path, "namespace": namespace})
+        if file_doc.get("blob") and r.deleted_count > 0:
+            self.blobs.release(self.fs, file_doc["blob"])
+        if file_doc.get("cold_copy") and r.deleted_count > 0:
+            self.drop_cold([file_doc])
+        self.invalidate(path, namespace, file_id)
+        if r.deleted_count > 0:
+            self.remove_directories([path], namespace)
+            self.count_usage(namespace, -1, -file_doc.get("size", 0))
         return r.deleted_count > 0
 
     def close(self):
-        self.fs.close()
+        if self.closed:
+            return
+        self.closed = True
+        if self.cache_invalidator is not None:
+            self.cache_invalidator.stop()
+        if self.io_pool is not None:
+            self.io_pool.shutdown()
+        if self.promoter is not None:
+            self.promoter.shutdown()
+        # Shared ones are closed by the last FileSystem using them
+        for key, fs in [(self.storage_key, self.fs), (self.cold_storage_key, self.cold_fs)]:
+            if fs is None:
+                continue
+            if self.shared:
+                release_storage(key, fs)
+            else:
+                fs.close()
+        if self.owns_mongo and self.shared:
+            release_mongo(self.mongo_key)
+        elif self.owns_mongo:
+            self.mongo.close()
 
+    @measured("exists")
     def exists(self, path: str, namespace: str = None) -> bool:
         path = self.sanitize_path(path, False)
         if namespace is None:
             namespace = self.namespace
 
-        return self.db.find_one({"name": path, "namespace": namespace}, {"_id": 1}) is not None
+        return self.find_file(path, namespace, {"_id": 1}) is not None
 
+    @measured("get_url")
     def get_url(self, path: str, namespace: str = None) -> str:
         path = self.sanitize_path(path, False)
         if namespace is None:
             namespace = self.namespace
 
-        file_info = self.db.find_one({"name": path, "namespace": namespace}, {"_id": 1})
+        file_info = self.find_file(path, namespace, FILE_OBJECT_PROJECT)
         
         if file_info is None:
             raise FileNotFoundError("[Errno 2] No such file or directory: '{filename}'".format(filename=path))
         
-        return self.fs.geturl(str(file_info["_id"]))
+        return self.layout.geturl(self.storage_of(file_info), self.object_name(file_info), file_info.get("sharded"))
+
+    def find_many(self, paths: Iterable[str], namespace: str, projection: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        """Documents of the given (sanitized) paths with a single query, by name. Missing paths are not included."""
+        projection = dict(projection, name=1)
+        files = self.db.find({"namespace": namespace, "name": {"$in": list(paths)}}, projection)
+        return {file["name"]: file for file in files}
+
+    def sanitize_paths(self, paths: Iterable[str]) -> Dict[str, str]:
+        """Map every path, as provided, to its sanitized version."""
+        return {path: self.sanitize_path(path, False) for path in paths}
+
+    @measured("put_many", bytes_in="files")
+    def put_many(self, files: Dict[str, bytes], namespace: str = None, codec: str = None) -> Dict[str, Optional[Exception]]:
+        """Put several files with a query, an insert and an update for all of them.
+
+        Returns, for every path, None if it was stored or the exception raised by that file. Failed files are
+        rolled back like put does: new files are removed and existing ones get their size and updated date back.
+        """
+        if namespace is None:
+            namespace = self.namespace
+        paths = self.sanitize_paths(files)
+        codecs = {path: self.choose_codec(namespace, codec, content) for path, content in files.items()}
+
+        if self.deduplicate:
+            # Every file is a blob to acquire and a document to point to it, so they are put one by one
+            def put(fs, path):
+                self.put_deduplicated(paths[path], files[path], namespace, codecs[path], fs)
+
+            results = self.map_io(put, list(files), [len(content) for content in files.values()])
+            return dict(zip(files, results))
+
+        stored = {
+            path: content if codecs[path] is None else codecs[path].compress(content) for path, content in files.items()
+        }
+        existing = self.find_many(
+            paths.values(),
+            namespace,
+            {"size": 1, "updated": 1, "blob": 1, "codec": 1, "stored_size": 1, "tier": 1, "cold_copy": 1, "sharded": 1}
+        )
+        errors = {}
+
+        new_paths = [path for path in files if paths[path] not in existing]
+        new_docs = [self.set_fields({
+            "name": paths[path],
+            "namespace": namespace,
+            "created": datetime.utcnow(),
+            "updated": datetime.utcnow(),
+            "size": len(files[path]),
+            "state": FILE_PENDING,
+            **self.codec_fields(codecs[path], len(stored[path])),
+            **self.layout_fields(self.layout)
+        })["$set"] for path in new_paths]
+        if new_docs:
+            try:
+                # insert_many sets the _id of every document
+                self.db.insert_many(new_docs, ordered=False)
+            except BulkWriteError as e:
+                for write_error in e.details["writeErrors"]:
+                    errors[new_paths[write_error["index"]]] = Exception(write_error["errmsg"])
+        filenames = {path: str(d["_id"]) for path, d in zip(new_paths, new_docs) if path not in errors}
+        # Accounted as they are created, so a crash leaves pending files to undo like the ones being removed
+        self.add_directories([paths[path] for path in filenames], namespace)
+        self.count_usage(namespace, len(filenames), sum(len(files[path]) for path in filenames))
+
+        updated_paths = [path for path in files if paths[path] in existing]
+        if updated_paths:
+            self.db.bulk_write([
+                UpdateOne({"name": paths[path], "namespace": namespace}, self.set_fields({
+                    "size": len(files[path]),
+                    "updated": datetime.utcnow(),
+                    "state": FILE_COMMITTED,
+                    "tier": None,
+                    "cold_copy": None,
+                    **self.codec_fields(codecs[path], len(stored[path])),
+                    **self.layout_fields(self.layout)
+                })) for path in updated_paths
+            ], ordered=False)
+            filenames.update((path, str(existing[paths[path]]["_id"])) for path in updated_paths)
+            self.wait_moves([existing[paths[path]]["_id"] for path in updated_paths])
+
+        def write(fs, path):
+            with self.layout.open(fs, filenames[path], "wb") as f:
+                f.write(stored[path])
+
+        written = list(filenames)
+        results = self.map_io(write, written, [len(stored[path]) for path in written])
+        errors.update((path, e) for path, e in zip(written, results) if e is not None)
+
+        committed = [d["_id"] for path, d in zip(new_paths, new_docs) if path not in errors]
+        if committed:
+            self.db.update_many({"_id": {"$in": committed}}, {"$set": {"state": FILE_COMMITTED}})
+
+        # The ones inserted, a failed insert may be a file created by someone else meanwhile
+        failed_new = [(path, d) for path, d in zip(new_paths, new_docs) if path in errors and path in filenames]
+        if failed_new:
+            # Only remove when creating the file, otherwise we could remove a valid entry (eg if database is ok and storage is not)
+            self.db.delete_many({"_id": {"$in": [d["_id"] for path, d in failed_new]}})
+            self.remove_directories([paths[path] for path, d in failed_new], namespace)
+            self.count_usage(namespace, -len(failed_new), -sum(len(files[path]) for path, d in failed_new))
+        failed_updated = [existing[paths[path]] for path in updated_paths if path in errors]
+        if failed_updated:
+            # Backup data
+            self.db.bulk_write([
+                UpdateOne({"_id": d["_id"]}, self.set_fields({
+                    "size": d.get("size"),
+                    "updated": d["updated"],
+                    "codec": d.get("codec"),
+                    "stored_size": d.get("stored_size"),
+                    "tier": d.get("tier"),
+                    "cold_copy": d.get("cold_copy"),
+                    "sharded": d.get("sharded")
+                })) for d in failed_updated
+            ], ordered=False)
+
+        for path, sanitized in paths.items():
+            self.invalidate(sanitized, namespace, filenames.get(path))
+        changed = [path for path in updated_paths if path not in errors]
+        self.detach_blobs([existing[paths[path]] for path in changed])
+        self.drop_cold([existing[paths[path]] for path in changed])
+        self.drop_flat([existing[paths[path]] for path in changed])
+        self.count_usage(namespace, 0, sum(len(files[path]) - existing[paths[path]].get("size", 0) for path in changed))
+        return {path: errors.get(path) for path in files}
+
+    @measured("get_many", bytes_out=RESULT)
+    def get_many(self, paths: Iterable[str], namespace: str = None) -> Dict[str, Union[bytes, None, Exception]]:
+        """Get several files with a single query. Missing files are None and unreadable ones their exception."""
+        if namespace is None:
+            namespace = self.namespace
+        paths = self.sanitize_paths(paths)
+        existing = self.find_many(paths.values(), namespace, FILE_PROJECT)
+
+        def read(fs, d):
+            return self.read_content(d, fs)
+
+        found = [path for path, sanitized in paths.items() if sanitized in existing]
+        docs = [existing[paths[path]] for path in found]
+        result = dict.fromkeys(paths)
+        result.update(zip(found, self.map_io(read, docs, [d.get("size", 0) for d in docs])))
+        return result
+
+    @measured("exists_many")
+    def exists_many(self, paths: Iterable[str], namespace: str = None) -> Dict[str, bool]:
+        if namespace is None:
+            namespace = self.namespace
+        paths = self.sanitize_paths(paths)
+        existing = self.find_many(paths.values(), namespace, {"_id": 1})
+        return {path: sanitized in existing for path, sanitized in paths.items()}
+
+    @measured("remove_many")
+    def remove_many(self, paths: Iterable[str], namespace: str = None) -> Dict[str, Union[bool, Exception]]:
+        """Remove several files, deleting all their documents at once.
+
+        Returns, for every path, True if it was removed or the exception raised by that file (ValueError if it
+        doesn't exist). As in remove, the document is kept when the stored file can't be removed.
+        """
+        if namespace is None:
+            namespace = self.namespace
+        paths = self.sanitize_paths(paths)
+        existing = self.find_many(paths.values(), namespace, FILE_OBJECT_PROJECT)
+
+        result = {
+            path: ValueError(f"Couldn't find file {sanitized} in {namespace}.")
+            for path, sanitized in paths.items() if sanitized not in existing
+        }
+        found = [path for path in paths if path not in result]
+        errors = self.remove_files([existing[paths[path]] for path in found], namespace)
+        result.update((path, error or True) for path, error in zip(found, errors))
+        return {path: result[path] for path in paths}
+
+    def remove_files(self, docs: List[Dict[str, Any]], namespace: str, missing_ok: bool = False) -> List[Optional[Exception]]:
+        """Remove the files of the documents (with name and FILE_OBJECT_PROJECT), deleting the documents at once.
+
+        Returns the exception of every file, or None if it was removed. A file whose stored object can't be removed
+        keeps its document, unless the object doesn't exist and missing_ok is set.
+        """
+        def remove(fs, d):
+            # Blobs are released once the documents are deleted
+            if not d.get("blob"):
+                try:
+                    self.layout.remove(self.storage_of(d, fs), str(d["_id"]))
+                except ResourceNotFound:
+                    if not missing_ok:
+                        raise
+
+        if docs:
+            self.db.update_many({"_id": {"$in": [d["_id"] for d in docs]}}, {"$set": {"state": FILE_PENDING}})
+        errors = self.map_io(remove, docs, [0] * len(docs))
+        removed = [d for d, error in zip(docs, errors) if error is None]
+        failed = [d for d, error in zip(docs, errors) if error is not None]
+        if failed:
+            self.db.bulk_write([
+                UpdateOne({"_id": d["_id"]}, self.set_fields({"state": d.get("state")})) for d in failed
+            ], ordered=False)
+        if removed:
+            self.db.delete_many({"_id": {"$in": [d["_id"] for d in removed]}})
+            self.remove_directories([d["name"] for d in removed], namespace)
+            self.count_usage(namespace, -len(removed), -sum(d.get("size", 0) for d in removed))
+            for d in removed:
+                if d.get("blob"):
+                    self.blobs.release(self.fs, d["blob"])
+            self.drop_cold([d for d in removed if d.get("cold_copy")])
+        for d in docs:
+            self.invalidate(d["name"], namespace, d["_id"])
+        return errors
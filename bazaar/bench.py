@@ -0,0 +1,345 @@
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from datetime import datetime
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from pymongo import MongoClient
+
+from .bazaar import BufferWrapper, FileSystem, normalize_path
+
+try:
+    import mongomock
+except ImportError:  # Only needed to benchmark without a mongod
+    mongomock = None
+
+
+# Payload sizes of put/get and files of the directories listed, by default. Directories of 1M files take a while
+PAYLOAD_SIZES = [1024, 64 * 1024, 1024 * 1024]
+DIRECTORY_SIZES = [10, 1000, 10000]
+# Timed calls of every case, and calls before them that are not timed
+REPEAT = 100
+WARMUP = 5
+# Files written at once when filling the directories
+FILL_BATCH_SIZE = 1000
+# Calls timed together by the micro benchmarks, a single one is too fast to time
+MICRO_BATCH_SIZE = 1000
+# Slower than the baseline by more than this is a regression
+REGRESSION_THRESHOLD = 0.1
+
+# Latencies in seconds
+Result = namedtuple('Result', ["case", "param", "storage", "calls", "ops_per_second", "mean", "p50", "p95", "p99"])
+# What a benchmark runs against, its options and the storage name for the results
+Config = namedtuple('Config', ["filesystem", "storage", "payload_sizes", "directory_sizes", "repeat", "warmup"])
+
+BENCHMARKS = {}
+
+
+def benchmark(name: str):
+    """Register a benchmark: a function of a Config yielding (param, latencies) for every variant it measures."""
+    def decorator(function: Callable[[Config], Iterator[Tuple[str, List[float]]]]):
+        BENCHMARKS[name] = function
+        return function
+    return decorator
+
+
+def timed(function: Callable[[int], object], repeat: int, warmup: int = 0) -> List[float]:
+    """Latencies of calling function(i) repeat times, after warmup calls (with negative i)."""
+    for i in range(-warmup, 0):
+        function(i)
+    latencies = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function(i)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def percentile(latencies: List[float], fraction: float) -> float:
+    ordered = sorted(latencies)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def result(case: str, param: str, storage: str, latencies: List[float]) -> Result:
+    total = sum(latencies)
+    return Result(
+        case=case,
+        param=param,
+        storage=storage,
+        calls=len(latencies),
+        ops_per_second=len(latencies) / total if total else float("inf"),
+        mean=total / len(latencies),
+        p50=percentile(latencies, 0.5),
+        p95=percentile(latencies, 0.95),
+        p99=percentile(latencies, 0.99)
+    )
+
+
+def size_name(size: int) -> str:
+    for unit, factor in [("MiB", 1024 * 1024), ("KiB", 1024)]:
+        if size >= factor and size % factor == 0:
+            return f"{size // factor}{unit}"
+    return f"{size}B"
+
+
+def fill(filesystem: FileSystem, directory: str, files: int):
+    """Put files (and a subdirectory for every 10 of them) in directory."""
+    for start in range(0, files, FILL_BATCH_SIZE):
+        filesystem.put_many({
+            f"{directory}/{i // 10}/file{i}" if i % 10 == 0 else f"{directory}/file{i}": b"x"
+            for i in range(start, min(start + FILL_BATCH_SIZE, files))
+        })
+
+
+@benchmark("put")
+def bench_put(config: Config):
+    for size in config.payload_sizes:
+        content = os.urandom(size)
+        yield size_name(size), timed(lambda i: config.filesystem.put(f"/put/{size}/{i}", content), config.repeat, config.warmup)
+
+
+@benchmark("get")
+def bench_get(config: Config):
+    for size in config.payload_sizes:
+        config.filesystem.put(f"/get/{size}", os.urandom(size))
+        yield size_name(size), timed(lambda i: config.filesystem.get(f"/get/{size}"), config.repeat, config.warmup)
+
+
+@benchmark("open_write")
+def bench_open_write(config: Config):
+    for size in config.payload_sizes:
+        content = os.urandom(size)
+
+        def write(i):
+            with config.filesystem.open(f"/open/{size}/{i}", "wb") as f:
+                f.write(content)
+
+        yield size_name(size), timed(write, config.repeat, config.warmup)
+
+
+@benchmark("exists")
+def bench_exists(config: Config):
+    config.filesystem.put("/exists", b"x")
+    yield "found", timed(lambda i: config.filesystem.exists("/exists"), config.repeat, config.warmup)
+    yield "missing", timed(lambda i: config.filesystem.exists("/missing"), config.repeat, config.warmup)
+
+
+@benchmark("attrs")
+def bench_attrs(config: Config):
+    config.filesystem.put("/attrs", b"x")
+    yield "", timed(lambda i: config.filesystem.attrs("/attrs"), config.repeat, config.warmup)
+
+
+@benchmark("list")
+def bench_list(config: Config):
+    for files in config.directory_sizes:
+        fill(config.filesystem, f"/list{files}", files)
+        # Big directories take long to list, a few calls are enough
+        repeat = max(min(config.repeat, 1000000 // files), 3)
+        yield f"{files} files", timed(lambda i: config.filesystem.list(f"/list{files}"), repeat, 1)
+
+
+@benchmark("list_dirs")
+def bench_list_dirs(config: Config):
+    for files in config.directory_sizes:
+        if not config.filesystem.exists(f"/list{files}/file1"):
+            fill(config.filesystem, f"/list{files}", files)
+        repeat = max(min(config.repeat, 1000000 // files), 3)
+        yield f"{files} files", timed(lambda i: config.filesystem.list_dirs(f"/list{files}"), repeat, 1)
+
+
+@benchmark("sanitize_path")
+def bench_sanitize_path(config: Config):
+    """Batches of paths sanitized: repeated ones, new ones, and with os.path.realpath as it was done before."""
+    paths = [f"/dir{i % 10}/./sub//file{i}" for i in range(MICRO_BATCH_SIZE)]
+    param = f"x{MICRO_BATCH_SIZE}"
+    yield f"{param} cached", timed(lambda i: [FileSystem.sanitize_path(p, False) for p in paths], config.repeat, 1)
+    # Without the memo
+    yield f"{param} new", timed(lambda i: [normalize_path.__wrapped__(p, False) for p in paths], config.repeat, 1)
+    yield f"{param} realpath", timed(lambda i: [os.path.realpath(p) for p in paths], config.repeat, 1)
+
+
+class HookedWrapper(object):
+    """How BufferWrapper forwarded calls before binding them, the baseline of the buffer_wrapper case."""
+
+    def __init__(self, wrapped_object):
+        self.wrapped_object = wrapped_object
+
+    def __getattr__(self, attr: str):
+        orig_attr = self.wrapped_object.__getattribute__(attr)
+        if callable(orig_attr):
+            def hooked(*args, **kwargs):
+                result = orig_attr(*args, **kwargs)
+                if result == self.wrapped_object:
+                    return self
+                return result
+
+            return hooked
+        else:
+            return orig_attr
+
+
+@benchmark("buffer_wrapper")
+def bench_buffer_wrapper(config: Config):
+    """Batches of small calls on files from open, on the same files without the wrapper, and with the wrapper
+    hooking every call as it did before.
+    """
+    chunk = b"x" * 64
+    content = chunk * MICRO_BATCH_SIZE
+    param = f"x{MICRO_BATCH_SIZE}"
+
+    def write(wrapper):
+        def calls(i):
+            f = wrapper(io.BytesIO())
+            for _ in range(MICRO_BATCH_SIZE):
+                f.write(chunk)
+        return calls
+
+    def read(wrapper, into):
+        buffer = bytearray(len(chunk))
+
+        def calls(i):
+            f = wrapper(io.BytesIO(content))
+            for _ in range(MICRO_BATCH_SIZE):
+                if into:
+                    f.readinto(buffer)
+                else:
+                    f.read(len(chunk))
+        return calls
+
+    wrappers = [
+        ("raw", lambda f: f),
+        ("hooked", HookedWrapper),
+        ("wrapped", lambda f: BufferWrapper(f, {}, None))
+    ]
+    for name, wrapper in wrappers:
+        yield f"{param} write {name}", timed(write(wrapper), config.repeat, 1)
+        yield f"{param} read {name}", timed(read(wrapper, False), config.repeat, 1)
+        yield f"{param} readinto {name}", timed(read(wrapper, True), config.repeat, 1)
+
+
+@benchmark("rename")
+def bench_rename(config: Config):
+    config.filesystem.put_many({f"/rename/{i}": b"x" for i in range(-config.warmup, config.repeat)})
+    yield "", timed(lambda i: config.filesystem.rename(f"/rename/{i}", f"/renamed/{i}"), config.repeat, config.warmup)
+
+
+@benchmark("remove")
+def bench_remove(config: Config):
+    config.filesystem.put_many({f"/remove/{i}": b"x" for i in range(-config.warmup, config.repeat)})
+    yield "", timed(lambda i: config.filesystem.remove(f"/remove/{i}"), config.repeat, config.warmup)
+
+
+def open_database(db_uri: str, name: str):
+    if db_uri == "mongomock":
+        if mongomock is None:
+            raise SystemExit("mongomock is not installed: pip install mongomock")
+        return mongomock.MongoClient()[name]
+    return MongoClient(host=db_uri)[name]
+
+
+def run(
+    storages: List[str],
+    db_uri: str,
+    cases: List[str] = None,
+    payload_sizes: List[int] = PAYLOAD_SIZES,
+    directory_sizes: List[int] = DIRECTORY_SIZES,
+    repeat: int = REPEAT,
+    warmup: int = WARMUP
+) -> Iterator[Result]:
+    """Run the benchmarks (every one by default) against every storage ("mem://" or "osfs" for a temporary
+    directory), each with a new database dropped at the end.
+    """
+    for storage in storages:
+        directory = None
+        storage_uri = storage
+        if storage == "osfs":
+            directory = storage_uri = tempfile.mkdtemp(prefix="bazaar-bench-")
+        database = open_database(db_uri, f"bazaar_bench_{os.getpid()}")
+        filesystem = FileSystem(storage_uri, database=database)
+        config = Config(filesystem, storage, payload_sizes, directory_sizes, repeat, warmup)
+        try:
+            for name in cases or BENCHMARKS:
+                try:
+                    for param, latencies in BENCHMARKS[name](config):
+                        yield result(name, param, storage, latencies)
+                except NotImplementedError as e:
+                    # mongomock lacks some operators
+                    print(f"{name} skipped: {e}", file=sys.stderr)
+        finally:
+            filesystem.close()
+            database.client.drop_database(database.name)
+            if directory is not None:
+                shutil.rmtree(directory)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline: Dict, current: Dict, threshold: float = REGRESSION_THRESHOLD) -> List[str]:
+    """Lines comparing the ops per second of the cases in both results. Regressions are marked."""
+    before = {(r["case"], r["param"], r["storage"]): r for r in baseline["results"]}
+    lines = []
+    for r in current["results"]:
+        key = (r["case"], r["param"], r["storage"])
+        if key not in before:
+            continue
+        change = r["ops_per_second"] / before[key]["ops_per_second"] - 1
+        mark = "  REGRESSION" if change < -threshold else ""
+        lines.append(f"{' '.join(part for part in key if part)}: {change:+.1%}{mark}")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths of bazaar, writing the results as JSON")
+    parser.add_argument("--storage", action="append", help="mem:// or osfs (a temporary directory), can be repeated")
+    parser.add_argument("--db", default="mongodb://localhost", help="Mongo URI, or mongomock to run without mongod")
+    parser.add_argument("--case", action="append", choices=sorted(BENCHMARKS), help="Only these benchmarks")
+    parser.add_argument("--sizes", type=int, nargs="+", default=PAYLOAD_SIZES, help="Payload sizes in bytes")
+    parser.add_argument("--dir-sizes", type=int, nargs="+", default=DIRECTORY_SIZES, help="Files of the directories")
+    parser.add_argument("--repeat", type=int, default=REPEAT, help="Timed calls of every case")
+    parser.add_argument("--output", help="JSON file for the results, stdout by default")
+    parser.add_argument("--compare", help="JSON results of a previous run (eg another commit) to compare with")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="Slowdown that is a regression")
+    args = parser.parse_args()
+
+    results = []
+    for r in run(args.storage or ["mem://"], args.db, args.case, args.sizes, args.dir_sizes, args.repeat):
+        print(f"{r.case} {r.param} {r.storage}: {r.ops_per_second:.1f} ops/s, p50 {r.p50 * 1000:.3f}ms, "
+              f"p99 {r.p99 * 1000:.3f}ms", file=sys.stderr)
+        results.append(r._asdict())
+    output = {
+        "commit": git_commit(),
+        "date": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "db": args.db,
+        "results": results
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            lines = compare(json.load(f), output, args.threshold)
+        print("\n".join(lines), file=sys.stderr)
+        if any(line.endswith("REGRESSION") for line in lines):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+import hashlib
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional
+
+from fs.base import FS
+from fs.errors import ResourceNotFound
+from pymongo import ReturnDocument
+from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError
+
+from .layout import ObjectLayout
+
+
+# States of a blob: being written, stored, failed to be written, being removed
+PENDING = "pending"
+COMPLETE = "complete"
+FAILED = "failed"
+COLLECTING = "collecting"
+
+# A blob being written by someone else is polled this often, and written again if not complete after the wait
+BLOB_POLL_SECONDS = 0.1
+BLOB_WAIT_SECONDS = 60
+# Tries to reference a blob that is being removed, it should be gone in a moment
+BLOB_COLLECTING_RETRIES = 50
+
+
+class BlobStore(object):
+    """Contents stored once by their digest, with a count of the files referencing them.
+
+    A document per blob: {_id: digest, refs, size, state}. The file documents reference it in their 'blob' field.
+    Removing a blob marks it as collecting before touching the storage, and nobody can reference a collecting blob, so
+    a new upload of the same content never races with its removal.
+    """
+
+    def __init__(self, db: Collection, layout: ObjectLayout):
+        self.db = db
+        self.layout = layout
+
+    @staticmethod
+    def new_hash():
+        """Hash of the digests, it can be fed in chunks."""
+        return hashlib.sha256()
+
+    @classmethod
+    def digest(cls, content: bytes) -> str:
+        h = cls.new_hash()
+        h.update(content)
+        return h.hexdigest()
+
+    def get(self, digest: str) -> Optional[Dict[str, Any]]:
+        """The blob, if it's stored."""
+        return self.db.find_one({"_id": digest, "state": COMPLETE})
+
+    def acquire(self, fs: FS, digest: str, size: int, write: Callable[[], Optional[Dict[str, Any]]]) -> Dict[str, Any]:
+        """Reference a blob, calling write() to store it when it isn't stored yet, and return it.
+
+        write() can return fields to save in the blob, like how it was stored.
+        """
+        for _ in range(BLOB_COLLECTING_RETRIES):
+            try:
+                previous = self.db.find_one_and_update(
+                    {"_id": digest, "state": {"$ne": COLLECTING}},
+                    {
+                        "$inc": {"refs": 1},
+                        "$setOnInsert": {"size": size, "state": PENDING, "created": datetime.utcnow()}
+                    },
+                    upsert=True
+                )
+                break
+            except DuplicateKeyError:
+                # It exists but it's being collected
+                time.sleep(BLOB_POLL_SECONDS)
+        else:
+            raise Exception(f"Blob {digest} is being collected, try again later")
+
+        if previous is None:
+            return self.store(fs, digest, write)
+
+        # Someone else stored it or is storing it. Our reference keeps it from being removed meanwhile
+        deadline = time.monotonic() + BLOB_WAIT_SECONDS
+        while True:
+            blob = self.db.find_one({"_id": digest})
+            if blob["state"] == COMPLETE:
+                return blob
+            claimed = blob["state"] == FAILED and self.db.update_one(
+                {"_id": digest, "state": FAILED}, {"$set": {"state": PENDING}}
+            ).modified_count > 0
+            # After the wait, the other writer may have died
+            if claimed or time.monotonic() > deadline:
+                return self.store(fs, digest, write)
+            time.sleep(BLOB_POLL_SECONDS)
+
+    def store(self, fs: FS, digest: str, write: Callable[[], Optional[Dict[str, Any]]]) -> Dict[str, Any]:
+        try:
+            fields = write() or {}
+        except Exception as e:
+            self.db.update_one({"_id": digest}, {"$set": {"state": FAILED}})
+            self.release(fs, digest)
+            raise e
+        return self.db.find_one_and_update(
+            {"_id": digest}, {"$set": dict(fields, state=COMPLETE)}, return_document=ReturnDocument.AFTER
+        )
+
+    def release(self, fs: FS, digest: str):
+        """Drop a reference to a blob, removing it when nobody else references it."""
+        blob = self.db.find_one_and_update({"_id": digest}, {"$inc": {"refs": -1}}, return_document=ReturnDocument.AFTER)
+        if blob is None or blob["refs"] > 0:
+            return
+        self.collect(fs, blob)
+
+    def collect(self, fs: FS, blob: Dict[str, Any]) -> bool:
+        """Remove a blob nobody references. False if it's referenced again in the meantime.
+
+        A blob left collecting by a crash is removed again.
+        """
+        digest = blob["_id"]
+        if blob["state"] == FAILED:
+            # Never stored
+            return self.db.delete_one({"_id": digest, "refs": {"$lte": 0}, "state": FAILED}).deleted_count > 0
+        r = self.db.update_one(
+            {"_id": digest, "refs": {"$lte": 0}, "state": {"$in": [COMPLETE, COLLECTING]}}, {"$set": {"state": COLLECTING}}
+        )
+        if r.matched_count == 0:
+            # Referenced again in the meantime
+            return False
+        try:
+            self.layout.remove(fs, digest)
+        except ResourceNotFound:
+            pass
+        self.db.delete_one({"_id": digest, "state": COLLECTING})
+        return True
+
+    def collect_orphan(self, fs: FS, digest: str) -> bool:
+        """Remove a stored blob without document, eg after a crash. False if it has a document now."""
+        try:
+            # Nobody can reference it meanwhile
+            self.db.insert_one({"_id": digest, "refs": 0, "state": COLLECTING, "created": datetime.utcnow()})
+        except DuplicateKeyError:
+            return False
+        try:
+            self.layout.remove(fs, digest)
+        except ResourceNotFound:
+            pass
+        self.db.delete_one({"_id": digest, "state": COLLECTING})
+        return True
@@ -0,0 +1,257 @@
+import copy
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from pymongo.collection import Collection
+
+
+logger = logging.getLogger(__name__)
+
+CacheStats = namedtuple('CacheStats', ["hits", "misses", "size"])
+
+# Biggest file kept in memory by default, as a fraction of the memory budget
+CONTENT_CACHE_MAX_ITEM_FRACTION = 4
+# Disk cache files are written with this suffix and renamed when complete
+PARTIAL_SUFFIX = ".partial"
+
+# Wait for changes this long, so the watcher notices when it's stopped
+WATCH_AWAIT_MS = 500
+# Wait before opening the change stream again after an error
+WATCH_RETRY_SECONDS = 5
+
+
+class MetadataCache(object):
+    """LRU of file documents by (namespace, name) whose entries expire after ttl seconds.
+
+    Documents are copied in and out, so callers can't change the cached ones.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        # Documents are also found by _id, the only thing change streams give for deletes
+        self.keys_by_id = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple[str, str]) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self.pop(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(entry[1])
+
+    def set(self, key: Tuple[str, str], document: Dict[str, Any]):
+        with self.lock:
+            self.pop(key)
+            self.entries[key] = (time.monotonic() + self.ttl, copy.deepcopy(document))
+            self.keys_by_id[document["_id"]] = key
+            while len(self.entries) > self.max_size:
+                self.pop(next(iter(self.entries)))
+
+    def invalidate(self, key: Tuple[str, str]):
+        with self.lock:
+            self.pop(key)
+
+    def invalidate_id(self, file_id: Hashable):
+        with self.lock:
+            key = self.keys_by_id.get(file_id)
+            if key is not None:
+                self.pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.keys_by_id.clear()
+
+    def pop(self, key: Tuple[str, str]):
+        """Remove an entry, the lock must be held."""
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.keys_by_id.pop(entry[1]["_id"], None)
+
+    def stats(self) -> CacheStats:
+        return CacheStats(hits=self.hits, misses=self.misses, size=len(self.entries))
+
+
+class ChangeStreamInvalidator(object):
+    """Invalidate the cache with the changes made by other processes, read from a change stream of the collection.
+
+    Change streams need a replica set. When the stream fails some changes may be lost, so the whole cache is cleared.
+    """
+
+    def __init__(self, db: Collection, cache: MetadataCache):
+        self.db = db
+        self.cache = cache
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.watch, name="bazaar-cache-invalidator", daemon=True)
+        self.thread.start()
+
+    def watch(self):
+        while not self.stopped.is_set():
+            try:
+                with self.db.watch(max_await_time_ms=WATCH_AWAIT_MS) as stream:
+                    while stream.alive and not self.stopped.is_set():
+                        change = stream.try_next()
+                        if change is None:
+                            continue
+                        if "documentKey" in change:
+                            self.cache.invalidate_id(change["documentKey"]["_id"])
+                        else:
+                            # The collection was dropped or renamed
+                            self.cache.clear()
+            except Exception:
+                logger.exception("Metadata cache change stream failed, clearing the cache")
+                self.cache.clear()
+                self.stopped.wait(WATCH_RETRY_SECONDS)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class BytesLRU(object):
+    """LRU of (version, value) by key, limited by the sum of the sizes of the values. Not thread safe."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.entries = OrderedDict()
+
+    def get(self, key: str, version: str) -> Any:
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != version:
+            return None
+        self.entries.move_to_end(key)
+        return entry[2]
+
+    def set(self, key: str, version: str, size: int, value: Any) -> List[Any]:
+        """Add an entry, returning the values evicted to make room for it (or replaced by it)."""
+        evicted = self.pop(key)
+        self.entries[key] = (version, size, value)
+        self.used += size
+        while self.used > self.max_bytes:
+            evicted.extend(self.pop(next(iter(self.entries))))
+        return evicted
+
+    def pop(self, key: str) -> List[Any]:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return []
+        self.used -= entry[1]
+        return [entry[2]]
+
+
+class ContentCache(object):
+    """File contents by stored object id, in memory and optionally on a local directory, limited by bytes.
+
+    An entry is only valid for the (updated, size) of the document it was read with, so a file changed by another
+    process is a miss. The directory must be used by a single process.
+    """
+
+    def __init__(self, memory_bytes: int, disk_dir: str = None, disk_bytes: int = 0, max_item_bytes: int = None):
+        self.memory = BytesLRU(memory_bytes)
+        self.max_item_bytes = memory_bytes // CONTENT_CACHE_MAX_ITEM_FRACTION if max_item_bytes is None else max_item_bytes
+        self.disk_dir = disk_dir
+        self.disk = BytesLRU(disk_bytes)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+            self.load_disk()
+
+    @staticmethod
+    def version(updated: datetime, size: int) -> str:
+        return f"{updated:%Y%m%d%H%M%S%f}-{size}"
+
+    def load_disk(self):
+        """Index the files left by a previous run, oldest first so they are evicted first."""
+        entries = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith(PARTIAL_SUFFIX) or "." not in entry.name:
+                os.remove(entry.path)
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            file_id, version = name.split(".", 1)
+            self.remove_files(self.disk.set(file_id, version, size, os.path.join(self.disk_dir, name)))
+
+    def disk_path(self, file_id: str, version: str) -> str:
+        return os.path.join(self.disk_dir, f"{file_id}.{version}")
+
+    def get(self, file_id: str, updated: datetime, size: int) -> Optional[bytes]:
+        version = self.version(updated, size)
+        with self.lock:
+            content = self.memory.get(file_id, version)
+            path = self.disk.get(file_id, version) if content is None else None
+            if content is None and path is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        if content is None:
+            try:
+                with open(path, "rb") as f:
+                    content = f.read()
+            except FileNotFoundError:
+                # Evicted in the meantime
+                return None
+            self.set_memory(file_id, version, content)
+        return content
+
+    def get_path(self, file_id: str, updated: datetime, size: int) -> Optional[str]:
+        """Path of the file in the disk tier, if it's there. Only hits are counted, misses will go through get."""
+        with self.lock:
+            path = self.disk.get(file_id, self.version(updated, size))
+            if path is not None:
+                self.hits += 1
+            return path
+
+    def set(self, file_id: str, updated: datetime, size: int, content: bytes):
+        version = self.version(updated, size)
+        self.set_memory(file_id, version, content)
+        if self.disk_dir is not None and len(content) <= self.disk.max_bytes:
+            path = self.disk_path(file_id, version)
+            with open(path + PARTIAL_SUFFIX, "wb") as f:
+                f.write(content)
+            os.replace(path + PARTIAL_SUFFIX, path)
+            with self.lock:
+                evicted = self.disk.set(file_id, version, len(content), path)
+            self.remove_files(evicted, keep=path)
+
+    def set_memory(self, file_id: str, version: str, content: bytes):
+        if len(content) <= self.max_item_bytes:
+            with self.lock:
+                self.memory.set(file_id, version, len(content), content)
+
+    def invalidate(self, file_id: str):
+        with self.lock:
+            self.memory.pop(file_id)
+            evicted = self.disk.pop(file_id)
+        self.remove_files(evicted)
+
+    @staticmethod
+    def remove_files(paths: List[str], keep: str = None):
+        for path in paths:
+            if path != keep:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def stats(self) -> CacheStats:
+        """Hits, misses and bytes in memory and disk."""
+        return CacheStats(hits=self.hits, misses=self.misses, size=self.memory.used + self.disk.used)
@@ -0,0 +1,281 @@
+import io
+import lzma
+import os
+import zlib
+from abc import ABC, abstractmethod
+from typing import Callable, Iterable, Iterator, Optional
+
+try:
+    import zstandard
+except ImportError:  # Only installed with the "zstd" extra
+    zstandard = None
+
+
+# Codec name to store contents as they are, eg to override the codec of a namespace in a call
+NO_CODEC = "none"
+# Contents smaller than this are not worth compressing
+COMPRESS_MIN_BYTES = 512
+# Bytes of the beginning of a content compressed to see if it's worth compressing it all
+COMPRESS_SAMPLE_BYTES = 64 * 1024
+# The sample must shrink at least this much
+COMPRESS_MIN_SAVING = 0.1
+# Beginning of formats that are compressed already: gzip, zip (and docx, jar...), png, jpeg, gif, zstd, xz, bzip2, 7z,
+# rar, ogg, flac, mkv/webm
+COMPRESSED_MAGIC = (
+    b"\x1f\x8b", b"PK\x03\x04", b"\x89PNG", b"\xff\xd8\xff", b"GIF8", b"\x28\xb5\x2f\xfd", b"\xfd7zXZ\x00", b"BZh",
+    b"7z\xbc\xaf\x27\x1c", b"Rar!", b"OggS", b"fLaC", b"\x1a\x45\xdf\xa3"
+)
+# Bytes read from the storage at once when decompressing
+DECOMPRESS_CHUNK_SIZE = 1024 * 1024
+
+
+class Codec(ABC):
+    """Compression of stored objects: one-shot and incremental, for the streaming methods and open."""
+    name = None
+
+    @abstractmethod
+    def compressor(self):
+        """Object with compress(data) and flush()."""
+
+    @abstractmethod
+    def decompressor(self):
+        """Object with decompress(data)."""
+
+    def compress(self, data: bytes) -> bytes:
+        compressor = self.compressor()
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data: bytes) -> bytes:
+        return b"".join(decompress_chunks([data], self))
+
+
+class ZlibCodec(Codec):
+    name = "zlib"
+
+    def __init__(self, level: int = 6):
+        self.level = level
+
+    def compressor(self):
+        return zlib.compressobj(self.level)
+
+    def decompressor(self):
+        return zlib.decompressobj()
+
+
+class LzmaCodec(Codec):
+    name = "lzma"
+
+    def __init__(self, preset: int = 6):
+        self.preset = preset
+
+    def compressor(self):
+        return lzma.LZMACompressor(preset=self.preset)
+
+    def decompressor(self):
+        return lzma.LZMADecompressor()
+
+
+class ZstdCodec(Codec):
+    name = "zstd"
+
+    def __init__(self, level: int = 3):
+        self.level = level
+
+    def compressor(self):
+        return zstandard.ZstdCompressor(level=self.level).compressobj()
+
+    def decompressor(self):
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+CODECS = {codec.name: codec() for codec in (ZlibCodec, LzmaCodec)}
+if zstandard is not None:
+    CODECS[ZstdCodec.name] = ZstdCodec()
+
+
+def get_codec(name: Optional[str]) -> Optional[Codec]:
+    """Codec by name, None for no compression."""
+    if name is None or name == NO_CODEC:
+        return None
+    if name not in CODECS:
+        if name == ZstdCodec.name:
+            raise ValueError("The zstd codec needs the zstandard package, install bazaar[zstd]")
+        raise ValueError(f"Unknown codec {name}, use one of {', '.join(CODECS)}")
+    return CODECS[name]
+
+
+def is_compressible(sample: bytes) -> bool:
+    """Guess from the beginning of a content if compressing it is worth it: not tiny nor compressed already."""
+    if len(sample) < COMPRESS_MIN_BYTES or sample.startswith(COMPRESSED_MAGIC):
+        return False
+    # mp4/mov and webp have their signature after the size
+    if sample[4:8] == b"ftyp" or (sample[:4] == b"RIFF" and sample[8:12] == b"WEBP"):
+        return False
+    sample = sample[:COMPRESS_SAMPLE_BYTES]
+    return len(zlib.compress(sample, 1)) <= len(sample) * (1 - COMPRESS_MIN_SAVING)
+
+
+def compress_chunks(chunks: Iterable[bytes], codec: Codec) -> Iterator[bytes]:
+    compressor = codec.compressor()
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def decompress_chunks(chunks: Iterable[bytes], codec: Codec) -> Iterator[bytes]:
+    decompressor = codec.decompressor()
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    # Some decompressors keep data until flushed
+    flush = getattr(decompressor, "flush", None)
+    if flush is not None:
+        data = flush()
+        if data:
+            yield data
+
+
+def rechunk(chunks: Iterable[bytes], chunk_size: int) -> Iterator[bytes]:
+    """The same bytes in chunks of chunk_size, the last one can be smaller."""
+    pending = bytearray()
+    for chunk in chunks:
+        pending += chunk
+        while len(pending) >= chunk_size:
+            yield bytes(pending[:chunk_size])
+            del pending[:chunk_size]
+    if pending:
+        yield bytes(pending)
+
+
+class DecompressingReader(io.RawIOBase):
+    """Readable file with the decompressed content of a stored object, read as needed."""
+
+    def __init__(self, raw: io.IOBase, codec: Codec, mode: str = "rb"):
+        self.raw = raw
+        self.mode = mode
+        self.chunks = decompress_chunks(iter(lambda: raw.read(DECOMPRESS_CHUNK_SIZE), b""), codec)
+        self.pending = bytearray()
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self.pending:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.pending += chunk
+        size = min(len(b), len(self.pending))
+        b[:size] = self.pending[:size]
+        del self.pending[:size]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.raw.close()
+        super().close()
+
+
+class CompressingWriter(io.RawIOBase):
+    """Writable file compressing into a stored object. tell() is the position in the uncompressed content.
+
+    With sample, the first COMPRESS_SAMPLE_BYTES are kept until written, and stored as they are with the rest if
+    is_compressible says they aren't worth compressing. on_close is called with the size of the stored object and
+    the codec it has (None if stored as it is) once everything is written.
+    """
+
+    def __init__(
+        self,
+        raw: io.IOBase,
+        codec: Codec,
+        mode: str = "wb",
+        on_close: Callable[[int, Optional[Codec]], None] = None,
+        sample: bool = False
+    ):
+        self.raw = raw
+        self.mode = mode
+        self.codec = codec
+        self.compressor = codec.compressor()
+        self.on_close = on_close
+        self.sample = bytearray() if sample else None
+        self.size = 0
+        self.stored_size = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self.size += len(b)
+        if self.sample is None:
+            self.store(bytes(b))
+            return len(b)
+        self.sample += b
+        if len(self.sample) >= COMPRESS_SAMPLE_BYTES:
+            self.store_sample()
+        return len(b)
+
+    def store(self, data: bytes):
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.raw.write(data)
+        self.stored_size += len(data)
+
+    def store_sample(self):
+        sample, self.sample = bytes(self.sample), None
+        if not is_compressible(sample):
+            self.codec = self.compressor = None
+        self.store(sample)
+
+    def seekable(self) -> bool:
+        # Only to tell the position, text files need it
+        return True
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if (offset, whence) not in {(0, os.SEEK_CUR), (self.size, os.SEEK_SET)}:
+            raise io.UnsupportedOperation("Compressed files can only be written sequentially")
+        return self.size
+
+    def tell(self) -> int:
+        return self.size
+
+    def close(self):
+        if not self.closed:
+            if self.sample is not None:
+                self.store_sample()
+            if self.compressor is not None:
+                data = self.compressor.flush()
+                self.raw.write(data)
+                self.stored_size += len(data)
+            self.raw.close()
+            if self.on_close is not None:
+                self.on_close(self.stored_size, self.codec)
+        super().close()
+
+
+def open_reader(raw: io.IOBase, codec: Codec, mode: str) -> io.IOBase:
+    """Readable file in mode ("r" or "rb") with the content of raw, an object opened in "rb" and compressed with codec."""
+    reader = io.BufferedReader(DecompressingReader(raw, codec))
+    if "b" in mode:
+        return reader
+    text = io.TextIOWrapper(reader)
+    text.mode = mode
+    return text
+
+
+def open_writer(
+    raw: io.IOBase,
+    codec: Codec,
+    mode: str,
+    on_close: Callable[[int, Optional[Codec]], None] = None,
+    sample: bool = False
+) -> io.IOBase:
+    """Writable file in mode ("w", "wb", "x"...) compressing into raw, an object opened in "wb"."""
+    writer = io.BufferedWriter(CompressingWriter(raw, codec, mode, on_close, sample))
+    if "b" in mode:
+        return writer
+    text = io.TextIOWrapper(writer)
+    text.mode = mode
+    return text
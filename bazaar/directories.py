@@ -0,0 +1,111 @@
+import argparse
+from collections import Counter
+from typing import Iterable, Iterator, List
+
+from pymongo import ASCENDING, MongoClient, UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError
+
+
+# Directories written at once by the rebuild
+REBUILD_BATCH_SIZE = 1000
+
+
+class DirectoryIndex(object):
+    """Collection with a document per directory, so listing subdirectories is an indexed query.
+
+    Every directory keeps the count of files below it (at any depth). Adding a file increments the count of all its
+    ancestors, creating them if needed, and removing it decrements them, deleting the ones that get empty.
+    Paths of directories end with a slash, like the sanitized ones: /dir/subdir/ has parent /dir/ and name subdir.
+    """
+
+    def __init__(self, db: Collection):
+        self.db = db
+
+    def ensure_indexes(self):
+        self.db.create_index([("namespace", ASCENDING), ("path", ASCENDING)], unique=True)
+        self.db.create_index([("namespace", ASCENDING), ("parent", ASCENDING), ("name", ASCENDING)])
+
+    @staticmethod
+    def ancestors(name: str) -> List[str]:
+        """Directories of a file name: /a/b/file -> /a/, /a/b/. The root is not included."""
+        parts = name.split("/")[1:-1]
+        return ["/" + "/".join(parts[:i]) + "/" for i in range(1, len(parts) + 1)]
+
+    def count_ancestors(self, names: Iterable[str]) -> Counter:
+        return Counter(directory for name in names for directory in self.ancestors(name))
+
+    def add(self, names: Iterable[str], namespace: str):
+        """Account new files in their directories."""
+        counts = self.count_ancestors(names)
+        if not counts:
+            return
+        operations = [
+            UpdateOne(
+                {"namespace": namespace, "path": path},
+                {
+                    "$inc": {"count": count},
+                    "$setOnInsert": {"parent": path.rsplit("/", 2)[0] + "/", "name": path.rsplit("/", 2)[1]}
+                },
+                upsert=True
+            ) for path, count in counts.items()
+        ]
+        try:
+            self.db.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # Two upserts of the same new directory at the same time, one fails: it exists now, so just repeat those
+            self.db.bulk_write([operations[error["index"]] for error in e.details["writeErrors"]], ordered=False)
+
+    def remove(self, names: Iterable[str], namespace: str):
+        """Account removed files in their directories, deleting the empty ones."""
+        counts = self.count_ancestors(names)
+        if not counts:
+            return
+        self.db.bulk_write([
+            UpdateOne({"namespace": namespace, "path": path}, {"$inc": {"count": -count}})
+            for path, count in counts.items()
+        ], ordered=False)
+        self.db.delete_many({"namespace": namespace, "path": {"$in": list(counts)}, "count": {"$lte": 0}})
+
+    def iter(self, path: str, namespace: str) -> Iterator[str]:
+        """Names of the subdirectories of path, in order."""
+        for d in self.db.find({"namespace": namespace, "parent": path}, {"name": 1}).sort("name", ASCENDING):
+            yield d["name"]
+
+    def rebuild(self, files: Collection, namespace: str = None):
+        """Build the index from scratch out of the files collection, for all namespaces or for one.
+
+        The counts are kept in memory, one per directory, while the files are streamed.
+        """
+        query = {} if namespace is None else {"namespace": namespace}
+        counts = Counter()
+        for file in files.find(query, {"namespace": 1, "name": 1}):
+            for directory in self.ancestors(file["name"]):
+                counts[(file["namespace"], directory)] += 1
+
+        self.db.delete_many(query)
+        batch = []
+        for (file_namespace, path), count in counts.items():
+            parent, name = path.rsplit("/", 2)[:2]
+            batch.append({"namespace": file_namespace, "path": path, "parent": parent + "/", "name": name, "count": count})
+            if len(batch) == REBUILD_BATCH_SIZE:
+                self.db.insert_many(batch)
+                batch = []
+        if batch:
+            self.db.insert_many(batch)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the directory index of a bazaar database")
+    parser.add_argument("db_uri", help="Mongo URI of the bazaar database, eg mongodb://localhost/bazaar")
+    parser.add_argument("--namespace", help="Only rebuild this namespace")
+    args = parser.parse_args()
+
+    database = MongoClient(host=args.db_uri).get_default_database()
+    directories = DirectoryIndex(database.directory)
+    directories.ensure_indexes()
+    directories.rebuild(database.file, args.namespace)
+
+
+if __name__ == '__main__':
+    main()
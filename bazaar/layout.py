@@ -0,0 +1,229 @@
+import argparse
+import hashlib
+import logging
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import IO, Callable, Iterator
+
+from bson import ObjectId
+from fs import open_fs
+from fs.base import FS
+from fs.errors import ResourceNotFound
+from pymongo.collection import Collection
+
+from .registry import mongo_client
+
+
+logger = logging.getLogger(__name__)
+
+# Hex characters of the hash used for every directory level
+SHARD_WIDTH = 2
+# Objects moved at the same time by the migration
+MIGRATION_BATCH_SIZE = 1000
+# Bytes read at once when rewriting an object
+REWRITE_CHUNK_SIZE = 1024 * 1024
+# Only the names of objects stored by bazaar are migrated
+OBJECT_NAME = re.compile(r"^[0-9a-f]{24}$")
+# Objects stored once by their SHA-256 and objects being written, named tmp-<ObjectId>
+BLOB_NAME = re.compile(r"^[0-9a-f]{64}$")
+TMP_NAME = re.compile(r"^tmp-[0-9a-f]{24}$")
+
+
+class ObjectLayout(object):
+    """Where the stored objects are in the storage.
+
+    With shard_levels > 0, objects are spread in directories named after the hash of their id (eg ab/cd/<id> with 2
+    levels), so no directory gets millions of files. Objects stored flat in the root before sharding are still found,
+    after a miss in the sharded path, until they are migrated. Callers that know an object is sharded (the file
+    documents record it) say so, and no flat one is looked for.
+    """
+
+    def __init__(self, shard_levels: int = 0):
+        self.shard_levels = shard_levels
+        self.created_dirs = set()
+        self.lock = threading.Lock()
+
+    def path(self, file_id: str) -> str:
+        if not self.shard_levels:
+            return file_id
+        digest = hashlib.md5(file_id.encode()).hexdigest()
+        levels = [digest[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(self.shard_levels)]
+        return "/".join(levels + [file_id])
+
+    def make_dirs(self, fs: FS, path: str):
+        # Once per directory, storage and process, it's a storage call. Tiers are storages of the same layout
+        key = (id(fs), path.rsplit("/", 1)[0])
+        if key in self.created_dirs:
+            return
+        fs.makedirs(key[1], recreate=True)
+        with self.lock:
+            self.created_dirs.add(key)
+
+    def open(self, fs: FS, file_id: str, mode: str, sharded: bool = False) -> IO:
+        path = self.path(file_id)
+        if path == file_id:
+            return fs.open(path, mode)
+
+        if "r" in mode and "+" not in mode:
+            try:
+                return fs.open(path, mode)
+            except ResourceNotFound:
+                if sharded:
+                    raise
+                return fs.open(file_id, mode)
+        if not (sharded or "w" in mode or "x" in mode) and not fs.exists(path) and fs.exists(file_id):
+            # Appending to or updating a legacy object
+            return fs.open(file_id, mode)
+        self.make_dirs(fs, path)
+        return fs.open(path, mode)
+
+    def remove(self, fs: FS, file_id: str):
+        path = self.path(file_id)
+        try:
+            fs.remove(path)
+        except ResourceNotFound:
+            if path == file_id:
+                raise
+            fs.remove(file_id)
+
+    def remove_flat(self, fs: FS, file_id: str):
+        """Remove the legacy flat object of file_id, if any, once it's written again to its sharded path."""
+        if self.path(file_id) == file_id:
+            return
+        try:
+            fs.remove(file_id)
+        except ResourceNotFound:
+            pass
+
+    def copy(self, fs: FS, src_id: str, dst_id: str, sharded: bool = False):
+        path = self.path(dst_id)
+        if path != dst_id:
+            self.make_dirs(fs, path)
+        src_path = self.path(src_id)
+        try:
+            fs.copy(src_path, path, overwrite=True)
+        except ResourceNotFound:
+            if sharded or src_path == src_id:
+                raise
+            # Copying a legacy object
+            fs.copy(src_id, path, overwrite=True)
+
+    def move(self, fs: FS, src_id: str, dst_id: str):
+        path = self.path(dst_id)
+        if path != dst_id:
+            self.make_dirs(fs, path)
+        fs.move(self.path(src_id), path, overwrite=True)
+
+    def transfer(self, src_fs: FS, dst_fs: FS, file_id: str):
+        """Copy an object to the same path of another storage (eg another tier), by chunks."""
+        path = self.path(file_id)
+        if path != file_id:
+            self.make_dirs(dst_fs, path)
+        with self.open(src_fs, file_id, "rb") as src, dst_fs.open(path, "wb") as dst:
+            for chunk in iter(lambda: src.read(REWRITE_CHUNK_SIZE), b""):
+                dst.write(chunk)
+
+    def rewrite(self, fs: FS, src_id: str, dst_id: str, transform: Callable[[Iterator[bytes]], Iterator[bytes]]):
+        """Write dst with the content of src passed through transform, by chunks. src and dst can be the same."""
+        tmp_id = f"tmp-{ObjectId()}"
+        try:
+            with self.open(fs, src_id, "rb") as src, self.open(fs, tmp_id, "wb") as dst:
+                for chunk in transform(iter(lambda: src.read(REWRITE_CHUNK_SIZE), b"")):
+                    dst.write(chunk)
+            self.move(fs, tmp_id, dst_id)
+        except Exception as e:
+            try:
+                self.remove(fs, tmp_id)
+            except ResourceNotFound:
+                pass
+            raise e
+
+    def exists(self, fs: FS, file_id: str) -> bool:
+        path = self.path(file_id)
+        return fs.exists(path) or (path != file_id and fs.exists(file_id))
+
+    def geturl(self, fs: FS, file_id: str, sharded: bool = False) -> str:
+        path = self.path(file_id)
+        if path != file_id and not sharded and not fs.exists(path) and fs.exists(file_id):
+            path = file_id
+        return fs.geturl(path)
+
+    def migrate_object(self, fs: FS, file_id: str) -> bool:
+        """Move a flat object to its sharded path. If the object was rewritten there, the flat one is just removed."""
+        path = self.path(file_id)
+        try:
+            if fs.exists(path):
+                fs.remove(file_id)
+                return False
+            self.make_dirs(fs, path)
+            fs.move(file_id, path)
+            return True
+        except ResourceNotFound:
+            # Removed or migrated by someone else in the meantime
+            return False
+
+    def migrate(
+        self, fs: FS, workers: int = 1, batch_size: int = MIGRATION_BATCH_SIZE, files: Collection = None
+    ) -> int:
+        """Move every flat object of the storage to the sharded layout, returning how many were moved. With the
+        files collection of bazaar, their documents record that they are sharded now.
+
+        The flat objects left in the root are the pending work, so an interrupted migration continues where it was
+        when run again.
+        """
+        moved = 0
+        objects = self.flat_objects(fs)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                batch = list(islice(objects, batch_size))
+                if not batch:
+                    return moved
+                moved += sum(executor.map(lambda file_id: self.migrate_object(fs, file_id), batch))
+                if files is not None:
+                    # Moved now or by someone else, either way they are in their sharded path
+                    ids = [ObjectId(file_id) for file_id in batch]
+                    files.update_many({"_id": {"$in": ids}}, {"$set": {"sharded": True}})
+                logger.info("%d objects moved to the sharded layout", moved)
+
+    def objects(self, fs: FS) -> Iterator[str]:
+        """Names of every object of the storage, flat or sharded (ids, blobs and temporary ones), as they are listed."""
+        return self.walk(fs, "/", 0)
+
+    def walk(self, fs: FS, directory: str, level: int) -> Iterator[str]:
+        for info in fs.scandir(directory):
+            if info.is_dir:
+                if level < self.shard_levels and len(info.name) == SHARD_WIDTH:
+                    yield from self.walk(fs, f"{directory}{info.name}/", level + 1)
+            elif OBJECT_NAME.match(info.name) or BLOB_NAME.match(info.name) or TMP_NAME.match(info.name):
+                yield info.name
+
+    @staticmethod
+    def flat_objects(fs: FS) -> Iterator[str]:
+        for info in fs.scandir("/"):
+            if not info.is_dir and OBJECT_NAME.match(info.name):
+                yield info.name
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move the objects of a bazaar storage to the sharded layout")
+    parser.add_argument("storage_uri", help="Storage of bazaar, eg /var/bazaar or s3://bucket")
+    parser.add_argument("--levels", type=int, default=2, help="Directory levels, must match FileSystem(shard_levels)")
+    parser.add_argument("--workers", type=int, default=8, help="Objects moved at the same time")
+    parser.add_argument("--db-uri", help="Mongo URI of the bazaar database, to record that the files are sharded")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    mongo = files = None
+    if args.db_uri is not None:
+        mongo = mongo_client(args.db_uri)
+        files = mongo.get_default_database().file
+    with open_fs(args.storage_uri) as fs:
+        ObjectLayout(args.levels).migrate(fs, args.workers, files=files)
+    if mongo is not None:
+        mongo.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,384 @@
+import inspect
+import logging
+import threading
+import time
+from collections import namedtuple
+from functools import wraps
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional
+
+from pymongo import monitoring
+
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the latency histogram of every operation
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Tells measured to take the size from what the method returns
+RESULT = "return"
+
+# A call to a public method. other_seconds is the time out of the database, mostly the storage (and compression)
+Operation = namedtuple('Operation', [
+    "name", "seconds", "db_queries", "db_seconds", "sanitize_seconds", "other_seconds", "bytes_in", "bytes_out", "error"
+])
+
+
+class CallLocal(threading.local):
+    """The operation running in every thread, if it's measured. A missing attribute is slow to look up, so it's
+    never missing.
+    """
+    call = None
+
+
+local = CallLocal()
+
+
+class Call(object):
+    """What an operation running has used so far. The io workers add to it at the same time as its thread."""
+    __slots__ = ("db_queries", "db_seconds", "sanitize_seconds", "lock")
+
+    def __init__(self):
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.sanitize_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def add_query(self, seconds: float):
+        with self.lock:
+            self.db_queries += 1
+            self.db_seconds += seconds
+
+    def add_sanitize(self, seconds: float):
+        with self.lock:
+            self.sanitize_seconds += seconds
+
+
+def current_call() -> Optional[Call]:
+    return local.call
+
+
+class CommandCounter(monitoring.CommandListener):
+    """Count the database round trips of the operation running in the thread. Nothing to do when none is measured."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.count(event)
+
+    def failed(self, event):
+        self.count(event)
+
+    @staticmethod
+    def count(event):
+        call = current_call()
+        if call is not None:
+            call.add_query(event.duration_micros / 1000000)
+
+
+# Listeners are given to the clients when created, this one is shared by all of them. Clients created by the caller
+# (the database given to FileSystem) need it too, not registered globally so nothing else is counted twice
+COMMAND_COUNTER = CommandCounter()
+
+
+class OperationStats(object):
+    """Totals of the calls to an operation."""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.sanitize_seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # Calls by the first bucket they fit in, the last one is for the slower ones
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, operation: Operation):
+        self.calls += 1
+        self.errors += operation.error is not None
+        self.seconds += operation.seconds
+        self.db_queries += operation.db_queries
+        self.db_seconds += operation.db_seconds
+        self.sanitize_seconds += operation.sanitize_seconds
+        self.bytes_in += operation.bytes_in
+        self.bytes_out += operation.bytes_out
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if operation.seconds <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def copy(self) -> "OperationStats":
+        stats = OperationStats()
+        stats.__dict__.update(self.__dict__, buckets=list(self.buckets))
+        return stats
+
+
+class Metrics(object):
+    """Timing and counters of the public methods of a FileSystem, off unless enabled (it can be toggled any time).
+
+    Every call measured is added to the totals by operation and passed to the hooks, callables receiving the
+    Operation (like a LoggingHook). Gauges are functions returning a namedtuple of numbers, like the stats of the
+    caches, exported with the totals by prometheus_text().
+    """
+
+    def __init__(self, enabled: bool = False, hooks: Iterable[Callable[[Operation], Any]] = None):
+        self.enabled = enabled
+        self.hooks = list(hooks or [])
+        self.gauges = {}
+        self.operations = {}
+        self.lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def add_hook(self, hook: Callable[[Operation], Any]):
+        self.hooks.append(hook)
+
+    def add_gauges(self, name: str, gauges: Callable[[], tuple]):
+        self.gauges[name] = gauges
+
+    def record(self, operation: Operation):
+        with self.lock:
+            stats = self.operations.get(operation.name)
+            if stats is None:
+                stats = self.operations[operation.name] = OperationStats()
+            stats.add(operation)
+        for hook in self.hooks:
+            try:
+                hook(operation)
+            except Exception:
+                logger.exception("Metrics hook %r failed", hook)
+
+    def snapshot(self) -> Dict[str, OperationStats]:
+        with self.lock:
+            return {name: stats.copy() for name, stats in self.operations.items()}
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+
+    def prometheus_text(self, prefix: str = "bazaar") -> str:
+        """Totals and gauges in the Prometheus text format, to be served at /metrics."""
+        operations = sorted(self.snapshot().items())
+        lines = [f"# HELP {prefix}_operation_seconds Duration of the calls", f"# TYPE {prefix}_operation_seconds histogram"]
+        for operation, stats in operations:
+            count = 0
+            for bound, calls in zip(LATENCY_BUCKETS, stats.buckets):
+                count += calls
+                lines.append(f'{prefix}_operation_seconds_bucket{{operation="{operation}",le="{bound}"}} {count}')
+            lines.append(f'{prefix}_operation_seconds_bucket{{operation="{operation}",le="+Inf"}} {stats.calls}')
+            lines.append(f'{prefix}_operation_seconds_sum{{operation="{operation}"}} {stats.seconds}')
+            lines.append(f'{prefix}_operation_seconds_count{{operation="{operation}"}} {stats.calls}')
+        for name, help_text in [
+            ("errors", "Calls that raised an exception"),
+            ("db_queries", "Database round trips"),
+            ("db_seconds", "Time waiting for the database"),
+            ("sanitize_seconds", "Time sanitizing paths"),
+            ("bytes_in", "Bytes of content written"),
+            ("bytes_out", "Bytes of content read")
+        ]:
+            lines.append(f"# HELP {prefix}_operation_{name}_total {help_text}")
+            lines.append(f"# TYPE {prefix}_operation_{name}_total counter")
+            lines.extend(
+                f'{prefix}_operation_{name}_total{{operation="{operation}"}} {getattr(stats, name)}'
+                for operation, stats in operations
+            )
+        for gauge_name, gauges in sorted(self.gauges.items()):
+            for field, value in gauges()._asdict().items():
+                lines.append(f"# TYPE {prefix}_{gauge_name}_{field} gauge")
+                lines.append(f"{prefix}_{gauge_name}_{field} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class LoggingHook(object):
+    """Log every operation or, with slow_seconds or max_db_queries, only the slow ones and the ones doing more
+    round trips than that (eg a query by file, when one for all of them would do).
+    """
+
+    def __init__(
+        self,
+        logger: logging.Logger = logger,
+        level: int = logging.INFO,
+        slow_seconds: float = None,
+        max_db_queries: int = None
+    ):
+        self.logger = logger
+        self.level = level
+        self.slow_seconds = slow_seconds
+        self.max_db_queries = max_db_queries
+
+    def __call__(self, operation: Operation):
+        filtered = self.slow_seconds is not None or self.max_db_queries is not None
+        slow = self.slow_seconds is not None and operation.seconds >= self.slow_seconds
+        chatty = self.max_db_queries is not None and operation.db_queries > self.max_db_queries
+        if filtered and not (slow or chatty):
+            return
+        self.logger.log(
+            self.level,
+            "%s took %.6fs: %d queries in %.6fs, %d bytes in, %d bytes out%s",
+            operation.name, operation.seconds, operation.db_queries, operation.db_seconds, operation.bytes_in,
+            operation.bytes_out, f", failed with {operation.error}" if operation.error else ""
+        )
+
+
+def size_of(value: Any) -> int:
+    """Bytes of a content, a size, or the contents of a dict of them (put_many, get_many)."""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, dict):
+        return sum(len(v) for v in value.values() if isinstance(v, (bytes, bytearray, memoryview)))
+    return 0
+
+
+def finished(name: str, call: Call, start: float, error: Optional[str], bytes_in: int, bytes_out: int) -> Operation:
+    seconds = time.perf_counter() - start
+    return Operation(
+        name=name,
+        seconds=seconds,
+        db_queries=call.db_queries,
+        db_seconds=call.db_seconds,
+        sanitize_seconds=call.sanitize_seconds,
+        other_seconds=max(seconds - call.db_seconds - call.sanitize_seconds, 0.0),
+        bytes_in=bytes_in,
+        bytes_out=bytes_out,
+        error=error
+    )
+
+
+class MeasuredStream(object):
+    """Chunks returned by a measured operation, which goes on until they are exhausted, closed or dropped. Their
+    bytes are its bytes_out, and what reading them queries is part of it.
+    """
+
+    def __init__(self, chunks: Iterator[bytes], metrics: "Metrics", name: str, call: Call, start: float):
+        self.chunks = chunks
+        self.metrics = metrics
+        self.name = name
+        self.call = call
+        self.start = start
+        self.size = 0
+        self.done = False
+
+    def __iter__(self) -> "MeasuredStream":
+        return self
+
+    def __next__(self) -> bytes:
+        previous, local.call = local.call, self.call
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.finish(None)
+            raise
+        except Exception as e:
+            self.finish(type(e).__name__)
+            raise e
+        finally:
+            local.call = previous
+        self.size += len(chunk)
+        return chunk
+
+    def close(self):
+        close = getattr(self.chunks, "close", None)
+        if close is not None:
+            close()
+        self.finish(None)
+
+    def __del__(self):
+        self.finish(None)
+
+    def finish(self, error: Optional[str]):
+        if self.done:
+            return
+        self.done = True
+        self.metrics.record(finished(self.name, self.call, self.start, error, 0, 0 if error else self.size))
+
+
+def measured(name: str, bytes_in: str = None, bytes_out: str = None, stream: bool = False):
+    """Measure calls to a method of an object with metrics, unless they are off.
+
+    bytes_in and bytes_out name the argument (or RESULT) with the content written or read. Calls made inside a
+    measured one are part of it. With stream, the method returns an iterator of chunks (or None) and the call lasts
+    until it's consumed, see MeasuredStream.
+    """
+    def decorator(method):
+        signature = inspect.signature(method)
+
+        def size(argument, args, kwargs, result) -> int:
+            if argument is None:
+                return 0
+            if argument == RESULT:
+                return size_of(result)
+            return size_of(signature.bind(*args, **kwargs).arguments.get(argument))
+
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            metrics = self.metrics
+            if not metrics.enabled or current_call() is not None:
+                return method(self, *args, **kwargs)
+
+            call = local.call = Call()
+            result = error = None
+            start = time.perf_counter()
+            try:
+                result = method(self, *args, **kwargs)
+                if stream and result is not None:
+                    return MeasuredStream(result, metrics, name, call, start)
+                return result
+            except Exception as e:
+                error = type(e).__name__
+                raise e
+            finally:
+                local.call = None
+                if not stream or result is None:
+                    metrics.record(finished(
+                        name,
+                        call,
+                        start,
+                        error,
+                        0 if error else size(bytes_in, (self,) + args, kwargs, result),
+                        0 if error else size(bytes_out, (self,) + args, kwargs, result)
+                    ))
+        return wrapper
+    return decorator
+
+
+def measured_sanitize(function: Callable[[str, bool], str]) -> Callable[[str, bool], str]:
+    """Add the time of sanitize_path(path, directory) to the operation running, if any. It's called a lot, so the
+    wrapper takes the arguments as they are.
+    """
+    @wraps(function)
+    def wrapper(path, directory):
+        call = local.call
+        if call is None:
+            return function(path, directory)
+        start = time.perf_counter()
+        try:
+            return function(path, directory)
+        finally:
+            call.add_sanitize(time.perf_counter() - start)
+    return wrapper
+
+
+def in_current_call(function: Callable) -> Callable:
+    """function counting, in any thread, for the operation running in this one (eg in the io workers)."""
+    call = current_call()
+    if call is None:
+        return function
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        local.call = call
+        try:
+            return function(*args, **kwargs)
+        finally:
+            local.call = None
+    return wrapper
@@ -0,0 +1,208 @@
+import io
+import os
+from collections import OrderedDict
+from typing import Optional
+
+from fs.base import FS
+from fs.errors import ResourceNotFound
+
+from .compression import Codec, decompress_chunks
+from .layout import ObjectLayout
+
+try:
+    from botocore.exceptions import ClientError
+except ImportError:  # Only installed with the "s3" extra
+    ClientError = None
+
+
+# Bytes fetched at once by the seekable readers, and how many of those blocks they keep
+RANGE_BLOCK_SIZE = 256 * 1024
+RANGE_CACHED_BLOCKS = 16
+# Bytes read at once from compressed objects, that are decompressed from the beginning
+COMPRESSED_CHUNK_SIZE = 1024 * 1024
+
+
+def has_ranged_get(fs: FS) -> bool:
+    """If fs is an S3 storage (fs-s3fs), whose files download the whole object when opened."""
+    return hasattr(fs, "_bucket_name") and hasattr(fs, "_path_to_key")
+
+
+class ObjectRanges(object):
+    """Byte ranges of a stored object: S3 objects are read with ranged GETs, the rest seeking a file opened once."""
+
+    def __init__(self, fs: FS, layout: ObjectLayout, name: str):
+        self.fs = fs
+        self.layout = layout
+        self.name = name
+        self.file = None
+
+    def read(self, offset: int, length: int) -> bytes:
+        if length <= 0:
+            return b""
+        if has_ranged_get(self.fs):
+            return self.get_range(offset, length)
+        if self.file is None:
+            self.file = self.layout.open(self.fs, self.name, "rb")
+        self.file.seek(offset)
+        return self.file.read(length)
+
+    def get_range(self, offset: int, length: int) -> bytes:
+        path = self.layout.path(self.name)
+        # Objects stored before sharding are in the root
+        for key in dict.fromkeys([path, self.name]):
+            try:
+                response = self.fs.client.get_object(
+                    Bucket=self.fs._bucket_name,
+                    Key=self.fs._path_to_key(key),
+                    Range=f"bytes={offset}-{offset + length - 1}"
+                )
+                return response["Body"].read()
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in {"NoSuchKey", "404"}:
+                    raise
+        raise ResourceNotFound(self.name)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class DecompressedRanges(object):
+    """Byte ranges of the content of a compressed object. It's decompressed from the beginning, so going back
+    starts over, but reading forward continues where the previous range ended.
+    """
+
+    def __init__(self, fs: FS, layout: ObjectLayout, name: str, codec: Codec):
+        self.fs = fs
+        self.layout = layout
+        self.name = name
+        self.codec = codec
+        self.file = None
+        self.chunks = None
+        # Decompressed bytes not read yet, they start at position
+        self.pending = b""
+        self.position = 0
+
+    def restart(self):
+        self.close()
+        self.file = self.layout.open(self.fs, self.name, "rb")
+        self.chunks = decompress_chunks(iter(lambda: self.file.read(COMPRESSED_CHUNK_SIZE), b""), self.codec)
+        self.pending = b""
+        self.position = 0
+
+    def read(self, offset: int, length: int) -> bytes:
+        if self.chunks is None or offset < self.position:
+            self.restart()
+        data = bytearray()
+        while len(data) < length:
+            if not self.pending:
+                self.pending = next(self.chunks, b"")
+                if not self.pending:
+                    break
+            if self.position < offset:
+                used = min(offset - self.position, len(self.pending))
+            else:
+                used = min(length - len(data), len(self.pending))
+                data += self.pending[:used]
+            self.pending = self.pending[used:]
+            self.position += used
+        return bytes(data)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.chunks = None
+
+
+def object_ranges(fs: FS, layout: ObjectLayout, name: str, codec: Optional[Codec] = None):
+    if codec is not None:
+        return DecompressedRanges(fs, layout, name, codec)
+    return ObjectRanges(fs, layout, name)
+
+
+class RangedReader(io.RawIOBase):
+    """Seekable read-only file of a stored object of a known size, fetching blocks of it as they are read.
+
+    Reads of a block or more go straight to the storage, smaller ones use the last blocks fetched.
+    """
+
+    def __init__(self, ranges, size: int, block_size: int = RANGE_BLOCK_SIZE, cached_blocks: int = RANGE_CACHED_BLOCKS):
+        self.ranges = ranges
+        self.size = size
+        self.block_size = block_size
+        self.cached_blocks = cached_blocks
+        self.blocks = OrderedDict()
+        self.position = 0
+        self.mode = "rb"
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            position = offset
+        elif whence == os.SEEK_CUR:
+            position = self.position + offset
+        elif whence == os.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self.position = position
+        return position
+
+    def tell(self) -> int:
+        return self.position
+
+    def readinto(self, b) -> int:
+        length = min(len(b), self.size - self.position)
+        if length <= 0:
+            return 0
+        if length >= self.block_size:
+            data = self.ranges.read(self.position, length)
+        else:
+            index, start = divmod(self.position, self.block_size)
+            data = self.block(index)[start:start + length]
+        b[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def block(self, index: int) -> bytes:
+        block = self.blocks.get(index)
+        if block is not None:
+            self.blocks.move_to_end(index)
+            return block
+        block = self.ranges.read(index * self.block_size, self.block_size)
+        self.blocks[index] = block
+        if len(self.blocks) > self.cached_blocks:
+            self.blocks.popitem(last=False)
+        return block
+
+    def close(self):
+        if not self.closed:
+            self.ranges.close()
+        super().close()
+
+
+def ranged_file(ranges, size: int, mode: str, block_size: int = RANGE_BLOCK_SIZE) -> io.IOBase:
+    """Seekable file in mode ("r" or "rb") reading the ranges as needed."""
+    reader = io.BufferedReader(RangedReader(ranges, size, block_size), buffer_size=min(block_size, io.DEFAULT_BUFFER_SIZE))
+    if "b" in mode:
+        return reader
+    text = io.TextIOWrapper(reader)
+    text.mode = mode
+    return text
+
+
+def read_range(fs: FS, layout: ObjectLayout, name: str, offset: int, length: int, codec: Optional[Codec] = None) -> bytes:
+    ranges = object_ranges(fs, layout, name, codec)
+    try:
+        return ranges.read(offset, length)
+    finally:
+        ranges.close()
@@ -0,0 +1,238 @@
+import argparse
+import logging
+import threading
+import time
+from collections import Counter, namedtuple
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import Dict, Iterator
+
+from bson import ObjectId
+from fs.base import FS
+from fs.errors import ResourceNotFound
+
+from .bazaar import FILE_PENDING, FileSystem
+from .layout import BLOB_NAME, OBJECT_NAME
+
+
+logger = logging.getLogger(__name__)
+
+# Objects and documents checked at once
+RECONCILE_BATCH_SIZE = 1000
+# Anything younger than this may still be being written, so it's never a problem
+RECONCILE_GRACE_SECONDS = 3600
+# Seconds between runs of the background collector
+GC_INTERVAL_SECONDS = 3600
+
+# Stored objects without file or blob document, in the hot storage and in the cold one
+ORPHAN_OBJECT = "orphan_object"
+ORPHAN_COLD_OBJECT = "orphan_cold_object"
+# Committed files whose object is not stored
+DANGLING_FILE = "dangling_file"
+# Files that were never committed, or whose removal was interrupted
+PENDING_FILE = "pending_file"
+# Blobs referenced by no file
+UNREFERENCED_BLOB = "unreferenced_blob"
+
+# name is the object, the blob digest or the path of the file
+Problem = namedtuple('Problem', ["kind", "name", "document"])
+
+
+class Reconciler(object):
+    """Find and fix what crashes leave behind: stored objects without documents and documents without objects.
+
+    The storage listing and the collection (by _id) are both streamed in batches, the objects of every batch are
+    looked up with a single query and the documents of every batch are checked in the io workers of the filesystem,
+    so it's a single pass over each with the memory of a batch. The storage can't be listed in _id order once it's
+    sharded, so checking documents takes a storage call each. Files in the cold tier are checked there, and the cold
+    storage is listed looking for orphan objects too.
+    """
+
+    def __init__(
+        self,
+        filesystem: FileSystem,
+        grace_seconds: float = RECONCILE_GRACE_SECONDS,
+        batch_size: int = RECONCILE_BATCH_SIZE
+    ):
+        self.filesystem = filesystem
+        self.grace_seconds = grace_seconds
+        self.batch_size = batch_size
+
+    def fsck(self) -> Iterator[Problem]:
+        """Problems found, without fixing them."""
+        deadline = datetime.utcnow() - timedelta(seconds=self.grace_seconds)
+        # Ids lower than this one were created before the grace period
+        cutoff = ObjectId.from_datetime(deadline)
+        yield from self.scan_objects(cutoff)
+        if self.filesystem.cold_fs is not None:
+            yield from self.scan_objects(cutoff, self.filesystem.cold_fs, ORPHAN_COLD_OBJECT)
+        yield from self.scan_files(cutoff)
+        yield from self.scan_blobs(deadline)
+
+    def scan_objects(self, cutoff: ObjectId, fs: FS = None, kind: str = ORPHAN_OBJECT) -> Iterator[Problem]:
+        objects = self.filesystem.layout.objects(fs or self.filesystem.fs)
+        while True:
+            batch = list(islice(objects, self.batch_size))
+            if not batch:
+                return
+            if kind == ORPHAN_COLD_OBJECT:
+                # Blobs are never moved to the cold tier
+                batch = [name for name in batch if not BLOB_NAME.match(name)]
+            ids = [ObjectId(name) for name in batch if OBJECT_NAME.match(name)]
+            digests = [name for name in batch if BLOB_NAME.match(name)]
+            files = {d["_id"] for d in self.filesystem.db.find({"_id": {"$in": ids}}, {"_id": 1})} if ids else set()
+            blobs = {b["_id"] for b in self.filesystem.blobs.db.find({"_id": {"$in": digests}}, {"_id": 1})} if digests else set()
+            for name in batch:
+                if BLOB_NAME.match(name):
+                    if name not in blobs:
+                        yield Problem(kind, name, None)
+                    continue
+                # Ids and temporary objects, tmp-<ObjectId>
+                object_id = ObjectId(name[-24:])
+                if object_id < cutoff and (name.startswith("tmp-") or object_id not in files):
+                    yield Problem(kind, name, None)
+
+    def scan_files(self, cutoff: ObjectId) -> Iterator[Problem]:
+        def missing(fs, d):
+            return not self.filesystem.layout.exists(self.filesystem.storage_of(d, fs), str(d["_id"]))
+
+        projection = {"_id": 1, "name": 1, "namespace": 1, "blob": 1, "state": 1, "size": 1, "tier": 1}
+        files = self.filesystem.db.find({}, projection).sort("_id").batch_size(self.batch_size)
+        while True:
+            batch = list(islice(files, self.batch_size))
+            if not batch:
+                return
+            # Deduplicated files are checked with their blobs
+            checked = []
+            for d in batch:
+                if d.get("state") == FILE_PENDING:
+                    if d["_id"] < cutoff:
+                        yield Problem(PENDING_FILE, d["name"], d)
+                elif not d.get("blob"):
+                    checked.append(d)
+            for d, result in zip(checked, self.filesystem.map_io(missing, checked, [0] * len(checked))):
+                if isinstance(result, Exception):
+                    logger.warning("Couldn't check the object of %s: %r", d["name"], result)
+                elif result:
+                    yield Problem(DANGLING_FILE, d["name"], d)
+
+    def scan_blobs(self, deadline: datetime) -> Iterator[Problem]:
+        for blob in self.filesystem.blobs.db.find({"refs": {"$lte": 0}, "created": {"$lt": deadline}}):
+            yield Problem(UNREFERENCED_BLOB, blob["_id"], blob)
+
+    def fix(self, problem: Problem) -> bool:
+        """Clean up a problem, if it's still there. Returns if something was removed."""
+        filesystem = self.filesystem
+        if problem.kind in (ORPHAN_OBJECT, ORPHAN_COLD_OBJECT):
+            if BLOB_NAME.match(problem.name):
+                return filesystem.blobs.collect_orphan(filesystem.fs, problem.name)
+            if not problem.name.startswith("tmp-") and filesystem.db.find_one({"_id": ObjectId(problem.name)}, {"_id": 1}):
+                return False
+            return self.remove_object(problem.name, filesystem.cold_fs if problem.kind == ORPHAN_COLD_OBJECT else None)
+        if problem.kind == UNREFERENCED_BLOB:
+            return filesystem.blobs.collect(filesystem.fs, problem.document)
+
+        d = problem.document
+        if problem.kind == DANGLING_FILE:
+            if filesystem.layout.exists(filesystem.storage_of(d), str(d["_id"])):
+                return False
+            query = {"_id": d["_id"], "state": {"$ne": FILE_PENDING}}
+        else:
+            query = {"_id": d["_id"], "state": FILE_PENDING}
+        # Without the document first, so a crash now leaves an orphan object for the next run
+        if filesystem.db.delete_one(query).deleted_count == 0:
+            return False
+        if d.get("blob"):
+            filesystem.blobs.release(filesystem.fs, d["blob"])
+        elif problem.kind == PENDING_FILE:
+            self.remove_object(str(d["_id"]), filesystem.storage_of(d))
+        # Files are accounted as soon as their documents are created, pending or not
+        filesystem.remove_directories([d["name"]], d["namespace"])
+        filesystem.count_usage(d["namespace"], -1, -d.get("size", 0))
+        filesystem.invalidate(d["name"], d["namespace"], d["_id"])
+        return True
+
+    def remove_object(self, name: str, fs: FS = None) -> bool:
+        try:
+            self.filesystem.layout.remove(fs or self.filesystem.fs, name)
+        except ResourceNotFound:
+            return False
+        return True
+
+    def reconcile(self, max_per_second: float = None) -> Dict[str, int]:
+        """Fix every problem found, at most max_per_second of them. Returns how many of every kind were fixed."""
+        fixed = Counter()
+        started = time.monotonic()
+        for i, problem in enumerate(self.fsck()):
+            if max_per_second:
+                # Spread over time so the database and the storage keep serving everybody else
+                wait = started + i / max_per_second - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+            try:
+                if self.fix(problem):
+                    fixed[problem.kind] += 1
+            except Exception:
+                logger.exception("Couldn't fix %s %s", problem.kind, problem.name)
+        return dict(fixed)
+
+
+class GarbageCollector(object):
+    """Thread reconciling the filesystem every interval seconds, fixing at most max_per_second problems."""
+
+    def __init__(
+        self,
+        filesystem: FileSystem,
+        interval: float = GC_INTERVAL_SECONDS,
+        max_per_second: float = None,
+        grace_seconds: float = RECONCILE_GRACE_SECONDS
+    ):
+        self.reconciler = Reconciler(filesystem, grace_seconds)
+        self.interval = interval
+        self.max_per_second = max_per_second
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="bazaar-gc", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                fixed = self.reconciler.reconcile(self.max_per_second)
+                if fixed:
+                    logger.info("Garbage collected %s", fixed)
+            except Exception:
+                logger.exception("Garbage collection failed")
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find (and fix) orphan objects and dangling files of a bazaar storage")
+    parser.add_argument("storage_uri", help="Storage of bazaar, eg /var/bazaar or s3://bucket")
+    parser.add_argument("db_uri", help="Mongo URI of the bazaar database, eg mongodb://localhost/bazaar")
+    parser.add_argument("--shard-levels", type=int, default=0, help="Must match FileSystem(shard_levels)")
+    parser.add_argument("--cold-storage-uri", help="Cold storage, if files are moved to one, eg s3://bucket")
+    parser.add_argument("--workers", type=int, default=8, help="Objects checked at the same time")
+    parser.add_argument("--grace", type=float, default=RECONCILE_GRACE_SECONDS, help="Seconds a write may take")
+    parser.add_argument("--fix", action="store_true", help="Remove what is found, not only list it")
+    parser.add_argument("--rate", type=float, help="Problems fixed per second at most")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    filesystem = FileSystem(
+        args.storage_uri, args.db_uri, create_indexes=False, io_workers=args.workers, shard_levels=args.shard_levels,
+        cold_storage_uri=args.cold_storage_uri
+    )
+    reconciler = Reconciler(filesystem, args.grace)
+    if args.fix:
+        print(reconciler.reconcile(args.rate))
+    else:
+        for problem in reconciler.fsck():
+            print(problem.kind, problem.name)
+    filesystem.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import os
+import threading
+from typing import Any, Callable, Hashable, Optional
+
+from fs import open_fs
+from fs.base import FS
+from pymongo import MongoClient
+
+from .metrics import COMMAND_COUNTER
+
+
+# Connections kept open by every Mongo client at most, the default of pymongo
+MONGO_MAX_POOL_SIZE = 100
+# Storages whose handles can be used by many threads at once, so by every FileSystem of the process. PyFilesystem2
+# guards the local ones with a lock and fs-s3fs keeps a boto3 client per thread. FTP serializes every call on its
+# single connection, and every mem:// is a filesystem of its own, so they are never shared
+SHARED_STORAGE_SCHEMES = {"osfs", "s3"}
+
+
+class Registry(object):
+    """Resources shared by the FileSystems of the process (Mongo clients, storage handles), by key.
+
+    Every acquire must be paired with a release. The resource is created by the first acquire and closed by the
+    last release, so closing a FileSystem doesn't tear down what others are using. Resources are created without the
+    lock, so a slow one doesn't hold the others.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key: [resource, close, references]
+        self.entries = {}
+
+    def acquire(self, key: Hashable, factory: Callable[[], Any], close: Callable[[Any], Any]) -> Any:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry[2] += 1
+                return entry[0]
+        resource = factory()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = [resource, close, 0]
+            entry[2] += 1
+        if entry[0] is not resource:
+            # Created by someone else meanwhile
+            close(resource)
+        return entry[0]
+
+    def release(self, key: Hashable):
+        with self.lock:
+            entry = self.entries[key]
+            entry[2] -= 1
+            if entry[2] > 0:
+                return
+            del self.entries[key]
+        entry[1](entry[0])
+
+    def references(self, key: Hashable) -> int:
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry[2] if entry is not None else 0
+
+
+REGISTRY = Registry()
+
+
+def mongo_key(db_uri: Optional[str], max_pool_size: int) -> tuple:
+    # Clients can't be used after a fork, a child process gets its own. Release with the key of the acquire, it's
+    # another one in a forked child
+    return "mongo", os.getpid(), db_uri, max_pool_size
+
+
+def storage_key(storage_uri: str) -> tuple:
+    return "storage", os.getpid(), storage_uri
+
+
+def mongo_client(db_uri: Optional[str], max_pool_size: int = MONGO_MAX_POOL_SIZE) -> MongoClient:
+    """Client connecting at its first query, not when created. The round trips of every operation are counted from
+    its command events.
+    """
+    options = {"maxPoolSize": max_pool_size, "connect": False, "event_listeners": [COMMAND_COUNTER]}
+    if db_uri is None:
+        return MongoClient(**options)
+    return MongoClient(host=db_uri, **options)
+
+
+def storage_scheme(storage_uri: str) -> str:
+    # Paths are local directories
+    return storage_uri.split("://", 1)[0] if "://" in storage_uri else "osfs"
+
+
+def is_shareable(storage_uri: str) -> bool:
+    return storage_scheme(storage_uri) in SHARED_STORAGE_SCHEMES
+
+
+def acquire_mongo(key: tuple) -> MongoClient:
+    """The client of the process for a mongo_key, release it with release_mongo and the same key."""
+    _, _, db_uri, max_pool_size = key
+    return REGISTRY.acquire(key, lambda: mongo_client(db_uri, max_pool_size), MongoClient.close)
+
+
+def release_mongo(key: tuple):
+    REGISTRY.release(key)
+
+
+def acquire_storage(key: tuple) -> FS:
+    """The storage handle of the process for a storage_key if it can be shared, otherwise a new one. Release it
+    with release_storage and the same key.
+    """
+    storage_uri = key[2]
+    if not is_shareable(storage_uri):
+        return open_fs(storage_uri)
+    return REGISTRY.acquire(key, lambda: open_fs(storage_uri), FS.close)
+
+
+def release_storage(key: tuple, fs: FS):
+    if not is_shareable(key[2]):
+        fs.close()
+        return
+    REGISTRY.release(key)
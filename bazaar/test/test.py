@@ -1,16 +1,47 @@
+import asyncio
+import functools
 import io
 import os
 import shutil
+import threading
+import time
 import unittest
+import unittest.mock
+from datetime import datetime, timedelta
 
+from bson import ObjectId
 from pymongo import MongoClient
 
 try:
-    from bazaar.bazaar import BufferWrapper, FileSystem
+    from bazaar.bazaar import TIER_COLD, BufferWrapper, FileSystem
+    from bazaar.cache import ContentCache, MetadataCache
+    from bazaar.compression import Codec, get_codec, is_compressible
+    from bazaar.bench import compare, run
+    from bazaar.metrics import COMMAND_COUNTER, Call, LoggingHook
+    from bazaar.reconcile import (
+        DANGLING_FILE, ORPHAN_COLD_OBJECT, ORPHAN_OBJECT, PENDING_FILE, UNREFERENCED_BLOB, GarbageCollector, Reconciler
+    )
+    from bazaar.registry import MONGO_MAX_POOL_SIZE, REGISTRY, Registry, mongo_key
+    from bazaar.tiering import MOVED, RELEASED, TierMover
 except ImportError:
     import sys
     sys.path.insert(1, '.')
-    from bazaar.bazaar import BufferWrapper, FileSystem
+    from bazaar.bazaar import TIER_COLD, BufferWrapper, FileSystem
+    from bazaar.cache import ContentCache, MetadataCache
+    from bazaar.compression import Codec, get_codec, is_compressible
+    from bazaar.bench import compare, run
+    from bazaar.metrics import COMMAND_COUNTER, Call, LoggingHook
+    from bazaar.reconcile import (
+        DANGLING_FILE, ORPHAN_COLD_OBJECT, ORPHAN_OBJECT, PENDING_FILE, UNREFERENCED_BLOB, GarbageCollector, Reconciler
+    )
+    from bazaar.registry import MONGO_MAX_POOL_SIZE, REGISTRY, Registry, mongo_key
+    from bazaar.tiering import MOVED, RELEASED, TierMover
+
+
+try:
+    from bazaar.aio import AsyncFileSystem
+except ImportError:  # motor is only installed with the "async" extra
+    AsyncFileSystem = None
 
 
 TEST_MONGO_URI = "mongodb://localhost/bazaar_test"
@@ -42,6 +73,224 @@ class TestFileSystem(unittest.TestCase):
         # Same file with other namespace
         self.assertIsNone(self.fs.get(path=path, namespace="other"))
 
+    def test_put_get_stream(self):
+        path = "/stream"
+        self.assertEqual(12, self.fs.put_stream(path, io.BytesIO(b"Hello world!"), chunk_size=5))
+        self.assertEqual([b"Hello", b" worl", b"d!"], list(self.fs.get_stream(path, chunk_size=5)))
+        self.assertEqual(12, self.fs.attrs(path).size)
+
+        # Overwrite with an iterable of chunks
+        self.assertEqual(4, self.fs.put_stream(path, [b"ab", b"cd"]))
+        self.assertEqual(b"abcd", self.fs.get(path))
+        self.assertEqual(4, self.fs.attrs(path).size)
+
+        self.assertIsNone(self.fs.get_stream("/notexists"))
+
+    def test_put_stream_rollback(self):
+        def broken_content():
+            yield b"ab"
+            raise IOError("Broken stream")
+
+        # A new file is removed
+        with self.assertRaises(IOError):
+            self.fs.put_stream("/new", broken_content())
+        self.assertFalse(self.fs.exists("/new"))
+
+        # An existing file keeps its metadata
+        self.fs.put("/existing", b"abcd")
+        updated = self.fs.attrs("/existing").updated
+        with self.assertRaises(IOError):
+            self.fs.put_stream("/existing", broken_content())
+        self.assertEqual(4, self.fs.attrs("/existing").size)
+        self.assertEqual(updated, self.fs.attrs("/existing").updated)
+
+    def test_many(self):
+        self.fs.put("/existing", b"old")
+        errors = self.fs.put_many({"/existing": b"new", "/dir/new": b"a", "other": b"bc"})
+        self.assertEqual({"/existing": None, "/dir/new": None, "other": None}, errors)
+        self.assertEqual(3, self.fs.attrs("/existing").size)
+
+        contents = self.fs.get_many(["/existing", "/dir/new", "other", "/notexists"])
+        self.assertEqual({"/existing": b"new", "/dir/new": b"a", "other": b"bc", "/notexists": None}, contents)
+
+        self.assertEqual({"/dir/new": True, "/notexists": False}, self.fs.exists_many(["/dir/new", "/notexists"]))
+
+        removed = self.fs.remove_many(["/existing", "/dir/new", "/notexists"])
+        self.assertTrue(removed["/existing"])
+        self.assertTrue(removed["/dir/new"])
+        self.assertIsInstance(removed["/notexists"], ValueError)
+        self.assertEqual({"/existing": False, "/dir/new": False, "other": True},
+                         self.fs.exists_many(["/existing", "/dir/new", "other"]))
+
+    def test_put_many_rollback(self):
+        self.fs.put("/existing", b"old")
+        updated = self.fs.attrs("/existing").updated
+        # The storage can't write the blobs, every file must be rolled back. Not closing it, it's shared
+        failing = unittest.mock.Mock(side_effect=OSError("storage down"))
+        with unittest.mock.patch.multiple(self.fs.fs, open=failing, openbin=failing):
+            errors = self.fs.put_many({"/existing": b"new content", "/new": b"a"})
+        self.assertIsNotNone(errors["/existing"])
+        self.assertIsNotNone(errors["/new"])
+        self.assertFalse(self.fs.exists("/new"))
+        self.assertEqual(3, self.fs.attrs("/existing").size)
+        self.assertEqual(updated, self.fs.attrs("/existing").updated)
+
+        # Files written by old versions don't have a size
+        self.fs.db.update_one({"name": "/existing"}, {"$unset": {"size": ""}})
+        with unittest.mock.patch.multiple(self.fs.fs, open=failing, openbin=failing):
+            errors = self.fs.put_many({"/existing": b"new content"})
+        self.assertIsNotNone(errors["/existing"])
+        self.assertEqual(b"old", self.fs.get("/existing"))
+        # Back to what the usage counters have
+        self.fs.db.update_one({"name": "/existing"}, {"$set": {"size": 3}})
+
+    def test_get_range(self):
+        self.fs.put("/file", b"0123456789" * 100)
+        self.assertEqual(b"234", self.fs.get_range("/file", 2, 3))
+        self.assertEqual(b"89", self.fs.get_range("/file", 998))
+        self.assertEqual(b"789", self.fs.get_range("/file", -3))
+        self.assertEqual(b"9", self.fs.get_range("/file", 999, 100))
+        self.assertEqual(b"", self.fs.get_range("/file", 2000, 3))
+        self.assertIsNone(self.fs.get_range("/notexists", 0, 3))
+
+    def test_open_ranged(self):
+        content = bytes(range(256)) * 40
+        self.fs.put("/file", content)
+        with self.fs.open_ranged("/file", block_size=100) as f:
+            self.assertEqual(content[:10], f.read(10))
+            f.seek(5000)
+            self.assertEqual(content[5000:5300], f.read(300))
+            self.assertEqual(5300, f.tell())
+            f.seek(-10, os.SEEK_END)
+            self.assertEqual(content[-10:], f.read())
+            f.seek(20)
+            self.assertEqual(content[20:], f.read())
+        self.fs.put("/text", b"first line\nsecond line\n")
+        with self.fs.open_ranged("/text", "r") as f:
+            self.assertEqual(["first line\n", "second line\n"], f.readlines())
+        with self.assertRaises(FileNotFoundError):
+            self.fs.open_ranged("/notexists")
+        with self.assertRaises(ValueError):
+            self.fs.open_ranged("/file", "wb")
+
+    def test_get_buffer(self):
+        content = b"0123456789" * 100
+        self.fs.put("/file", content)
+        buffer = self.fs.get_buffer("/file")
+        self.assertIsInstance(buffer, memoryview)
+        self.assertEqual(content, bytes(buffer))
+        self.assertEqual(b"234", buffer[2:5].tobytes())
+        self.fs.put("/empty", b"")
+        self.assertEqual(b"", bytes(self.fs.get_buffer("/empty")))
+        self.assertIsNone(self.fs.get_buffer("/notexists"))
+
+    def test_open_mmap(self):
+        content = b"0123456789" * 100
+        self.fs.put("/file", content)
+        with self.fs.open_mmap("/file") as mapped:
+            self.assertEqual(content, mapped[:])
+            self.assertEqual(10, mapped.find(b"0", 1))
+        with self.assertRaises(FileNotFoundError):
+            self.fs.open_mmap("/notexists")
+
+    def test_open_mmap_not_local(self):
+        fs = FileSystem("mem://", db_uri=TEST_MONGO_URI)
+        fs.put("/file", b"Hello world!")
+        with fs.open_mmap("/file") as mapped:
+            self.assertEqual(b"world", mapped[6:11])
+        self.assertEqual(b"Hello", fs.get_buffer("/file")[:5].tobytes())
+        fs.remove("/file")
+        fs.close()
+
+    def test_copy_tree(self):
+        self.fs.put("/dir/a", b"a")
+        self.fs.put("/dir/sub/b", b"b")
+        self.fs.put("/dirx", b"x")
+        self.assertEqual(2, self.fs.copy_tree("/dir", "/copy"))
+        self.assertEqual(b"a", self.fs.get("/copy/a"))
+        self.assertEqual(b"b", self.fs.get("/copy/sub/b"))
+        self.assertEqual(b"a", self.fs.get("/dir/a"))
+        self.assertIsNone(self.fs.get("/copyx"))
+
+        # Copies are independent
+        self.fs.put("/copy/a", b"c")
+        self.assertEqual(b"a", self.fs.get("/dir/a"))
+
+        self.assertEqual(2, self.fs.copy_tree("/dir", "/dir", to_namespace="other"))
+        self.assertEqual(b"b", self.fs.get("/dir/sub/b", namespace="other"))
+
+        with self.assertRaises(ValueError):
+            self.fs.copy_tree("/dir", "/copy")
+        with self.assertRaises(ValueError):
+            self.fs.copy_tree("/dir", "/dir/sub/inside")
+
+    def test_move_tree(self):
+        self.fs.put("/dir/sub/a", b"a")
+        self.fs.put("/copy/a", b"a")
+        # Names are rewritten by the database with $substrCP
+        self.assertEqual(1, self.fs.move_tree("/dir", "/moved"))
+        self.assertEqual(b"a", self.fs.get("/moved/sub/a"))
+        self.assertFalse(self.fs.exists("/dir/sub/a"))
+        with self.assertRaises(ValueError):
+            self.fs.move_tree("/moved", "/copy")
+
+    def test_change_namespace_tree(self):
+        self.fs.put("/dir/a", b"a")
+        self.fs.put("/dir/sub/b", b"b")
+        self.fs.put("/other", b"o")
+        self.assertEqual(2, self.fs.change_namespace_tree("/dir", from_namespace="", to_namespace="other"))
+        self.assertFalse(self.fs.exists("/dir/a"))
+        self.assertEqual(b"b", self.fs.get("/dir/sub/b", namespace="other"))
+        self.assertTrue(self.fs.exists("/other"))
+        with self.assertRaises(ValueError):
+            self.fs.change_namespace_tree("/dir", from_namespace="other", to_namespace="other")
+
+    def test_remove_tree(self):
+        self.fs.put("/dir/a", b"a")
+        self.fs.put("/dir/sub/b", b"b")
+        self.fs.put("/dirx", b"x")
+        self.assertEqual(2, self.fs.remove_tree("/dir"))
+        self.assertFalse(self.fs.exists("/dir/a"))
+        self.assertFalse(self.fs.exists("/dir/sub/b"))
+        self.assertTrue(self.fs.exists("/dirx"))
+        self.assertEqual(0, self.fs.remove_tree("/dir"))
+
+    def test_du(self):
+        self.fs.put("/dir/a", b"a" * 10)
+        self.fs.put("/dir/sub/b", b"b" * 5)
+        self.fs.put("/dirx", b"x")
+        usage = self.fs.du("/dir")
+        self.assertEqual((2, 15), (usage.files, usage.size))
+        self.assertEqual(3, self.fs.du("/").files)
+        self.assertEqual((0, 0, 0), self.fs.du("/empty"))
+
+    def test_stats(self):
+        self.fs.put("/dir/a", b"a" * 10)
+        self.fs.put("/dir/sub/b", b"b" * 5)
+        self.fs.put("/dir/sub/deeper/c", b"c")
+        self.fs.put("/root", b"r" * 2)
+        self.fs.put("/other/d", b"d" * 3, namespace="other")
+        self.assertEqual([("", 4, 18), ("other", 1, 3)], [(u.namespace, u.files, u.size) for u in self.fs.stats()])
+        self.assertEqual(
+            [("", "/", 1, 2), ("", "/dir/", 3, 16), ("other", "/other/", 1, 3)],
+            [(u.namespace, u.directory, u.files, u.size) for u in self.fs.stats(group_by_depth=1)]
+        )
+        self.assertEqual(
+            [("/dir/", 1, 10), ("/dir/sub/", 2, 6)],
+            [(u.directory, u.files, u.size) for u in self.fs.stats("", group_by_depth=2) if u.directory != "/"]
+        )
+        self.assertEqual([], self.fs.stats("empty"))
+
+    def test_sanitize_path(self):
+        self.assertEqual("/dir11/prettyfile", self.fs.sanitize_path("/dir11/./prettyfile", False))
+        self.assertEqual("/a/c", self.fs.sanitize_path("//a/b/..//c/", False))
+        self.assertEqual("/b", self.fs.sanitize_path("/../../b", False))
+        self.assertEqual("/a/b/", self.fs.sanitize_path("/a/b", True))
+        self.assertEqual("/", self.fs.sanitize_path("/", True))
+        # Nothing to do with the working directory
+        self.assertEqual("/relative", self.fs.sanitize_path("relative", False))
+        self.assertEqual("/", self.fs.sanitize_path(".", True))
+
     def test_not_exist(self):
         # Same file with other namespace
         self.assertIsNone(self.fs.get(path="/notexists"))
@@ -97,6 +346,50 @@ class TestFileSystem(unittest.TestCase):
         self.assertListEqual(["file"], self.fs.list("/this/is/test"))
 
         
+    def test_list_prefix_bounds(self):
+        # '-' sorts before '/' and '0' right after it, both must be out of the /dir1/ range
+        self.fs.put(path="/dir1-a/file", content=b"a")
+        self.fs.put(path="/dir10/file", content=b"a")
+        self.fs.put(path="/dir1/file", content=b"a")
+        self.assertListEqual(["file"], self.fs.list("/dir1"))
+        self.assertListEqual([], self.fs.list_dirs("/dir1"))
+
+    def test_iter_list(self):
+        for name in ["c", "a", "b", "dir/d"]:
+            self.fs.put(path="/" + name, content=b"a")
+        self.assertListEqual(["a", "b", "c"], list(self.fs.iter_list("/", batch_size=2)))
+
+        page = self.fs.list_page("/", limit=2)
+        self.assertEqual(["a", "b"], page.names)
+        page = self.fs.list_page("/", limit=2, after=page.next)
+        self.assertEqual(["c"], page.names)
+        self.assertIsNone(page.next)
+        with self.assertRaises(ValueError):
+            self.fs.list_page("/", limit=0)
+
+    def test_iter_dirs(self):
+        for name in ["/dir2/a", "/dir1/a", "/dir1/sub/b", "/dir1-x/c", "/dir1/b", "/file"]:
+            self.fs.put(path=name, content=b"a")
+        self.assertListEqual(["dir1", "dir1-x", "dir2"], sorted(self.fs.iter_dirs("/")))
+        self.assertListEqual(["sub"], list(self.fs.iter_dirs("/dir1")))
+        self.assertListEqual([], list(self.fs.iter_dirs("/dir2")))
+
+    def test_indexes(self):
+        self.fs.ensure_indexes()
+        index_keys = [index["key"] for index in self.fs.db.index_information().values()]
+        self.assertIn([("namespace", 1), ("name", 1)], index_keys)
+
+    def test_explain(self):
+        self.fs.ensure_indexes()
+        self.fs.ensure_extras_index("status")
+        self.fs.put(path="/dir1/file", content=b"a")
+        plans = self.fs.explain(extras={"status": "pending"})
+        self.assertIn("list_dirs", plans)
+        self.assertIn("find", plans)
+        for method, plan in plans.items():
+            self.assertIsNotNone(plan.index, method)
+            self.assertNotIn("COLLSCAN", plan.stages, method)
+
     def test_exists(self):
         namespace = "test"
         self.assertFalse(self.fs.exists("/my_file.txt", namespace=namespace))
@@ -145,6 +438,40 @@ class TestFileSystem(unittest.TestCase):
         self.fs.set_extras(path="/first", extras={"foo": "bar"})
         self.assertEqual({"foo": "bar"}, self.fs.get_extras(path="/first"))
 
+    def test_find(self):
+        for path, extras in [
+            ("/a", {"status": "pending", "tries": 1}),
+            ("/dir/b", {"status": "pending", "tries": 3}),
+            ("/dir/c", {"status": "done", "meta": {"kind": "image"}}),
+            ("/d", None)
+        ]:
+            self.fs.put(path, b"abc")
+            if extras is not None:
+                self.fs.set_extras(path, extras)
+        self.fs.put("/e", b"a", namespace="other")
+        self.fs.set_extras("/e", {"status": "pending"}, namespace="other")
+
+        found = list(self.fs.find({"status": "pending"}))
+        self.assertCountEqual(["/a", "/dir/b"], [f.name for f in found])
+        self.assertEqual(3, found[0].size)
+        self.assertEqual("", found[0].namespace)
+        self.assertEqual(["/dir/b"], [f.name for f in self.fs.find({"status": "pending"}, path_prefix="dir")])
+        self.assertEqual(["/a"], [f.name for f in self.fs.find({"status": "pending", "tries": {"$lt": 3}})])
+        self.assertEqual(["/dir/c"], [f.name for f in self.fs.find({"meta.kind": "image"})])
+        self.assertEqual(["/e"], [f.name for f in self.fs.find({"status": "pending"}, namespace="other")])
+        self.assertEqual([], list(self.fs.find({"status": "unknown"})))
+        self.assertEqual(4, len(list(self.fs.find({}, batch_size=2))))
+        with self.assertRaises(ValueError):
+            list(self.fs.find({"$where": "true"}))
+
+    def test_ensure_extras_index(self):
+        name = self.fs.ensure_extras_index("status")
+        self.assertEqual([("namespace", 1), ("extras.status", 1)], self.fs.db.index_information()[name]["key"])
+        # Already there
+        self.assertEqual(name, self.fs.ensure_extras_index("status"))
+        with self.assertRaises(ValueError):
+            self.fs.ensure_extras_index("")
+
 
     def test_change_namespace(self):
         namespace = "test_1"
@@ -191,6 +518,16 @@ class TestFileSystem(unittest.TestCase):
         with self.fs.open(path, 'r', namespace=namespace) as hello_world_file:
             self.assertEqual(hello_world_file.read(), 'Hello world!')
 
+    def test_open_copyfileobj(self):
+        content = os.urandom(100000)
+        with self.fs.open("/copy", "wb") as f:
+            shutil.copyfileobj(io.BytesIO(content), f)
+        self.assertEqual(len(content), self.fs.attrs("/copy").size)
+        with self.fs.open("/copy", "rb") as f:
+            buffer = bytearray(len(content))
+            self.assertEqual(len(content), f.readinto(buffer))
+        self.assertEqual(content, buffer)
+
     def test_url_inexistent_file(self):
         with self.assertRaises(FileNotFoundError) as context:
             self.fs.get_url('INEXISTENT-FILE.txt', namespace='INEXISTENT-NAMESPACE')
@@ -215,6 +552,1098 @@ class TestFileSystem(unittest.TestCase):
         self.fs.put(path, b'Hello world!', namespace=namespace)
         return path, namespace
 
+    def test_rename_to_existing(self):
+        self.fs.put("/a", b"a")
+        self.fs.put("/b", b"b")
+        self.assertFalse(self.fs.rename("/a", "/b"))
+        self.assertEqual([b"a", b"b"], [self.fs.get("/a"), self.fs.get("/b")])
+        self.assertFalse(self.fs.rename("/missing", "/c"))
+        self.assertTrue(self.fs.rename("/a", "/c"))
+
+    def test_duplicated_paths(self):
+        # Written before the unique index
+        self.fs.db.drop()
+        self.fs.db.insert_many([{"name": "/a", "namespace": ""}, {"name": "/a", "namespace": ""}])
+        with self.assertLogs("bazaar.bazaar", "ERROR") as logs:
+            FileSystem("/tmp/test", db_uri=TEST_MONGO_URI).close()
+        self.assertIn("create_indexes=False", logs.output[0])
+        self.fs.db.drop()
+
+
+class TestFileSystemIOWorkers(TestFileSystem):
+    """Same tests, with the storage calls running in io workers."""
+
+    def setUp(self):
+        super().setUp()
+        self.fs.close()
+        self.fs = FileSystem("/tmp/test", db_uri=TEST_MONGO_URI, io_workers=4, max_in_flight_bytes=4)
+
+    def tearDown(self):
+        self.fs.close()
+
+    def test_stream_partial_read(self):
+        self.fs.put_stream("/stream", io.BytesIO(b"Hello world!"), chunk_size=2)
+        chunks = self.fs.get_stream("/stream", chunk_size=2)
+        self.assertEqual(b"He", next(chunks))
+        # The worker stops prefetching when the reader is gone
+        chunks.close()
+        self.assertEqual(b"Hello world!", b"".join(self.fs.get_stream("/stream", chunk_size=2)))
+
+    def test_stream_copy_single_worker(self):
+        self.fs.close()
+        self.fs = FileSystem("/tmp/test", db_uri=TEST_MONGO_URI, io_workers=1, max_in_flight_bytes=4)
+        self.fs.put("/src", b"Hello world!")
+        # Both prefetch, one consuming the other
+        copy = threading.Thread(target=lambda: self.fs.put_stream("/dst", self.fs.get_stream("/src", chunk_size=2)))
+        copy.start()
+        copy.join(timeout=10)
+        self.assertFalse(copy.is_alive())
+        self.assertEqual(b"Hello world!", self.fs.get("/dst"))
+
+
+class TestFileSystemMetadataCache(TestFileSystem):
+    """Same tests, with the metadata cache."""
+
+    def setUp(self):
+        super().setUp()
+        self.fs.close()
+        self.fs = FileSystem("/tmp/test", db_uri=TEST_MONGO_URI, metadata_cache_size=100)
+
+    def test_cache_hits(self):
+        self.fs.put("/file", b"a")
+        self.assertTrue(self.fs.exists("/file"))
+        self.assertEqual(b"a", self.fs.get("/file"))
+        self.assertEqual(1, self.fs.attrs("/file").size)
+        stats = self.fs.metadata_cache.stats()
+        self.assertEqual((2, 1, 1), (stats.hits, stats.misses, stats.size))
+
+        # Changes made by someone else are not seen until the entry expires
+        self.fs.db.update_one({"name": "/file"}, {"$set": {"size": 10}})
+        self.assertEqual(1, self.fs.attrs("/file").size)
+
+    def test_cache_invalidation(self):
+        self.fs.put("/file", b"a")
+        self.assertEqual(1, self.fs.attrs("/file").size)
+        self.fs.put("/file", b"abc")
+        self.assertEqual(3, self.fs.attrs("/file").size)
+
+        self.fs.set_extras("/file", {"foo": "bar"})
+        self.assertEqual({"foo": "bar"}, self.fs.get_extras("/file"))
+
+        with self.fs.open("/file", "wb") as f:
+            f.write(b"abcde")
+        self.assertEqual(5, self.fs.attrs("/file").size)
+
+        self.fs.rename("/file", "/renamed")
+        self.assertFalse(self.fs.exists("/file"))
+        self.fs.change_namespace("/renamed", from_namespace="", to_namespace="other")
+        self.assertFalse(self.fs.exists("/renamed"))
+        self.fs.remove("/renamed", namespace="other")
+        self.assertFalse(self.fs.exists("/renamed", namespace="other"))
+
+
+
+class TestFileSystemContentCache(TestFileSystem):
+    """Same tests, with the content cache in memory and disk."""
+
+    cache_dir = "/tmp/test_cache"
+
+    def setUp(self):
+        super().setUp()
+        self.fs.close()
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+        self.fs = FileSystem(
+            "/tmp/test", db_uri=TEST_MONGO_URI, content_cache_bytes=100, content_cache_dir=self.cache_dir,
+            content_cache_dir_bytes=1000
+        )
+
+    def test_content_cache(self):
+        self.fs.put("/file", b"a")
+        file_id = str(self.fs.db.find_one({"name": "/file"})["_id"])
+        self.assertEqual(b"a", self.fs.get("/file"))
+        # Change the stored file behind bazaar's back, the cached content is returned
+        self.fs.fs.writebytes(file_id, b"b")
+        self.assertEqual(b"a", self.fs.get("/file"))
+        with self.fs.open("/file", "rb") as f:
+            self.assertEqual(b"a", f.read())
+        self.assertEqual(2, self.fs.content_cache.stats().hits)
+
+        self.fs.put("/file", b"c")
+        self.assertEqual(b"c", self.fs.get("/file"))
+        with self.fs.open("/file", "wb") as f:
+            f.write(b"d")
+        self.assertEqual(b"d", self.fs.get("/file"))
+
+    def test_content_cache_big_file(self):
+        # Bigger than the memory tier, only in the disk one
+        self.fs.put("/file", b"a" * 500)
+        self.assertEqual(b"a" * 500, self.fs.get("/file"))
+        self.assertEqual(500, self.fs.content_cache.stats().size)
+        with self.fs.open("/file", "rb") as f:
+            self.assertEqual(b"a" * 500, f.read())
+        self.fs.remove("/file")
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+
+class TestContentCache(unittest.TestCase):
+    cache_dir = "/tmp/test_cache"
+
+    def setUp(self):
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    def test_eviction_by_bytes(self):
+        cache = ContentCache(memory_bytes=10, max_item_bytes=10)
+        now = datetime.utcnow()
+        cache.set("a", now, 6, b"aaaaaa")
+        cache.set("b", now, 4, b"bbbb")
+        cache.set("c", now, 1, b"c")
+        self.assertIsNone(cache.get("a", now, 6))
+        self.assertEqual(b"bbbb", cache.get("b", now, 4))
+        # Another version of the file is a miss
+        self.assertIsNone(cache.get("b", now, 5))
+
+    def test_disk_reload(self):
+        now = datetime.utcnow()
+        cache = ContentCache(memory_bytes=0, disk_dir=self.cache_dir, disk_bytes=10)
+        cache.set("a", now, 3, b"aaa")
+        cache = ContentCache(memory_bytes=0, disk_dir=self.cache_dir, disk_bytes=10)
+        self.assertEqual(b"aaa", cache.get("a", now, 3))
+        self.assertIsNotNone(cache.get_path("a", now, 3))
+
+
+class TestFileSystemDirectoryIndex(TestFileSystem):
+    """Same tests, with the directory index."""
+
+    def setUp(self):
+        super().setUp()
+        self.fs.close()
+        self.fs = FileSystem("/tmp/test", db_uri=TEST_MONGO_URI, directory_index=True)
+        self.fs.directories.db.drop()
+
+    def test_empty_directories_disappear(self):
+        self.fs.put("/dir1/sub/a", b"a")
+        self.fs.put("/dir1/sub/b", b"a")
+        self.fs.remove("/dir1/sub/a")
+        self.assertListEqual(["sub"], self.fs.list_dirs("/dir1"))
+        self.fs.rename("/dir1/sub/b", "/dir2/b")
+        self.assertListEqual(["dir2"], self.fs.list_dirs("/"))
+        self.fs.change_namespace("/dir2/b", from_namespace="", to_namespace="other")
+        self.assertListEqual([], self.fs.list_dirs("/"))
+        self.assertListEqual(["dir2"], self.fs.list_dirs("/", namespace="other"))
+
+    def test_rebuild(self):
+        self.fs.put("/dir1/sub/a", b"a")
+        self.fs.put("/dir2/b", b"a", namespace="other")
+        self.fs.directories.db.drop()
+        self.assertListEqual([], self.fs.list_dirs("/"))
+        self.fs.rebuild_directories()
+        self.assertListEqual(["dir1"], self.fs.list_dirs("/"))
+        self.assertListEqual(["sub"], self.fs.list_dirs("/dir1"))
+        self.assertListEqual(["dir2"], self.fs.list_dirs("/", namespace="other"))
+        # Counts are rebuilt too
+        self.fs.remove("/dir1/sub/a")
+        self.assertListEqual([], self.fs.list_dirs("/"))
+
+
+class TestFileSystemUsageCounters(TestFileSystem):
+    """Same tests, with the usage counters. They must match the files after every test."""
+
+    def setUp(self):
+        super().setUp()
+        self.fs.close()
+        self.fs = FileSystem("/tmp/test", db_uri=TEST_MONGO_URI, usage_counters=True)
+        self.fs.usage_counters.db.drop()
+
+    def tearDown(self):
+        counted = [u for u in self.fs.usage_counters.all() if u.files or u.size]
+        self.assertEqual([(u.namespace, u.files, u.size) for u in self.fs.stats()], [tuple(u) for u in counted])
+        self.fs.close()
+
+    def test_usage(self):
+        self.fs.put("/a", b"hello")
+        with self.fs.open("/b", "wb") as f:
+            f.write(b"abc")
+        self.assertEqual((2, 8), self.fs.usage()[1:])
+        self.fs.put("/a", b"hi")
+        self.fs.change_namespace("/b", from_namespace="", to_namespace="other")
+        self.assertEqual((1, 2), self.fs.usage()[1:])
+        self.assertEqual((1, 3), self.fs.usage("other")[1:])
+        self.fs.remove("/b", namespace="other")
+        self.assertEqual((0, 0), self.fs.usage("other")[1:])
+
+    def test_rebuild_usage(self):
+        self.fs.put("/a", b"hello")
+        self.fs.put("/b", b"abc", namespace="other")
+        self.fs.usage_counters.db.drop()
+        self.assertEqual((0, 0), self.fs.usage()[1:])
+        self.fs.rebuild_usage()
+        self.assertEqual((1, 5), self.fs.usage()[1:])
+        self.assertEqual((1, 3), self.fs.usage("other")[1:])
+
+
+class TestFileSystemTiered(TestFileSystem):
+    """Same tests, with a cold tier and accesses tracked, and moving files to the cold tier."""
+
+    def setUp(self):
+        super().setUp()
+        self.fs.close()
+        cold_dir = "/tmp/test_cold"
+        if os.path.exists(cold_dir):
+            shutil.rmtree(cold_dir)
+        os.mkdir(cold_dir)
+        self.fs = FileSystem("/tmp/test", db_uri=TEST_MONGO_URI, cold_storage_uri=cold_dir, track_access=True)
+
+    def make_cold(self, *paths):
+        old = datetime.utcnow() - timedelta(days=60)
+        self.fs.db.update_many({"name": {"$in": list(paths)}}, {"$set": {"updated": old, "accessed": old}})
+        return TierMover(self.fs).move()
+
+    def is_cold(self, path):
+        file_id = str(self.fs.db.find_one({"name": path})["_id"])
+        cold = self.fs.cold_fs.exists(self.fs.layout.path(file_id))
+        self.assertNotEqual(cold, self.fs.fs.exists(self.fs.layout.path(file_id)))
+        return cold
+
+    def test_move_to_cold(self):
+        self.fs.put("/old", b"old content")
+        self.fs.put("/new", b"new content")
+        self.fs.put("/dir/old", b"also old")
+        self.assertEqual({MOVED: 2}, self.make_cold("/old", "/dir/old"))
+        self.assertTrue(self.is_cold("/old"))
+        self.assertFalse(self.is_cold("/new"))
+        self.assertEqual(TIER_COLD, self.fs.db.find_one({"name": "/old"})["tier"])
+        # Nothing left to move
+        self.assertEqual({}, self.make_cold("/old", "/dir/old"))
+
+        self.assertEqual(b"old content", self.fs.get("/old"))
+        self.assertEqual(b"content", self.fs.get_range("/old", 4))
+        self.assertEqual(b"old content", b"".join(self.fs.get_stream("/old")))
+        with self.fs.open("/old", "rb") as f:
+            self.assertEqual(b"old content", f.read())
+        with self.fs.open_ranged("/old") as f:
+            f.seek(4)
+            self.assertEqual(b"content", f.read())
+        self.assertEqual({"/old": b"old content", "/new": b"new content"}, self.fs.get_many(["/old", "/new"]))
+        self.assertIn("test_cold", self.fs.get_url("/old"))
+        # Still where it was for everything else
+        self.assertEqual(11, self.fs.attrs("/old").size)
+        self.assertTrue(self.is_cold("/old"))
+
+    def test_recently_read_stay_hot(self):
+        self.fs.put("/file", b"a")
+        old = datetime.utcnow() - timedelta(days=60)
+        self.fs.db.update_one({"name": "/file"}, {"$set": {"updated": old}})
+        self.fs.get("/file")
+        self.assertGreater(self.fs.db.find_one({"name": "/file"})["accessed"], old)
+        self.assertEqual({}, TierMover(self.fs).move())
+        self.assertEqual({}, TierMover(self.fs, min_idle_seconds=3600).move())
+        self.fs.db.update_one({"name": "/file"}, {"$set": {"accessed": datetime.utcnow() - timedelta(days=1)}})
+        self.assertEqual({MOVED: 1}, TierMover(self.fs, min_idle_seconds=3600).move())
+
+    def test_changed_while_moving(self):
+        self.fs.put("/file", b"b")
+        d = self.fs.db.find_one({"name": "/file"})
+        # Found before the last write
+        d["updated"] -= timedelta(seconds=1)
+        self.assertFalse(self.fs.demote(d))
+        self.assertFalse(self.is_cold("/file"))
+        self.assertEqual(b"b", self.fs.get("/file"))
+
+    def test_removed_while_moving(self):
+        self.fs.put("/file", b"b")
+        d = self.fs.db.find_one({"name": "/file"})
+        # Marked pending by a remove that's removing its object
+        self.fs.db.update_one({"_id": d["_id"]}, {"$set": {"state": "pending"}})
+        self.assertFalse(self.fs.demote(d))
+        self.assertFalse(self.fs.cold_fs.exists(self.fs.layout.path(str(d["_id"]))))
+
+    def test_cold_orphans(self):
+        orphan_id = str(ObjectId.from_datetime(datetime.utcnow() - timedelta(days=2)))
+        with self.fs.layout.open(self.fs.cold_fs, orphan_id, "wb") as f:
+            f.write(b"orphan")
+        self.fs.put("/old", b"old")
+        self.make_cold("/old")
+        reconciler = Reconciler(self.fs, grace_seconds=-60)
+        self.assertEqual([(ORPHAN_COLD_OBJECT, orphan_id)], [(p.kind, p.name) for p in reconciler.fsck()])
+        self.assertEqual({ORPHAN_COLD_OBJECT: 1}, reconciler.reconcile())
+        self.assertEqual(b"old", self.fs.get("/old"))
+
+    def test_write_while_moving(self):
+        # Writes in the middle of a move between tiers wait for it, and the move doesn't undo them
+        writers = []
+
+        def with_put(method, content):
+            def interleaved(*args):
+                if not writers:
+                    writers.append(threading.Thread(target=self.fs.put, args=("/file", content)))
+                    writers[0].start()
+                    writers[0].join(0.3)
+                return method(*args)
+            return interleaved
+
+        self.fs.put("/file", b"old")
+        # Before removing the hot object
+        with unittest.mock.patch.object(self.fs.layout, "remove", with_put(self.fs.layout.remove, b"new")):
+            self.assertEqual({MOVED: 1}, self.make_cold("/file"))
+        writers.pop().join()
+        self.assertFalse(self.is_cold("/file"))
+        self.assertEqual(b"new", self.fs.get("/file"))
+
+        self.make_cold("/file")
+        # While writing the hot object
+        with unittest.mock.patch.object(self.fs.layout, "transfer", with_put(self.fs.layout.transfer, b"newer")):
+            self.assertFalse(self.fs.promote(self.fs.db.find_one({"name": "/file"})))
+        writers.pop().join()
+        self.assertFalse(self.is_cold("/file"))
+        self.assertEqual(b"newer", self.fs.get("/file"))
+        self.assertNotIn("moving", self.fs.db.find_one({"name": "/file"}))
+
+    def test_write_cold(self):
+        for path in ["/put", "/stream", "/many", "/append", "/write"]:
+            self.fs.put(path, b"cold")
+        self.make_cold("/put", "/stream", "/many", "/append", "/write")
+        self.fs.put("/put", b"hot")
+        self.fs.put_stream("/stream", [b"h", b"ot"])
+        self.fs.put_many({"/many": b"hot"})
+        with self.fs.open("/append", "ab") as f:
+            f.write(b" and hot")
+        with self.fs.open("/write", "wb") as f:
+            f.write(b"hot")
+        for path in ["/put", "/stream", "/many", "/write"]:
+            self.assertFalse(self.is_cold(path))
+            self.assertEqual(b"hot", self.fs.get(path))
+            self.assertNotIn("tier", self.fs.db.find_one({"name": path}))
+        self.assertFalse(self.is_cold("/append"))
+        self.assertEqual(b"cold and hot", self.fs.get("/append"))
+
+    def test_remove_and_copy_cold(self):
+        self.fs.put("/dir/a", b"a")
+        self.fs.put("/dir/b", b"b")
+        self.make_cold("/dir/a", "/dir/b")
+        self.assertEqual(2, self.fs.copy_tree("/dir", "/copy"))
+        self.assertTrue(self.is_cold("/copy/a"))
+        self.assertEqual(b"a", self.fs.get("/copy/a"))
+        self.assertTrue(self.fs.remove("/dir/a"))
+        self.assertEqual(b"a", self.fs.get("/copy/a"))
+        self.assertEqual({"/dir/b": True, "/copy/a": True}, self.fs.remove_many(["/dir/b", "/copy/a"]))
+        self.assertEqual(1, self.fs.remove_tree("/copy"))
+        self.assertEqual([], list(self.fs.layout.objects(self.fs.cold_fs)))
+
+    def test_promote_on_read(self):
+        self.fs.close()
+        self.fs = FileSystem("/tmp/test", db_uri=TEST_MONGO_URI, cold_storage_uri="/tmp/test_cold", promote_on_read=True)
+        self.fs.put("/file", b"content")
+        self.make_cold("/file")
+        self.assertEqual(b"content", self.fs.get("/file"))
+        self.fs.promoter.shutdown()
+        d = self.fs.db.find_one({"name": "/file"})
+        self.assertNotIn("tier", d)
+        self.assertTrue(self.fs.fs.exists(self.fs.layout.path(str(d["_id"]))))
+        self.assertEqual(b"content", self.fs.get("/file"))
+        # Kept for the reads that found it in the cold tier, until the grace period is over
+        self.assertTrue(self.fs.cold_fs.exists(self.fs.layout.path(str(d["_id"]))))
+        self.assertEqual({}, TierMover(self.fs).move())
+        self.fs.db.update_one({"_id": d["_id"]}, {"$set": {"cold_copy": datetime.utcnow() - timedelta(hours=2)}})
+        self.assertEqual({RELEASED: 1}, TierMover(self.fs).move())
+        self.assertFalse(self.is_cold("/file"))
+        self.assertNotIn("cold_copy", self.fs.db.find_one({"name": "/file"}))
+
+    def test_write_promoted(self):
+        self.fs.put("/put", b"cold")
+        self.fs.put("/remove", b"cold")
+        self.make_cold("/put", "/remove")
+        for path in ["/put", "/remove"]:
+            self.assertTrue(self.fs.promote(self.fs.db.find_one({"name": path})))
+        self.fs.put("/put", b"hot")
+        self.fs.remove("/remove")
+        self.assertFalse(self.is_cold("/put"))
+        self.assertEqual([], list(self.fs.layout.objects(self.fs.cold_fs)))
+
+    def test_without_cold_tier(self):
+        self.fs.put("/file", b"content")
+        self.make_cold("/file")
+        other = FileSystem("/tmp/test", db_uri=TEST_MONGO_URI)
+        with self.assertRaises(ValueError):
+            other.get("/file")
+        with self.assertRaises(ValueError):
+            TierMover(other)
+        other.close()
+
+
+class TestFileSystemTieredSharded(TestFileSystemTiered):
+    """Same tests, with the objects of both tiers sharded."""
+
+    def setUp(self):
+        super().setUp()
+        self.fs.close()
+        self.fs = FileSystem(
+            "/tmp/test", db_uri=TEST_MONGO_URI, cold_storage_uri="/tmp/test_cold", track_access=True, shard_levels=2
+        )
+
+    def test_sharded_cold_path(self):
+        self.fs.put("/old", b"old content")
+        self.assertEqual({MOVED: 1}, self.make_cold("/old"))
+        file_id = str(self.fs.db.find_one({"name": "/old"})["_id"])
+        self.assertTrue(self.fs.cold_fs.exists(self.fs.layout.path(file_id)))
+        self.assertEqual(b"old content", self.fs.get("/old"))
+
+
+class TestFileSystemSharded(TestFileSystem):
+    """Same tests, with objects stored in sharded directories."""
+
+    def setUp(self):
+        super().setUp()
+        self.fs.close()
+        self.fs = FileSystem("/tmp/test", db_uri=TEST_MONGO_URI, shard_levels=2)
+
+    def test_sharded_path(self):
+        self.fs.put("/file", b"a")
+        file_id = str(self.fs.db.find_one({"name": "/file"})["_id"])
+        self.assertFalse(self.fs.fs.exists(file_id))
+        self.assertTrue(self.fs.fs.exists(self.fs.layout.path(file_id)))
+        self.assertEqual(3, self.fs.layout.path(file_id).count("/") + 1)
+
+    def test_legacy_objects(self):
+        # Objects stored before sharding are in the root, and their documents don't say they are sharded
+        for path, content in [("/file", b"a"), ("/other", b"b")]:
+            self.fs.put(path, content)
+            d = self.fs.db.find_one_and_update({"name": path}, {"$unset": {"sharded": ""}})
+            self.fs.fs.move(self.fs.layout.path(str(d["_id"])), str(d["_id"]))
+        file_id = str(self.fs.db.find_one({"name": "/file"})["_id"])
+        self.assertEqual(b"a", self.fs.get("/file"))
+        self.assertIn(file_id, self.fs.get_url("/file"))
+        self.assertTrue(self.fs.remove("/file"))
+        self.assertFalse(self.fs.fs.exists(file_id))
+
+        self.assertEqual(1, self.fs.layout.migrate(self.fs.fs, files=self.fs.db))
+        self.assertEqual([], list(self.fs.layout.flat_objects(self.fs.fs)))
+        self.assertEqual(b"b", self.fs.get("/other"))
+        self.assertTrue(self.fs.db.find_one({"name": "/other"})["sharded"])
+        # Nothing left, running it again does nothing
+        self.assertEqual(0, self.fs.layout.migrate(self.fs.fs))
+
+    def test_rewrite_legacy_objects(self):
+        writes = {
+            "/put": lambda path: self.fs.put(path, b"new"),
+            "/stream": lambda path: self.fs.put_stream(path, [b"new"]),
+            "/many": lambda path: self.fs.put_many({path: b"new"}),
+            "/open": lambda path: self.fs.open(path, "wb").close(),
+        }
+        for path, write in writes.items():
+            self.fs.put(path, b"old")
+            d = self.fs.db.find_one_and_update({"name": path}, {"$unset": {"sharded": ""}})
+            self.fs.fs.move(self.fs.layout.path(str(d["_id"])), str(d["_id"]))
+            write(path)
+            # Only the sharded object is left
+            self.assertEqual([], list(self.fs.layout.flat_objects(self.fs.fs)), path)
+            self.assertTrue(self.fs.db.find_one({"name": path})["sharded"], path)
+
+    def test_copy_legacy_objects(self):
+        self.fs.put("/dir/file", b"a")
+        d = self.fs.db.find_one_and_update({"name": "/dir/file"}, {"$unset": {"sharded": ""}})
+        self.fs.fs.move(self.fs.layout.path(str(d["_id"])), str(d["_id"]))
+        self.assertEqual(1, self.fs.copy_tree("/dir", "/copy"))
+        self.assertEqual(b"a", self.fs.get("/copy/file"))
+        self.assertTrue(self.fs.db.find_one({"name": "/copy/file"})["sharded"])
+
+    def test_sharded_not_looked_for(self):
+        self.fs.put("/file", b"a")
+        self.fs.put_stream("/stream", [b"b"])
+        with self.fs.open("/open", "wb") as f:
+            f.write(b"c")
+        # Known to be sharded, the root isn't looked at
+        with unittest.mock.patch.object(self.fs.fs, "exists", side_effect=AssertionError("probed")):
+            for path in ["/file", "/stream", "/open"]:
+                self.assertIn(self.fs.layout.path(str(self.fs.db.find_one({"name": path})["_id"])), self.fs.get_url(path))
+            with self.fs.open("/file", "ab") as f:
+                f.write(b"b")
+        self.assertEqual(b"ab", self.fs.get("/file"))
+
+
+class TestFileSystemDeduplicated(TestFileSystem):
+    """Same tests, with contents stored once by their digest."""
+
+    def setUp(self):
+        super().setUp()
+        self.fs.close()
+        self.fs = FileSystem("/tmp/test", db_uri=TEST_MONGO_URI, shard_levels=1, deduplicate=True)
+        self.fs.blobs.db.drop()
+
+    def stored_objects(self):
+        return sorted(path.rsplit("/", 1)[-1] for path in self.fs.fs.walk.files())
+
+    def test_same_content_stored_once(self):
+        digest = self.fs.blobs.digest(b"Hello world!")
+        self.fs.put("/a", b"Hello world!")
+        self.fs.put("/b", b"Hello world!", namespace="other")
+        self.fs.put_stream("/c", [b"Hello ", b"world!"])
+        self.assertEqual([digest], self.stored_objects())
+        self.assertEqual(3, self.fs.blobs.get(digest)["refs"])
+        self.assertEqual(b"Hello world!", self.fs.get("/c"))
+
+        # Putting the same content again doesn't add references
+        self.fs.put("/a", b"Hello world!")
+        self.assertEqual(3, self.fs.blobs.get(digest)["refs"])
+
+        # Overwriting and removing release the blob, it's removed with the last file
+        self.fs.put("/a", b"other")
+        self.assertTrue(self.fs.remove("/b", namespace="other"))
+        self.assertEqual(1, self.fs.blobs.get(digest)["refs"])
+        self.assertEqual({"/c": True}, self.fs.remove_many(["/c"]))
+        self.assertIsNone(self.fs.blobs.get(digest))
+        self.assertEqual([self.fs.blobs.digest(b"other")], self.stored_objects())
+
+    def test_put_by_digest(self):
+        digest = self.fs.blobs.digest(b"content")
+        self.assertFalse(self.fs.has_digest(digest))
+        self.assertFalse(self.fs.put_by_digest("/copy", digest))
+        self.assertFalse(self.fs.exists("/copy"))
+        self.assertEqual(0, self.fs.blobs.db.count_documents({}))
+
+        self.fs.put("/file", b"content")
+        self.assertTrue(self.fs.has_digest(digest))
+        self.assertTrue(self.fs.put_by_digest("/dir/copy", digest))
+        self.assertEqual(b"content", self.fs.get("/dir/copy"))
+        self.assertEqual(7, self.fs.attrs("/dir/copy").size)
+        self.assertListEqual(["dir"], list(self.fs.iter_dirs("/")))
+
+    def test_open_detaches(self):
+        digest = self.fs.blobs.digest(b"Hello")
+        self.fs.put("/a", b"Hello")
+        self.fs.put("/b", b"Hello")
+        with self.fs.open("/a", "ab") as f:
+            f.write(b" world!")
+        self.assertEqual(b"Hello world!", self.fs.get("/a"))
+        self.assertEqual(b"Hello", self.fs.get("/b"))
+        self.assertEqual(1, self.fs.blobs.get(digest)["refs"])
+
+    def test_write_without_deduplicate(self):
+        digest = self.fs.blobs.digest(b"Hello")
+        self.fs.put("/a", b"Hello")
+        plain = FileSystem("/tmp/test", db_uri=TEST_MONGO_URI, shard_levels=1)
+        plain.mongo = self.fs.mongo
+        plain.db = self.fs.db
+        plain.blobs = self.fs.blobs
+        self.assertEqual(b"Hello", plain.get("/a"))
+        plain.put("/a", b"Bye")
+        self.assertEqual(b"Bye", self.fs.get("/a"))
+        self.assertIsNone(self.fs.blobs.get(digest))
+        plain.close()
+
+
+class TestFileSystemCompressed(TestFileSystem):
+    """Same tests, with contents compressed."""
+    text = b"Some text that compresses well. " * 100
+
+    def setUp(self):
+        super().setUp()
+        self.fs.close()
+        self.fs = FileSystem("/tmp/test", db_uri=TEST_MONGO_URI, codec="zlib", namespace_codecs={"raw": "none"})
+        self.fs.blobs.db.drop()
+
+    def stored(self, path, namespace=""):
+        d = self.fs.db.find_one({"name": path, "namespace": namespace})
+        with self.fs.fs.open(self.fs.object_name(d), "rb") as f:
+            return d, f.read()
+
+    def test_compressed(self):
+        self.fs.put("/text", self.text)
+        d, stored = self.stored("/text")
+        self.assertEqual("zlib", d["codec"])
+        self.assertEqual(len(stored), d["stored_size"])
+        self.assertEqual(self.text, get_codec("zlib").decompress(stored))
+        self.assertEqual(len(self.text), self.fs.attrs("/text").size)
+        self.assertEqual(self.text, self.fs.get("/text"))
+        self.assertEqual({"/text": self.text}, self.fs.get_many(["/text"]))
+        self.assertEqual([self.text[:1000], self.text[1000:2000]], list(self.fs.get_stream("/text", chunk_size=1000))[:2])
+
+        # Overwritten with something that doesn't compress
+        random = os.urandom(1000)
+        self.fs.put("/text", random)
+        d, stored = self.stored("/text")
+        self.assertNotIn("codec", d)
+        self.assertEqual(random, stored)
+
+    def test_codec_by_namespace_and_call(self):
+        self.fs.put("/text", self.text, namespace="raw")
+        self.assertEqual(self.text, self.stored("/text", "raw")[1])
+        self.fs.put("/text", self.text, namespace="raw", codec="lzma")
+        self.assertEqual("lzma", self.stored("/text", "raw")[0]["codec"])
+        self.assertEqual(self.text, self.fs.get("/text", namespace="raw"))
+        self.fs.put_stream("/stream", io.BytesIO(self.text), codec="none")
+        self.assertEqual(self.text, self.stored("/stream")[1])
+        self.fs.put_many({"/many": self.text})
+        self.assertEqual("zlib", self.stored("/many")[0]["codec"])
+        with self.assertRaises(ValueError):
+            self.fs.put("/text", self.text, codec="unknown")
+
+    def test_open_compressed(self):
+        with self.fs.open("/text", "w") as f:
+            f.write(self.text.decode())
+        d, stored = self.stored("/text")
+        self.assertEqual("zlib", d["codec"])
+        self.assertEqual(len(self.text), d["size"])
+        self.assertEqual(len(stored), d["stored_size"])
+        with self.fs.open("/text", "rb") as f:
+            self.assertEqual(self.text[:10], f.read(10))
+            self.assertEqual(self.text[10:], f.read())
+
+        # Appending needs the plain content
+        with self.fs.open("/text", "ab") as f:
+            f.write(b"end")
+        d, stored = self.stored("/text")
+        self.assertNotIn("codec", d)
+        self.assertEqual(self.text + b"end", stored)
+        self.assertEqual(len(self.text) + 3, self.fs.attrs("/text").size)
+
+        # Written with something that doesn't compress, like put
+        random = os.urandom(100 * 1024)
+        with self.fs.open("/random", "wb") as f:
+            for i in range(0, len(random), 1000):
+                f.write(random[i:i + 1000])
+        d, stored = self.stored("/random")
+        self.assertNotIn("codec", d)
+        self.assertEqual(random, stored)
+        self.assertEqual(random, self.fs.get("/random"))
+
+    def test_deduplicated(self):
+        self.fs.deduplicate = True
+        self.fs.put("/a", self.text)
+        self.fs.put("/b", self.text, codec="lzma")
+        # The blob was compressed by the first put
+        self.assertEqual("zlib", self.stored("/b")[0]["codec"])
+        self.assertEqual(self.text, self.fs.get("/b"))
+        self.fs.put_stream("/c", io.BytesIO(self.text), chunk_size=1000)
+        self.assertEqual(self.text, self.fs.get("/c"))
+        self.assertEqual(1, len(list(self.fs.fs.walk.files())))
+
+    def test_codec_is_abstract(self):
+        class Incomplete(Codec):
+            def compressor(self):
+                return None
+
+        with self.assertRaises(TypeError):
+            Incomplete()
+
+    def test_is_compressible(self):
+        self.assertTrue(is_compressible(self.text))
+        self.assertFalse(is_compressible(b"tiny"))
+        self.assertFalse(is_compressible(os.urandom(4096)))
+        self.assertFalse(is_compressible(b"\x89PNG" + self.text))
+
+
+class TestBackendCalls(unittest.TestCase):
+    """Database and storage calls of the write paths, a round trip more is a regression."""
+
+    def setUp(self):
+        tmp_dir = "/tmp/test"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.mkdir(tmp_dir)
+        self.fs = FileSystem(tmp_dir, db_uri=TEST_MONGO_URI)
+        self.fs.db.drop()
+        # Checked through self.files, so only the calls of the filesystem are counted
+        self.files = self.fs.db
+        self.fs.db = self.db = unittest.mock.Mock(wraps=self.files)
+        self.fs.layout.open = self.open = unittest.mock.Mock(wraps=self.fs.layout.open)
+
+    def tearDown(self):
+        self.fs.close()
+
+    def calls(self):
+        calls = ([name for name, args, kwargs in self.db.mock_calls], self.open.call_count)
+        self.db.reset_mock()
+        self.open.reset_mock()
+        return calls
+
+    def test_put(self):
+        self.fs.put("/a", b"hello")
+        # Created pending and committed once stored
+        self.assertEqual((["find_one_and_update", "update_one"], 1), self.calls())
+        self.fs.put("/a", b"bye")
+        self.assertEqual((["find_one_and_update"], 1), self.calls())
+        self.assertEqual({"size": 3, "state": "committed"}, self.files.find_one({"name": "/a"}, {"_id": 0, "size": 1, "state": 1}))
+
+    def test_put_rollback(self):
+        self.fs.put("/a", b"hello")
+        self.calls()
+        self.open.side_effect = OSError("storage down")
+        with self.assertRaises(OSError):
+            self.fs.put("/a", b"bye")
+        self.assertEqual((["find_one_and_update", "update_one"], 1), self.calls())
+        self.assertEqual(5, self.files.find_one({"name": "/a"})["size"])
+        with self.assertRaises(OSError):
+            self.fs.put("/b", b"bye")
+        self.assertEqual((["find_one_and_update", "delete_one"], 1), self.calls())
+        self.assertIsNone(self.files.find_one({"name": "/b"}))
+
+    def test_open_write(self):
+        with self.fs.open("/a", "wb") as f:
+            # The object is opened once, no probe before
+            self.assertEqual((["find_one_and_update"], 1), self.calls())
+            f.write(b"hello")
+        # The size is set when closed, committing it
+        self.assertEqual((["update_one"], 0), self.calls())
+        self.assertEqual("committed", self.files.find_one({"name": "/a"})["state"])
+        with self.fs.open("/a", "wb") as f:
+            f.write(b"bye")
+        self.assertEqual((["find_one_and_update", "update_one"], 1), self.calls())
+        self.assertEqual({"size": 3, "state": "committed"}, self.files.find_one({"name": "/a"}, {"_id": 0, "size": 1, "state": 1}))
+
+    def test_open_write_rollback(self):
+        self.open.side_effect = OSError("storage down")
+        with self.assertRaises(OSError):
+            self.fs.open("/a", "wb")
+        self.assertEqual((["find_one_and_update", "delete_one"], 1), self.calls())
+        self.assertIsNone(self.files.find_one({"name": "/a"}))
+
+
+class TestSharedResources(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = "/tmp/test-shared"
+        if os.path.exists(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+        os.mkdir(self.tmp_dir)
+
+    def test_shared(self):
+        key = mongo_key(TEST_MONGO_URI, MONGO_MAX_POOL_SIZE)
+        references = REGISTRY.references(key)
+        first = FileSystem(self.tmp_dir, db_uri=TEST_MONGO_URI)
+        second = FileSystem(self.tmp_dir, db_uri=TEST_MONGO_URI)
+        self.assertIs(first.mongo, second.mongo)
+        self.assertIs(first.fs, second.fs)
+        self.assertEqual(references + 2, REGISTRY.references(key))
+
+        # Closing one (even twice) leaves them open for the other
+        first.close()
+        first.close()
+        self.assertEqual(references + 1, REGISTRY.references(key))
+        second.put("/a", b"hello")
+        self.assertEqual(b"hello", second.get("/a"))
+        second.close()
+        self.assertEqual(references, REGISTRY.references(key))
+        self.assertTrue(second.fs.isclosed())
+
+    def test_closed_in_fork(self):
+        # A forked child gets its own keys, closing what it inherited releases the ones it was acquired with
+        key = mongo_key(TEST_MONGO_URI, MONGO_MAX_POOL_SIZE)
+        references = REGISTRY.references(key)
+        filesystem = FileSystem(self.tmp_dir, db_uri=TEST_MONGO_URI)
+        with unittest.mock.patch("os.getpid", return_value=os.getpid() + 1):
+            filesystem.close()
+        self.assertEqual(references, REGISTRY.references(key))
+
+    def test_created_without_lock(self):
+        registry = Registry()
+        closed = []
+        # Created by a factory, a resource can acquire others
+        outer = registry.acquire("outer", lambda: registry.acquire("inner", object, closed.append), closed.append)
+        self.assertIs(outer, registry.acquire("inner", object, closed.append))
+        self.assertEqual(2, registry.references("inner"))
+        self.assertEqual(1, registry.references("outer"))
+        self.assertEqual([], closed)
+
+    def test_not_shared(self):
+        first = FileSystem(self.tmp_dir, db_uri=TEST_MONGO_URI)
+        other = FileSystem(self.tmp_dir, db_uri=TEST_MONGO_URI, shared=False)
+        small = FileSystem(self.tmp_dir, db_uri=TEST_MONGO_URI, max_pool_size=5)
+        self.assertIsNot(first.mongo, other.mongo)
+        self.assertIsNot(first.fs, other.fs)
+        self.assertIsNot(first.mongo, small.mongo)
+        # Every mem:// is a filesystem of its own
+        self.assertIsNot(FileSystem("mem://", db_uri=TEST_MONGO_URI).fs, FileSystem("mem://", db_uri=TEST_MONGO_URI).fs)
+        other.close()
+        self.assertTrue(other.fs.isclosed())
+        self.assertFalse(first.fs.isclosed())
+        first.close()
+        small.close()
+
+
+class TestReconciler(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = "/tmp/test"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.mkdir(tmp_dir)
+        self.fs = FileSystem(tmp_dir, db_uri=TEST_MONGO_URI, shard_levels=1)
+        self.fs.db.drop()
+        self.fs.blobs.db.drop()
+        self.old_id = ObjectId.from_datetime(datetime.utcnow() - timedelta(days=1))
+        self.orphan_id = ObjectId.from_datetime(datetime.utcnow() - timedelta(days=2))
+
+    def tearDown(self):
+        self.fs.close()
+
+    def state(self, path):
+        return self.fs.db.find_one({"name": path, "namespace": ""})["state"]
+
+    def make_problems(self):
+        self.fs.put("/ok", b"ok")
+        # A crash after storing the object, before the document
+        with self.fs.layout.open(self.fs.fs, str(self.orphan_id), "wb") as f:
+            f.write(b"orphan")
+        # Its object is gone and can't be removed, it keeps the document
+        self.fs.put("/dangling", b"dangling")
+        self.fs.layout.remove(self.fs.fs, str(self.fs.db.find_one({"name": "/dangling"})["_id"]))
+        with self.assertRaises(Exception):
+            self.fs.remove("/dangling")
+        # A crash while writing a new file
+        self.fs.db.insert_one({"_id": ObjectId(), "name": "/writing", "namespace": "", "state": "pending"})
+        self.fs.db.insert_one({"_id": self.old_id, "name": "/pending", "namespace": "", "state": "pending"})
+        with self.fs.layout.open(self.fs.fs, str(self.old_id), "wb") as f:
+            f.write(b"partial")
+        # A crash while releasing a blob
+        self.fs.blobs.db.insert_one({"_id": "a" * 64, "refs": 0, "state": "complete", "created": datetime(2020, 1, 1)})
+
+    def test_states(self):
+        self.fs.put("/put", b"a")
+        self.assertEqual("committed", self.state("/put"))
+        self.fs.put_stream("/stream", [b"a"])
+        self.assertEqual("committed", self.state("/stream"))
+        self.fs.put_many({"/many": b"a"})
+        self.assertEqual("committed", self.state("/many"))
+        with self.fs.open("/open", "wb") as f:
+            self.assertEqual("pending", self.state("/open"))
+            f.write(b"a")
+        self.assertEqual("committed", self.state("/open"))
+
+    def test_fsck(self):
+        self.make_problems()
+        reconciler = Reconciler(self.fs)
+        problems = {(problem.kind, problem.name) for problem in reconciler.fsck()}
+        self.assertEqual({
+            (ORPHAN_OBJECT, str(self.orphan_id)), (DANGLING_FILE, "/dangling"), (PENDING_FILE, "/pending"),
+            (UNREFERENCED_BLOB, "a" * 64)
+        }, problems)
+
+        self.assertEqual({ORPHAN_OBJECT: 1, DANGLING_FILE: 1, PENDING_FILE: 1, UNREFERENCED_BLOB: 1}, reconciler.reconcile())
+        self.assertEqual([], list(reconciler.fsck()))
+        self.assertEqual(b"ok", self.fs.get("/ok"))
+        self.assertFalse(self.fs.exists("/dangling"))
+        self.assertTrue(self.fs.exists("/writing"))
+        self.assertEqual(["ok", "writing"], sorted(self.fs.list("/")))
+
+    def test_interrupted_writes(self):
+        self.fs.close()
+        self.fs = FileSystem("/tmp/test", db_uri=TEST_MONGO_URI, shard_levels=1, directory_index=True, usage_counters=True)
+        self.fs.directories.db.drop()
+        self.fs.usage_counters.db.drop()
+        self.fs.put("/d/x", b"x")
+        writes = [
+            lambda: self.fs.put("/d/y", b"y"),
+            lambda: self.fs.put_stream("/e/y", [b"y"]),
+            lambda: self.fs.put_many({"/f/y": b"y"}),
+        ]
+        # Failures roll back
+        with unittest.mock.patch.object(self.fs.layout, "open", side_effect=IOError):
+            for write in writes:
+                write_error = None
+                try:
+                    write()
+                except IOError as e:
+                    write_error = e
+                self.assertEqual(["d"], self.fs.list_dirs("/"), write_error)
+                self.assertEqual((1, 1), self.fs.usage()[1:], write_error)
+        # Crashes leave the files pending
+        with unittest.mock.patch.object(self.fs.layout, "open", side_effect=KeyboardInterrupt):
+            for write in writes:
+                with self.assertRaises(KeyboardInterrupt):
+                    write()
+        with self.assertRaises(KeyboardInterrupt):
+            with unittest.mock.patch.object(self.fs.layout, "open", side_effect=KeyboardInterrupt):
+                self.fs.open("/g/y", "wb")
+        self.assertEqual(4, self.fs.db.count_documents({"state": "pending"}))
+
+        self.assertEqual({PENDING_FILE: 4}, Reconciler(self.fs, grace_seconds=-60).reconcile())
+        self.assertEqual(["d"], self.fs.list_dirs("/"))
+        self.assertEqual(["x"], self.fs.list("/d"))
+        self.assertEqual((1, 1), self.fs.usage()[1:])
+
+    def test_text_mode_committed(self):
+        # The text files of mem:// (like S3 or FTP) have no mode of their own
+        self.fs.close()
+        self.fs = FileSystem("mem://", db_uri=TEST_MONGO_URI)
+        with self.fs.open("/text", "w") as f:
+            f.write("hello")
+        f = self.fs.open("/closed", "w")
+        f.write("hi")
+        f.close()
+        self.assertEqual(["committed", "committed"], [self.state("/text"), self.state("/closed")])
+        self.assertEqual(5, self.fs.attrs("/text").size)
+        self.assertEqual({}, Reconciler(self.fs, grace_seconds=-60).reconcile())
+        self.assertEqual(b"hello", self.fs.get("/text"))
+
+    def test_orphan_blob(self):
+        self.fs.deduplicate = True
+        self.fs.put("/a", b"a")
+        digest = self.fs.blobs.digest(b"a")
+        self.fs.blobs.db.delete_one({"_id": digest})
+        reconciler = Reconciler(self.fs)
+        self.assertEqual([(ORPHAN_OBJECT, digest)], [(p.kind, p.name) for p in reconciler.fsck()])
+        self.assertEqual({ORPHAN_OBJECT: 1}, reconciler.reconcile(max_per_second=1000))
+        self.assertEqual([], list(self.fs.layout.objects(self.fs.fs)))
+
+    def test_garbage_collector(self):
+        self.make_problems()
+        collector = GarbageCollector(self.fs, interval=0.01, max_per_second=1000)
+        for _ in range(100):
+            if not self.fs.exists("/pending"):
+                break
+            collector.stopped.wait(0.01)
+        collector.stop()
+        self.assertFalse(self.fs.exists("/pending"))
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = "/tmp/test"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.mkdir(tmp_dir)
+        self.operations = []
+        self.fs = FileSystem(tmp_dir, db_uri=TEST_MONGO_URI, metrics=True, metrics_hooks=[self.operations.append])
+        self.fs.db.drop()
+
+    def tearDown(self):
+        self.fs.close()
+
+    def test_operations(self):
+        self.fs.put("/a", b"hello")
+        self.fs.get("/a")
+        self.fs.get_many(["/a", "/b"])
+        self.fs.put_stream("/s", [b"ab", b"c"])
+        with self.assertRaises(ValueError):
+            self.fs.remove("/notexists")
+        self.assertEqual(["put", "get", "get_many", "put_stream", "remove"], [o.name for o in self.operations])
+        self.assertEqual([5, 0, 0, 3, 0], [o.bytes_in for o in self.operations])
+        self.assertEqual([0, 5, 5, 0, 0], [o.bytes_out for o in self.operations])
+        self.assertEqual("ValueError", self.operations[-1].error)
+        self.assertTrue(all(o.seconds >= o.sanitize_seconds > 0 for o in self.operations))
+
+        stats = self.fs.metrics.snapshot()
+        self.assertEqual(1, stats["put"].calls)
+        self.assertEqual(1, stats["remove"].errors)
+        text = self.fs.metrics.prometheus_text()
+        self.assertIn('bazaar_operation_seconds_count{operation="get"} 1', text)
+        self.assertIn('bazaar_operation_bytes_in_total{operation="put"} 5', text)
+
+        # Off at runtime
+        self.fs.metrics.disable()
+        self.fs.get("/a")
+        self.assertEqual(5, len(self.operations))
+        self.fs.metrics.enable()
+        self.fs.exists("/a")
+        self.assertEqual("exists", self.operations[-1].name)
+
+    def test_db_queries(self):
+        class Event(object):
+            duration_micros = 2000
+
+        # Only counted for the operation running in the thread
+        COMMAND_COUNTER.succeeded(Event())
+
+        def query(*args, **kwargs):
+            COMMAND_COUNTER.succeeded(Event())
+            COMMAND_COUNTER.succeeded(Event())
+
+        self.fs.db = unittest.mock.MagicMock(find_one=query)
+        self.fs.attrs("/a")
+        self.assertEqual((2, 0.004), (self.operations[-1].db_queries, self.operations[-1].db_seconds))
+
+    def test_calls_shared_by_threads(self):
+        # The io workers count for the operation of the thread that started them
+        call = Call()
+
+        def count():
+            for _ in range(10000):
+                call.add_query(0.001)
+
+        threads = [threading.Thread(target=count) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(80000, call.db_queries)
+
+    def test_streams(self):
+        def slow(chunks):
+            for chunk in chunks:
+                time.sleep(0.02)
+                yield chunk
+
+        # Written as the content is read
+        self.fs.put_stream("/s", slow([b"ab", b"c"]))
+        self.assertGreaterEqual(self.operations[-1].seconds, 0.04)
+
+        # Read until it's exhausted
+        chunks = self.fs.get_stream("/s", chunk_size=1)
+        self.assertEqual(["put_stream"], [o.name for o in self.operations])
+        self.assertEqual([b"a", b"b", b"c"], list(slow(chunks)))
+        self.assertEqual("get_stream", self.operations[-1].name)
+        self.assertEqual(3, self.operations[-1].bytes_out)
+        self.assertGreaterEqual(self.operations[-1].seconds, 0.04)
+
+        # Or closed before
+        chunks = self.fs.get_stream("/s", chunk_size=1)
+        self.assertEqual(b"a", next(chunks))
+        chunks.close()
+        self.assertEqual(1, self.operations[-1].bytes_out)
+        self.assertEqual(3, len(self.operations))
+        self.assertIsNone(self.fs.get_stream("/missing"))
+        self.assertEqual(4, len(self.operations))
+
+    def test_logging_hook(self):
+        logger = unittest.mock.Mock()
+        self.fs.metrics.hooks = [LoggingHook(logger, slow_seconds=10, max_db_queries=0)]
+        self.fs.exists("/a")
+        self.assertFalse(logger.log.called)
+        self.fs.metrics.hooks = [LoggingHook()]
+        with self.assertLogs("bazaar.metrics") as logs:
+            self.fs.exists("/a")
+        self.assertIn("exists took", logs.output[0])
+
+
+class TestBench(unittest.TestCase):
+    def test_run(self):
+        results = list(run(["mem://"], TEST_MONGO_URI, ["put", "exists"], payload_sizes=[10], repeat=3, warmup=0))
+        self.assertEqual([("put", "10B"), ("exists", "found"), ("exists", "missing")], [(r.case, r.param) for r in results])
+        self.assertTrue(all(r.calls == 3 and r.p50 <= r.p99 for r in results))
+
+    def test_compare(self):
+        def output(ops):
+            return {"results": [{"case": "get", "param": "1KiB", "storage": "mem://", "ops_per_second": ops}]}
+
+        self.assertEqual(["get 1KiB mem://: +10.0%"], compare(output(100), output(110)))
+        self.assertEqual(["get 1KiB mem://: -50.0%  REGRESSION"], compare(output(100), output(50)))
+
+
+class TestMetadataCache(unittest.TestCase):
+    def test_lru(self):
+        cache = MetadataCache(max_size=2, ttl=60)
+        cache.set(("", "/a"), {"_id": 1})
+        cache.set(("", "/b"), {"_id": 2})
+        cache.get(("", "/a"))
+        cache.set(("", "/c"), {"_id": 3})
+        # /b is the least recently used
+        self.assertIsNone(cache.get(("", "/b")))
+        self.assertEqual({"_id": 1}, cache.get(("", "/a")))
+        cache.invalidate_id(3)
+        self.assertIsNone(cache.get(("", "/c")))
+
+    def test_ttl(self):
+        cache = MetadataCache(max_size=2, ttl=0)
+        cache.set(("", "/a"), {"_id": 1})
+        self.assertIsNone(cache.get(("", "/a")))
+        self.assertEqual(0, cache.stats().size)
+
+    def test_copies(self):
+        cache = MetadataCache(max_size=2, ttl=60)
+        cache.set(("", "/a"), {"_id": 1, "extras": {"foo": "bar"}})
+        cache.get(("", "/a"))["extras"]["foo"] = "changed"
+        self.assertEqual({"foo": "bar"}, cache.get(("", "/a"))["extras"])
+
 
 class TestBufferWrapper(unittest.TestCase):
     test_file_dict = {'name': 'test_file', 'namespace': 'test-namespace'}
@@ -307,6 +1736,249 @@ class TestBufferWrapper(unittest.TestCase):
         updated_file_data = self.db.find_one(self.test_file_dict)
         self.assertEqual(updated_file_data['size'], new_size)
 
+    def test_io_compatibility(self):
+        wrapper = self.wrapper_factory(wrapped_object=io.BytesIO(b"line 1\nline 2\n"), default_mode='rb')
+        self.assertIsInstance(wrapper, io.IOBase)
+        # Bound to the wrapped file, not wrapped on every call
+        self.assertEqual(wrapper.wrapped_object.read, wrapper.read)
+        buffer = bytearray(4)
+        self.assertEqual(4, wrapper.readinto(memoryview(buffer)))
+        self.assertEqual(b"line", bytes(buffer))
+        self.assertEqual([b" 1\n", b"line 2\n"], list(wrapper))
+        wrapper.seek(0)
+        copy = io.BytesIO()
+        shutil.copyfileobj(wrapper, copy, 3)
+        self.assertEqual(b"line 1\nline 2\n", copy.getvalue())
+        # Text files have no readinto
+        self.assertFalse(hasattr(self.wrapper_factory(), "readinto"))
+
+    def test_not_committed_if_closing_fails(self):
+        # Closing stores the content on S3, if it fails the file keeps its size
+        class FailingWriter(io.BytesIO):
+            mode = 'wb'
+
+            def close(self):
+                raise IOError("Upload failed")
+
+        file_data = self.create_test_file()
+        wrapper = self.wrapper_factory(wrapped_object=FailingWriter(), file_data=file_data)
+        wrapper.write(b"Hello world!")
+        with self.assertRaises(IOError):
+            wrapper.close()
+        with self.assertRaises(IOError):
+            with self.wrapper_factory(wrapped_object=FailingWriter(), file_data=file_data) as f:
+                f.write(b"Hello world!")
+        self.assertEqual(0, self.db.find_one(self.test_file_dict)['size'])
+
+    def test_close_twice(self):
+        file_data = self.create_test_file()
+        wrapper = self.wrapper_factory(file_data=file_data, default_mode='w')
+        wrapper.write('Hello world!')
+        wrapper.close()
+        wrapper.close()
+        self.assertTrue(wrapper.closed)
+        self.assertEqual(12, self.db.find_one(self.test_file_dict)['size'])
+
+
+def async_test(method):
+    """Run a coroutine test in the loop of its test case, IsolatedAsyncioTestCase needs Python 3.8."""
+    @functools.wraps(method)
+    def wrapper(self):
+        return self.loop.run_until_complete(method(self))
+    return wrapper
+
+
+@unittest.skipIf(AsyncFileSystem is None, "motor is not installed")
+class TestAsyncFileSystem(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.fs = AsyncFileSystem("mem://", db_uri=TEST_MONGO_URI)
+        self.loop.run_until_complete(self.fs.db.drop())
+        self.loop.run_until_complete(self.fs.ensure_indexes())
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.fs.close())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    @async_test
+    async def test_put_get(self):
+        await self.fs.put("/dir/file", b"Hello world!", namespace="test")
+        self.assertEqual(b"Hello world!", await self.fs.get("/dir/file", namespace="test"))
+        self.assertIsNone(await self.fs.get("/dir/file"))
+        self.assertTrue(await self.fs.exists("/dir/file", namespace="test"))
+        self.assertEqual(12, (await self.fs.attrs("/dir/file", namespace="test")).size)
+
+    @async_test
+    async def test_get_range(self):
+        await self.fs.put("/file", b"Hello world!")
+        self.assertEqual(b"world", await self.fs.get_range("/file", 6, 5))
+        self.assertEqual(b"d!", await self.fs.get_range("/file", -2))
+        self.assertIsNone(await self.fs.get_range("/notexists", 0))
+
+    @async_test
+    async def test_list(self):
+        await self.fs.put("/first", b"a")
+        await self.fs.put("/dir1/file", b"a")
+        await self.fs.put("/dir1/subdir/file", b"a")
+        self.assertListEqual(["first"], await self.fs.list("/"))
+        self.assertListEqual(["file"], await self.fs.list("/dir1"))
+        self.assertCountEqual(["dir1"], await self.fs.list_dirs("/"))
+        self.assertCountEqual(["subdir"], await self.fs.list_dirs("/dir1"))
+
+    @async_test
+    async def test_open(self):
+        async with await self.fs.open("/file", "w") as f:
+            await f.write("Hello world!")
+        self.assertEqual(12, (await self.fs.attrs("/file")).size)
+        async with await self.fs.open("/file", "r") as f:
+            self.assertEqual("Hello world!", await f.read())
+        with self.assertRaises(FileNotFoundError):
+            await self.fs.open("/notexists", "r")
+
+    @async_test
+    async def test_rename_remove(self):
+        await self.fs.put("/file", b"a")
+        await self.fs.put("/other", b"b")
+        self.assertFalse(await self.fs.rename("/file", "/other"))
+        self.assertTrue(await self.fs.rename("/file", "/renamed"))
+        self.assertFalse(await self.fs.exists("/file"))
+        self.assertTrue(await self.fs.remove("/renamed"))
+        self.assertFalse(await self.fs.exists("/renamed"))
+        with self.assertRaises(ValueError):
+            await self.fs.remove("/renamed")
+
+    @async_test
+    async def test_extras_namespace_url(self):
+        await self.fs.put("/file", b"a", namespace="test_1")
+        self.assertTrue(await self.fs.set_extras("/file", {"foo": "bar"}, namespace="test_1"))
+        self.assertEqual({"foo": "bar"}, await self.fs.get_extras("/file", namespace="test_1"))
+        self.assertTrue(await self.fs.change_namespace("/file", from_namespace="test_1", to_namespace="test_2"))
+        self.assertTrue(await self.fs.exists("/file", namespace="test_2"))
+        with self.assertRaises(FileNotFoundError):
+            await self.fs.get_url("/file", namespace="test_1")
+
+    @async_test
+    async def test_directory_index(self):
+        await self.fs.close()
+        self.fs = AsyncFileSystem("mem://", db_uri=TEST_MONGO_URI, directory_index=True)
+        await self.fs.ensure_indexes()
+        self.fs.directories.db.drop()
+        await self.fs.put("/dir1/file", b"a")
+        await self.fs.put("/dir1/sub/file", b"a")
+        async with await self.fs.open("/dir2/file", "wb") as f:
+            await f.write(b"a")
+        self.assertEqual(["dir1", "dir2"], await self.fs.list_dirs("/"))
+        self.assertEqual(["sub"], await self.fs.list_dirs("/dir1"))
+
+        self.assertTrue(await self.fs.rename("/dir2/file", "/dir3/file"))
+        self.assertTrue(await self.fs.change_namespace("/dir1/file", "", "other"))
+        self.assertTrue(await self.fs.remove("/dir1/sub/file"))
+        self.assertEqual(["dir3"], await self.fs.list_dirs("/"))
+        self.assertEqual(["dir1"], await self.fs.list_dirs("/", namespace="other"))
+        # As FileSystem sees it
+        self.assertEqual(["dir3"], list(self.fs.directories.iter("/", "")))
+
+    @async_test
+    async def test_usage_counters(self):
+        await self.fs.close()
+        self.fs = AsyncFileSystem("mem://", db_uri=TEST_MONGO_URI, usage_counters=True)
+        self.fs.usage_counters.db.drop()
+        await self.fs.put("/first", b"12345")
+        await self.fs.put("/first", b"123")
+        async with await self.fs.open("/second", "wb") as f:
+            await f.write(b"1234567")
+        async with await self.fs.open("/second", "ab") as f:
+            await f.write(b"89")
+        self.assertEqual((2, 12), self.fs.usage_counters.get("")[1:])
+        self.assertTrue(await self.fs.rename("/first", "/renamed"))
+        self.assertTrue(await self.fs.change_namespace("/renamed", "", "other"))
+        self.assertEqual((1, 9), self.fs.usage_counters.get("")[1:])
+        self.assertEqual((1, 3), self.fs.usage_counters.get("other")[1:])
+        self.assertTrue(await self.fs.remove("/second"))
+        self.assertEqual((0, 0), self.fs.usage_counters.get("")[1:])
+
+    @async_test
+    async def test_deduplicated(self):
+        await self.fs.close()
+        storage_dir = "/tmp/test_aio"
+        if os.path.exists(storage_dir):
+            shutil.rmtree(storage_dir)
+        os.mkdir(storage_dir)
+        self.fs = AsyncFileSystem(storage_dir, db_uri=TEST_MONGO_URI)
+        # Written by a FileSystem on the same database and storage
+        sync_fs = FileSystem(storage_dir, database=self.fs.blobs.db.database, deduplicate=True)
+        sync_fs.blobs.db.drop()
+        for path in ["/put", "/open", "/remove"]:
+            sync_fs.put(path, b"shared")
+        sync_fs.close()
+        digest = self.fs.blobs.digest(b"shared")
+        self.assertEqual(3, self.fs.blobs.get(digest)["refs"])
+
+        await self.fs.put("/put", b"own")
+        async with await self.fs.open("/open", "wb") as f:
+            await f.write(b"own too")
+        self.assertEqual(1, self.fs.blobs.get(digest)["refs"])
+        self.assertEqual(b"shared", await self.fs.get("/remove"))
+        self.assertTrue(await self.fs.remove("/remove"))
+        self.assertIsNone(self.fs.blobs.get(digest))
+        self.assertFalse(self.fs.fs.exists(self.fs.layout.path(digest)))
+        self.assertEqual(b"own", await self.fs.get("/put"))
+        self.assertEqual(b"own too", await self.fs.get("/open"))
+
+    @async_test
+    async def test_sharded(self):
+        await self.fs.close()
+        storage_dir = "/tmp/test_aio"
+        if os.path.exists(storage_dir):
+            shutil.rmtree(storage_dir)
+        os.mkdir(storage_dir)
+        self.fs = AsyncFileSystem(storage_dir, db_uri=TEST_MONGO_URI, shard_levels=2)
+        await self.fs.put("/put", b"a")
+        async with await self.fs.open("/open", "wb") as f:
+            await f.write(b"b")
+        # Known to be sharded, the root isn't looked at
+        with unittest.mock.patch.object(self.fs.fs, "exists", side_effect=AssertionError("probed")):
+            for path in ["/put", "/open"]:
+                d = await self.fs.db.find_one({"name": path})
+                self.assertIn(self.fs.layout.path(str(d["_id"])), await self.fs.get_url(path))
+            async with await self.fs.open("/put", "ab") as f:
+                await f.write(b"b")
+        self.assertEqual(b"ab", await self.fs.get("/put"))
+
+        # Written again, a legacy flat object is removed
+        for path in ["/put", "/open"]:
+            d = await self.fs.db.find_one_and_update({"name": path}, {"$unset": {"sharded": ""}})
+            self.fs.fs.move(self.fs.layout.path(str(d["_id"])), str(d["_id"]))
+        await self.fs.put("/put", b"c")
+        async with await self.fs.open("/open", "wb") as f:
+            await f.write(b"d")
+        self.assertEqual([], list(self.fs.layout.flat_objects(self.fs.fs)))
+        self.assertEqual([b"c", b"d"], [await self.fs.get("/put"), await self.fs.get("/open")])
+
+    @async_test
+    async def test_cold_tier(self):
+        await self.fs.close()
+        self.fs = AsyncFileSystem("mem://", db_uri=TEST_MONGO_URI, cold_storage_uri="mem://")
+        for path in ["/read", "/append", "/put"]:
+            await self.fs.put(path, b"cold")
+            # As TierMover would
+            file_id = str((await self.fs.db.find_one({"name": path}))["_id"])
+            self.fs.layout.transfer(self.fs.fs, self.fs.cold_fs, file_id)
+            self.fs.layout.remove(self.fs.fs, file_id)
+            await self.fs.db.update_one({"name": path}, {"$set": {"tier": TIER_COLD}})
+        self.assertEqual(b"cold", await self.fs.get("/read"))
+        self.assertEqual(b"ld", await self.fs.get_range("/read", 2))
+        async with await self.fs.open("/append", "ab") as f:
+            await f.write(b" and hot")
+        await self.fs.put("/put", b"hot")
+        self.assertEqual(b"cold and hot", await self.fs.get("/append"))
+        self.assertEqual(b"hot", await self.fs.get("/put"))
+        self.assertEqual(1, len(list(self.fs.layout.objects(self.fs.cold_fs))))
+        self.assertTrue(await self.fs.remove("/read"))
+        self.assertEqual([], list(self.fs.layout.objects(self.fs.cold_fs)))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,161 @@
+import argparse
+import logging
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import Any, Dict, Iterator
+
+from .bazaar import FILE_PENDING, TIER_COLD, FileSystem
+
+
+logger = logging.getLogger(__name__)
+
+# Files moved at once, in parallel with the io workers of the filesystem
+TIER_BATCH_SIZE = 100
+# Files not written for this long go to the cold tier
+TIER_MIN_AGE_SECONDS = 30 * 24 * 3600
+# Cold objects of the files moved back to the hot tier are kept this long, for the reads that found them before
+PROMOTION_GRACE_SECONDS = 3600
+
+# Files moved by a run, to the cold tier and failed
+MOVED = "moved"
+FAILED = "failed"
+# Written or removed while being moved, they stay hot
+SKIPPED = "skipped"
+# Cold copies of files moved back removed
+RELEASED = "released"
+
+
+class TierMover(object):
+    """Move to the cold tier of the filesystem the objects of the files not written for min_age_seconds, nor read
+    for min_idle_seconds (the same by default) if the filesystem tracks accesses.
+
+    Candidates are streamed from the files collection and moved in batches, the objects of every batch in parallel
+    in the io workers of the filesystem. Deduplicated files stay in the hot tier, their blobs are shared by files
+    that may not be cold. Every run also removes the cold copies of the files moved back to the hot tier more than
+    grace_seconds ago. With interval, a thread runs it every interval seconds until stopped.
+    """
+
+    def __init__(
+        self,
+        filesystem: FileSystem,
+        min_age_seconds: float = TIER_MIN_AGE_SECONDS,
+        min_idle_seconds: float = None,
+        namespace: str = None,
+        batch_size: int = TIER_BATCH_SIZE,
+        interval: float = None,
+        grace_seconds: float = PROMOTION_GRACE_SECONDS
+    ):
+        if filesystem.cold_fs is None:
+            raise ValueError("The filesystem has no cold tier, give it a cold_storage_uri")
+        self.filesystem = filesystem
+        self.min_age_seconds = min_age_seconds
+        self.min_idle_seconds = min_age_seconds if min_idle_seconds is None else min_idle_seconds
+        self.namespace = namespace
+        self.batch_size = batch_size
+        self.interval = interval
+        self.grace_seconds = grace_seconds
+        self.stopped = threading.Event()
+        self.thread = None
+        if interval is not None:
+            self.thread = threading.Thread(target=self.run, name="bazaar-tiering", daemon=True)
+            self.thread.start()
+
+    def query(self) -> Dict[str, Any]:
+        now = datetime.utcnow()
+        idle = now - timedelta(seconds=self.min_idle_seconds)
+        query = {
+            "tier": {"$ne": TIER_COLD},
+            "blob": None,
+            "cold_copy": None,
+            "state": {"$ne": FILE_PENDING},
+            "updated": {"$lt": now - timedelta(seconds=self.min_age_seconds)},
+            "$or": [{"accessed": None}, {"accessed": {"$lt": idle}}]
+        }
+        if self.namespace is not None:
+            query["namespace"] = self.namespace
+        return query
+
+    def candidates(self) -> Iterator[Dict[str, Any]]:
+        projection = {"_id": 1, "updated": 1, "size": 1, "stored_size": 1}
+        return self.filesystem.db.find(self.query(), projection).batch_size(self.batch_size)
+
+    def move(self, limit: int = None) -> Dict[str, int]:
+        """Move the cold files, at most limit of them. Returns how many were moved, skipped and failed, and the cold
+        copies released.
+        """
+        filesystem = self.filesystem
+        moved = Counter()
+        released = self.release_copies()
+        if released:
+            moved[RELEASED] = released
+        files = islice(self.candidates(), limit)
+        while not self.stopped.is_set():
+            batch = list(islice(files, self.batch_size))
+            if not batch:
+                break
+            sizes = [d.get("stored_size", d.get("size")) or 0 for d in batch]
+            for d, result in zip(batch, filesystem.map_io(lambda fs, d: filesystem.demote(d, fs), batch, sizes)):
+                if isinstance(result, Exception):
+                    logger.warning("Couldn't move %s to the cold tier: %r", d["_id"], result)
+                    moved[FAILED] += 1
+                else:
+                    moved[MOVED if result else SKIPPED] += 1
+        return dict(moved)
+
+    def release_copies(self) -> int:
+        """Remove the cold copies kept after promoting files, once they are older than grace_seconds."""
+        filesystem = self.filesystem
+        deadline = datetime.utcnow() - timedelta(seconds=self.grace_seconds)
+        query = {"cold_copy": {"$lt": deadline}}
+        if self.namespace is not None:
+            query["namespace"] = self.namespace
+        released = 0
+        for d in filesystem.db.find(query, {"_id": 1, "cold_copy": 1}).batch_size(self.batch_size):
+            # Before forgetting it, so a crash leaves it to the next run. Files with a copy aren't moved meanwhile
+            filesystem.drop_cold([d])
+            r = filesystem.db.update_one({"_id": d["_id"], "cold_copy": d["cold_copy"]}, {"$unset": {"cold_copy": ""}})
+            released += r.modified_count
+        return released
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                moved = self.move()
+                if moved:
+                    logger.info("Moved to the cold tier %s", moved)
+            except Exception:
+                logger.exception("Moving to the cold tier failed")
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move the files not used for a while to the cold tier of a bazaar storage")
+    parser.add_argument("storage_uri", help="Storage of bazaar, eg /var/bazaar")
+    parser.add_argument("cold_storage_uri", help="Cold storage, eg s3://bucket")
+    parser.add_argument("db_uri", help="Mongo URI of the bazaar database, eg mongodb://localhost/bazaar")
+    parser.add_argument("--shard-levels", type=int, default=0, help="Must match FileSystem(shard_levels)")
+    parser.add_argument("--workers", type=int, default=8, help="Objects moved at the same time")
+    parser.add_argument("--min-age", type=float, default=TIER_MIN_AGE_SECONDS, help="Seconds since the last write")
+    parser.add_argument("--min-idle", type=float, help="Seconds since the last read, if tracked (default --min-age)")
+    parser.add_argument("--namespace", help="Only move files of this namespace")
+    parser.add_argument("--limit", type=int, help="Files moved at most")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    filesystem = FileSystem(
+        args.storage_uri, args.db_uri, create_indexes=False, io_workers=args.workers, shard_levels=args.shard_levels,
+        cold_storage_uri=args.cold_storage_uri
+    )
+    mover = TierMover(filesystem, args.min_age, args.min_idle, args.namespace)
+    print(mover.move(args.limit))
+    filesystem.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import argparse
+from collections import namedtuple
+from typing import Dict, List, Tuple
+
+from pymongo import MongoClient, UpdateOne
+from pymongo.collection import Collection
+
+
+# Files of a namespace and the sum of their sizes, as counted
+NamespaceUsage = namedtuple('NamespaceUsage', ["namespace", "files", "size"])
+
+
+class UsageCounters(object):
+    """Collection with a document per namespace counting its files and bytes, so reading the usage is a single
+    lookup instead of going through every file.
+
+    Every change adds its difference with $inc, so concurrent writers don't lose updates. The counts only see the
+    changes made through FileSystems with the counters on, rebuild() recounts everything from the files.
+    """
+
+    def __init__(self, db: Collection):
+        self.db = db
+
+    def add(self, namespace: str, files: int, size: int):
+        if files or size:
+            self.db.update_one({"_id": namespace}, {"$inc": {"files": files, "size": size}}, upsert=True)
+
+    def add_many(self, changes: Dict[str, Tuple[int, int]]):
+        """Add {namespace: (files, size)} with a single write."""
+        operations = [
+            UpdateOne({"_id": namespace}, {"$inc": {"files": files, "size": size}}, upsert=True)
+            for namespace, (files, size) in changes.items() if files or size
+        ]
+        if operations:
+            self.db.bulk_write(operations, ordered=False)
+
+    def get(self, namespace: str) -> NamespaceUsage:
+        d = self.db.find_one({"_id": namespace}) or {}
+        return NamespaceUsage(namespace, d.get("files", 0), d.get("size", 0))
+
+    def all(self) -> List[NamespaceUsage]:
+        return [NamespaceUsage(d["_id"], d["files"], d["size"]) for d in self.db.find().sort("_id")]
+
+    def rebuild(self, files: Collection, namespace: str = None):
+        """Count everything again out of the files collection, for all namespaces or for one, with a single
+        aggregation.
+        """
+        query = {} if namespace is None else {"namespace": namespace}
+        counts = list(files.aggregate([
+            {"$match": query},
+            {"$group": {"_id": "$namespace", "files": {"$sum": 1}, "size": {"$sum": "$size"}}}
+        ]))
+        self.db.delete_many({} if namespace is None else {"_id": namespace})
+        if counts:
+            self.db.insert_many(counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the usage counters of a bazaar database")
+    parser.add_argument("db_uri", help="Mongo URI of the bazaar database, eg mongodb://localhost/bazaar")
+    parser.add_argument("--namespace", help="Only rebuild this namespace")
+    args = parser.parse_args()
+
+    database = MongoClient(host=args.db_uri).get_default_database()
+    counters = UsageCounters(database.usage)
+    counters.rebuild(database.file, args.namespace)
+    for usage in counters.all():
+        print(usage.namespace, usage.files, usage.size)
+
+
+if __name__ == '__main__':
+    main()
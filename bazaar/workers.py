@@ -0,0 +1,151 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, List, Union
+
+from fs.base import FS
+
+
+# How long a prefetching worker waits for room in the queue before checking if the reader has gone
+PREFETCH_POLL_SECONDS = 0.5
+
+
+class ByteBudget(object):
+    """Limit the bytes being moved at the same time by the workers."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size: int):
+        with self.condition:
+            # An item bigger than the limit is allowed when it's alone, otherwise it would wait forever
+            self.condition.wait_for(lambda: self.used == 0 or self.used + size <= self.limit)
+            self.used += size
+
+    def release(self, size: int):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+class IOPool(object):
+    """Threads running the storage calls of FileSystem.
+
+    PyFilesystem2 filesystems guard their state with a lock, so a handle can be shared by all the workers. That's the
+    case of the local (osfs) and memory (mem) filesystems and S3 (fs-s3fs keeps a boto3 client per thread). Others,
+    like FTP, share a single connection that serializes every call; give an fs_factory to open one handle per worker
+    so they really work in parallel.
+    """
+
+    def __init__(self, workers: int, max_in_flight_bytes: int, fs: FS, fs_factory: Callable[[], FS] = None):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bazaar-io")
+        self.budget = ByteBudget(max_in_flight_bytes)
+        self.max_in_flight_bytes = max_in_flight_bytes
+        self.fs = fs
+        self.fs_factory = fs_factory
+        self.local = threading.local()
+        self.worker_filesystems = []
+        self.lock = threading.Lock()
+
+    def worker_fs(self) -> FS:
+        if self.fs_factory is None:
+            return self.fs
+        fs = getattr(self.local, "fs", None)
+        if fs is None:
+            fs = self.local.fs = self.fs_factory()
+            with self.lock:
+                self.worker_filesystems.append(fs)
+        return fs
+
+    def run(self, function: Callable[[FS, Any], Any], item: Any) -> Union[Any, Exception]:
+        try:
+            return function(self.worker_fs(), item)
+        except Exception as e:
+            return e
+
+    def map(
+        self,
+        function: Callable[[FS, Any], Any],
+        items: Iterable[Any],
+        sizes: Iterable[int]
+    ) -> List[Union[Any, Exception]]:
+        """Call function(fs, item) for every item, returning its result or its exception, in order.
+
+        A new item is not started until the bytes of the running ones (their size) fit in the budget.
+        """
+        futures = []
+        for item, size in zip(items, sizes):
+            self.budget.acquire(size)
+            future = self.executor.submit(self.run, function, item)
+            future.add_done_callback(lambda _, size=size: self.budget.release(size))
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def prefetch(self, chunks: Iterator[bytes], chunk_size: int) -> Iterator[bytes]:
+        """Consume chunks in a thread of their own while the caller handles the previous ones.
+
+        At most max_in_flight_bytes are waiting to be read. Errors of the thread are raised to the caller. It's not a
+        worker: a prefetch consuming another (put_stream of a get_stream) would wait for a worker that the other one
+        holds, and the workers would all be waiting with as many streams as workers.
+        """
+        pending = queue.Queue(maxsize=max(1, self.max_in_flight_bytes // chunk_size))
+        stopped = threading.Event()
+        end = object()
+
+        def produce():
+            try:
+                for chunk in chunks:
+                    if not self.put_until_stopped(pending, chunk, stopped):
+                        return
+                self.put_until_stopped(pending, end, stopped)
+            except Exception as e:
+                self.put_until_stopped(pending, e, stopped)
+            finally:
+                close = getattr(chunks, "close", None)
+                if close is not None:
+                    close()
+
+        threading.Thread(target=produce, name="bazaar-prefetch", daemon=True).start()
+        try:
+            while True:
+                chunk = pending.get()
+                if chunk is end:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            stopped.set()
+
+    @staticmethod
+    def put_until_stopped(pending: queue.Queue, item: Any, stopped: threading.Event) -> bool:
+        while not stopped.is_set():
+            try:
+                pending.put(item, timeout=PREFETCH_POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        for fs in self.worker_filesystems:
+            fs.close()
+        self.worker_filesystems = []
+
+
+def run_serially(
+    function: Callable[[FS, Any], Any],
+    fs: FS,
+    items: Iterable[Any]
+) -> List[Union[Any, Exception]]:
+    """Same as IOPool.map in the calling thread."""
+    results = []
+    for item in items:
+        try:
+            results.append(function(fs, item))
+        except Exception as e:
+            results.append(e)
+    return results
@@ -16,9 +16,17 @@ setup(
     classifiers=['Topic :: Adaptive Technologies', 'Topic :: Software Development', 'Topic :: System',
                  'Topic :: Utilities'],
     install_requires=install_requires,
+    python_requires='>=3.6',
     extras_require={
         "s3": [
             "fs-s3fs==1.1.1"
         ],
+        # motor 2 is the last one for pymongo 3, it doesn't import on Python 3.11
+        "async": [
+            "motor>=2.0,<3.0; python_version < '3.11'"
+        ],
+        "zstd": [
+            "zstandard>=0.15"
+        ],
     },
 )